@@ -147,6 +147,10 @@ DEFAULTS = [
               'bareme_only': True,
               'data_file': None,
               'reform': False,
+              'lazy/enable': True,
+              'lazy/budget': 256,
+              'store/enable': False,
+              'store/dir': osp.join(get_home_dir(), SUBFOLDER, 'results'),
               }),
             ('calibration',
              {'enable' : True,
@@ -182,7 +186,10 @@ DEFAULTS = [
              {
               'enable': True,
               'byvar' : 'so',
-              'colvar' : 'nivvie'
+              'colvar' : 'nivvie',
+              'aligned_diff' : False,
+              'chunks/enable' : False,
+              'chunks/count' : 20,
               }),
             ('inequality',
              {
@@ -107,9 +107,9 @@ from openfisca_qt.plugins.general.Parametres import ParamWidget
 from openfisca_qt.plugins.scenario.graph import ScenarioGraphWidget
 from openfisca_qt.plugins.scenario.table import ScenarioTableWidget
 from openfisca_qt.plugins.survey.survey_explorer import SurveyExplorerWidget
-#from openfisca_qt.plugins.survey.aggregates import AggregatesWidget
+from openfisca_qt.plugins.survey.aggregates import AggregatesWidget
 from openfisca_qt.plugins.survey.distribution import DistributionWidget
-#from openfisca_qt.plugins.survey.inequality import InequalityWidget
+from openfisca_qt.plugins.survey.inequality import InequalityWidget
 from openfisca_qt.plugins.survey.Calibration import CalibrationWidget
 
 from openfisca_qt.gui.utils.qthelpers import (
@@ -766,12 +766,12 @@ class MainWindow(QMainWindow):
                 self.calibration.register_plugin()
                 self.survey_plugins += [self.calibration]
 
-#            # Aggregates widget
-#            if CONF.get('aggregates', 'enable'):
-#                self.set_splash(_("Loading aggregates widget ..."))
-#                self.aggregates = AggregatesWidget(self)
-#                self.aggregates.register_plugin()
-#                self.survey_plugins  += [ self.aggregates]
+            # Aggregates widget
+            if CONF.get('aggregates', 'enable'):
+                self.set_splash(_("Loading aggregates widget ..."))
+                self.aggregates = AggregatesWidget(self)
+                self.aggregates.register_plugin()
+                self.survey_plugins += [self.aggregates]
 
             # Distribution widget
             if CONF.get('distribution', 'enable'):
@@ -780,12 +780,12 @@ class MainWindow(QMainWindow):
                 self.distribution.register_plugin()
                 self.survey_plugins += [self.distribution]
 
-#            # Inequality widget
-#            if CONF.get('inequality', 'enable'):
-#                self.set_splash(_("Loading inequality widget ..."))
-#                self.inequality = InequalityWidget(self)
-#                self.inequality.register_plugin()
-#                self.survey_plugins  += [ self.inequality]
+            # Inequality widget
+            if CONF.get('inequality', 'enable'):
+                self.set_splash(_("Loading inequality widget ..."))
+                self.inequality = InequalityWidget(self)
+                self.inequality.register_plugin()
+                self.survey_plugins += [self.inequality]
 
         # Creates survey_toolbar if needed
         if self.survey_toolbar is not None:
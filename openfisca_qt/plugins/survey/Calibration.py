@@ -26,15 +26,9 @@ from __future__ import division
 
 import os
 
-from numpy import logical_not, unique
+from numpy import unique
 #from openfisca_core import model
-from openfisca_core.calmar import calmar
-<<<<<<< Updated upstream
-from openfisca_core.columns import EnumCol, BoolCol, AgeCol, DateCol, IntCol
-=======
-from openfisca_core.columns import EnumCol, BoolCol, AgeCol, DateCol
->>>>>>> Stashed changes
-from pandas import read_csv, DataFrame, concat
+from pandas import DataFrame
 from PyQt4.QtCore import SIGNAL, Qt, QSize
 from PyQt4.QtGui import (QLabel, QHBoxLayout, QVBoxLayout, QPushButton, QComboBox,
                          QSpinBox, QDoubleSpinBox, QCheckBox, QInputDialog, QFileDialog,
@@ -47,356 +41,12 @@ from ...gui.qt.compat import to_qvariant
 from ...gui.qt.QtGui import (QGroupBox, QButtonGroup)
 from ...gui.qthelpers import MyComboBox, MySpinBox, MyDoubleSpinBox, DataFrameViewWidget, _fromUtf8
 from ...widgets.matplotlibwidget import MatplotlibWidget
+from ...survey.calibration import Calibration, MODCOLS
 from .. import OpenfiscaPluginWidget, PluginConfigPage
+from .worker import SURVEY_LOCK
 
 
 _ = get_translation('openfisca_qt')
-<<<<<<< Updated upstream
-MODCOLS = [EnumCol, BoolCol, IntCol, AgeCol, DateCol]
-=======
-MODCOLS = [EnumCol, BoolCol, AgeCol, DateCol]
->>>>>>> Stashed changes
-
-
-class Calibration(object):
-    """
-    An object to calibrate survey data of a SurveySimulation
-    """
-    def __init__(self):
-        super(Calibration, self).__init__()
-
-        self.simulation = None
-        self.param = {}
-        self.frame = None
-        self.input_margins_df = None
-        self.output_margins_df = None
-
-        self.totalpop = None
-        self.ini_totalpop = None
-
-        self.param = {'use_proportions' : True, 'pondini': None, 'method' : None, 'up' : None, 'lo':None}
-
-        # TODO: add a champm option
-
-    def __repr__(self):
-        return '%s \n simulation %s ' % (self.__class__.__name__, self.simulation)
-
-    def set_totalpop(self, totalpop):
-        """
-        Sets total population
-        """
-        self.totalpop = totalpop
-
-
-    def reset(self):
-        """
-        Reset the calibration to it initial state
-        """
-        self.frame = None
-        WEIGHT = model.WEIGHT
-        self.simulation.survey.set_value(WEIGHT, self.weights_init, self.simulation.survey.index[self.entity])
-        self.simulation.survey.propagate_to_members( entity=self.entity, col=WEIGHT)
-
-
-    def set_simulation(self, simulation):
-        """
-        Set simulation
-        """
-        self.simulation = simulation
-        inputs = self.simulation.input_table
-        if inputs is None:
-            return
-        self.entity = 'men' # TODO: shoud not be france specific
-        WEIGHT = model.WEIGHT
-        WEIGHT_INI = model.WEIGHT_INI
-
-        self.weights = 1*inputs.get_value(WEIGHT, self.entity)
-        self.weights_init = inputs.get_value(WEIGHT_INI, self.entity)
-        self.champm =  inputs.get_value("champm", self.entity)
-
-        self.ini_totalpop = sum(self.weights_init*self.champm)
-
-
-    def set_param(self, parameter, value):
-        """
-        Set parameter
-        """
-        if parameter == 'lo':
-            self.param['lo'] = 1/value
-        else:
-            self.param[parameter] = value
-
-    def set_inputs_margins_from_file(self, filename, year):
-        self.set_margins_from_file(filename, year, source="input")
-
-    def set_margins_from_file(self, filename, year, source):
-        """
-        Sets margins for inputs variable from file
-        """
-        # TODO read from h5 files
-        with open(filename) as f_tot:
-            totals = read_csv(f_tot,index_col = (0,1))
-        # if data for the configured year is not availbale leave margins empty
-        year = str(year)
-        if year not in totals:
-            return
-        marges = {}
-        if source == "input":
-            self.input_margins_df = totals.rename(columns = {year : 'target'}, inplace = False)
-        elif source =='output':
-            self.output_margins_df = totals.rename(columns = {year : 'target'}, inplace = False)
-
-        for var, mod in totals.index:
-            if not marges.has_key(var):
-                marges[var] = {}
-            marges[var][mod] =  totals.get_value((var,mod),year)
-
-        for var in marges.keys():
-            if var == 'totalpop':
-                if source == "input" or source == "config":
-                    totalpop = marges.pop('totalpop')[0]
-                    marges['totalpop'] = totalpop
-                    self.totalpop = totalpop
-            else:
-                self.add_var2(var, marges[var], source = source)
-
-    def add_var2(self, varname, target=None, source = 'free'):
-        """
-        Add a variable in the dataframe
-
-        Parameters
-        ----------
-
-        varname : str
-                  name of the variable
-        target : float
-                 target for the margin of the variable
-        source : str, default 'free'
-                 database source
-        """
-        w_init = self.weights_init*self.champm
-        w = self.weights*self.champm
-        inputs = self.simulation.survey
-        output_table = self.simulation.output_table
-
-        varcol = self.simulation.get_col(varname)
-        entity = self.entity
-        enum = inputs.column_by_name.get('qui'+self.entity).enum
-        people = [x[1] for x in enum]
-
-        if varname in inputs.column_by_name:
-            value = inputs.get_value(varname, index = idx)
-        elif output_table is not None and varname in output_table.column_by_name:
-            value = output_table.get_value(varname, index = idx, opt = people, sum_ = True)
-
-        label = varcol.label
-        # TODO: rewrite this using pivot table
-        items = [ ('marge'    , w[self.champm]  ), ('marge initiale' , w_init[self.champm] )]
-        if varcol.__class__  in MODCOLS:
-            items.append(('mod',   value[self.champm]))
-            df = DataFrame.from_items(items)
-            res = df.groupby('mod', sort= True).sum()
-        else:
-            res = DataFrame(index = ['total'],
-                            data = {'marge' : (value*w).sum(),
-                                    'marge initiale' : (value*w_init).sum()  } )
-        res.insert(0, u"modalités",u"")
-        res.insert(2, "cible", 0)
-        res.insert(2, u"cible ajustée", 0)
-        res.insert(4, "source", source)
-        mods = res.index
-
-        if target is not None:
-            if len(mods) != len(target.keys()):
-                drop_indices = [ (varname, mod) for mod in target.keys()]
-                if source == 'input':
-                    self.input_margins_df.drop(drop_indices, inplace=True)
-                    self.input_margins_df.index.names = ['var','mod']
-                if source == 'output':
-                    self.output_margins_df.drop(drop_indices, inplace=True)
-                    self.output_margins_df.index.names = ['var','mod']
-                return
-
-        if isinstance(varcol, EnumCol):
-            if varcol.enum:
-                enum = varcol.enum
-                res[u'modalités'] = [enum._vars[mod] for mod in mods]
-                res['mod'] = mods
-            else:
-                res[u'modalités'] = [mod for mod in mods]
-                res['mod'] = mods
-        elif isinstance(varcol, BoolCol):
-            res[u'modalités'] = bool(mods)
-            res['mod']        = mods
-        elif isinstance(varcol, IntCol):
-            res[u'modalités'] = mods
-            res['mod']        = mods
-        elif isinstance(varcol, AgeCol):
-            res[u'modalités'] = mods
-            res['mod'] = mods
-        else:
-            res[u'modalités'] = "total"
-            res['mod']  = 0
-
-        if label is not None:
-            res['variable'] = label
-        else:
-            res['variable'] = varname
-        res['var'] = varname
-
-        if target is not None:
-            for mod, margin in target.iteritems():
-                if mod == varname:    # dirty to deal with non catgorical data
-                    res['cible'][0] = margin
-                else:
-                    res['cible'][mod] = margin
-
-        if self.frame is None:
-            self.frame = res
-        else:
-            self.frame = concat([self.frame, res])
-
-        self.frame = self.frame.reset_index(drop=True)
-
-
-    def get_param(self):
-        p = {}
-        p['method'] = self.param['method']
-        p['lo']     = 1/self.param['invlo']
-        p['up']     = self.param['up']
-        p['use_proportions'] = True
-        WEIGHT = model.WEIGHT
-        p['pondini']  = WEIGHT + ""
-        return p
-
-    def build_calmar_data(self, marges, weights_in):
-        """
-        Builds the data dictionnary used as calmar input argument
-
-        Parameters
-        ----------
-        marges : dict
-                 Variables and their margins. A scalar var for numeric variables and a dict with
-                 categories key and population
-        weights_in : str
-                     name of the original weight variable
-
-        Returns
-        -------
-        data : TODO:
-        """
-        # Select only champm ménages by nullifying weight for irrelevant ménages
-        inputs = self.simulation.survey
-        output_table = self.simulation.output_table
-
-        data = {weights_in: self.weights_init*self.champm}
-        for var in marges:
-            if var in inputs.column_by_name:
-                data[var] = inputs.get_value(var, self.entity)
-            elif output_table and var in output_table.column_by_name:
-                entity = self.entity
-                enum = inputs.column_by_name.get('qui'+self.entity).enum
-                people = [x[1] for x in enum]
-                data[var] = output_table.get_value(var, entity=entity, opt=people, sum_=True)
-        return data
-
-
-    def update_weights(self, marges, param = {}, weights_in=None):
-        """
-        Runs calmar, stores new weights and returns adjusted margins
-
-        Parameters
-        ----------
-        marges : dict
-                 Variables and their margins. A scalar var for numeric variables and a dict with
-                 categories key and population
-        param : dict
-                parameters of the calibration
-        weights_in : str
-                     name of the original weight variable
-
-        Returns
-        -------
-        marge_new : dict
-                    computed values of the margins
-        """
-        if weights_in is None:
-            WEIGHT = model.WEIGHT
-            weights_in = WEIGHT + "_ini"
-
-        data = self.build_calmar_data(marges, weights_in)
-        try:
-            val_pondfin, lambdasol, marge_new = calmar(data, marges, param = param, pondini=weights_in)
-        except Exception, e:
-            raise Exception("Calmar returned error '%s'" % e)
-
-        # Updating only champm weights
-        self.weights = val_pondfin*self.champm + self.weights*(logical_not(self.champm))
-        return marge_new
-
-    def calibrate(self):
-        """
-        Calibrate according to margins found in frame
-        """
-
-        df = self.frame
-        inputs = self.simulation.survey
-        output_table = self.simulation.output_table
-        margins = {}
-
-        if df is not None:
-            df = df.reset_index(drop=True)
-            df = df.set_index(['var','mod'], inplace = True)
-            for var, mod in df.index:
-                # Dealing with non categorical vars ...
-                if df.get_value((var,mod), u"modalités") == 'total':
-                    margins[var] =  df.get_value((var,mod), 'cible')
-                #  ... and categorical vars
-                else:
-                    if not margins.has_key(var):
-                        margins[var] = {}
-                    margins[var][mod] =  df.get_value((var,mod), 'cible')
-
-        param = self.get_param()
-
-        if self.totalpop is not None:
-            margins['totalpop'] = self.totalpop
-        adjusted_margins = self.update_weights(margins, param=param)
-
-        if 'totalpop' in margins.keys():
-            del margins['totalpop']
-
-        w = self.weights
-        for var in margins.keys():
-            if var in inputs.column_by_name:
-                value = inputs.get_value(var, self.entity)
-            else:
-                entity = self.entity
-                enum = output_table._inputs.column_by_name.get('qui'+self.entity).enum
-                people = [x[1] for x in enum]
-                value = output_table.get_value(var, entity=entity, opt=people, sum_=True)
-
-            if isinstance(margins[var], dict):
-                items = [('marge', w  ),('mod', value)]
-                updated_margins = DataFrame.from_items(items).groupby('mod', sort= True).sum()
-                for mod in margins[var].keys():
-                    df.set_value((var,mod), u"cible ajustée", adjusted_margins[var][mod])
-                    df.set_value((var,mod), u"marge", updated_margins['marge'][mod])
-            else:
-                updated_margin = (w*value).sum()
-                df.set_value((var,0), u"cible ajustée", adjusted_margins[var])
-                df.set_value((var,0), u"marge", updated_margin)
-
-        if self.frame is not None:
-            self.frame = df.reset_index()
-
-    def set_calibrated_weights(self):
-        """
-        Modify the weights to use the calibrated weight
-        """
-        WEIGHT = model.WEIGHT
-        self.simulation.survey.set_value(WEIGHT, self.weights, self.simulation.survey.index[self.entity])
-        self.simulation.survey.propagate_to_members( entity=self.entity, col=WEIGHT)
 
 
 class CalibrationConfigPage(PluginConfigPage):
@@ -535,9 +185,13 @@ class CalibrationWidget(OpenfiscaPluginWidget):
         verticalLayout.addLayout(totalpop_lyt)
         verticalLayout.addWidget(self.view)
 
-        # weights ratio plot
+        # weights ratio and convergence plots
         self.mplwidget = MatplotlibWidget(self)
-        verticalLayout.addWidget(self.mplwidget)
+        self.convergence_mplwidget = MatplotlibWidget(self)
+        plots_lyt = QHBoxLayout()
+        plots_lyt.addWidget(self.mplwidget)
+        plots_lyt.addWidget(self.convergence_mplwidget)
+        verticalLayout.addLayout(plots_lyt)
 
         button_box = QDialogButtonBox(QDialogButtonBox.Cancel| QDialogButtonBox.Ok, parent = self)
         verticalLayout.addWidget(button_box)
@@ -635,6 +289,8 @@ class CalibrationWidget(OpenfiscaPluginWidget):
 
 #        TODO: fix this lists      = {'input': self.input_vars_list, 'output': self.output_vars_list, 'free': self.free_vars_list}
 
+        if not self.initialize_calibration():
+            return
         lists      = {'input': self.input_vars_list}
 
         variables_list = lists[source]
@@ -664,10 +320,7 @@ class CalibrationWidget(OpenfiscaPluginWidget):
                         if ok:
                             target = {str(varname): val*1e6}
                 else:
-                    if datatable_name =='output_table':
-                        unique_values = unique(self.output_table.get_value(varname, self.entity))
-                    elif datatable_name =='inputs':
-                        unique_values = unique(self.inputs.get_value(varname, self.entity))
+                    unique_values = unique(self.calibration.get_margin_value(varname))
                     target = {}
 
                     for mod in unique_values:
@@ -685,6 +338,8 @@ class CalibrationWidget(OpenfiscaPluginWidget):
         '''
         Removes variable from the margins
         '''
+        if self.calibration is None or self.calibration.frame is None:
+            return
         vars_in_table = self.calibration.frame['var'].unique()
         varnames = self.get_name_label_dict(vars_in_table)
         varlabel, ok = QInputDialog.getItem(self.parent(), "Ajouter une variable", "Nom de la variable",
@@ -701,7 +356,11 @@ class CalibrationWidget(OpenfiscaPluginWidget):
         '''
         Removes all variables from the margins
         '''
-        self.calibration.reset()
+        if self.calibration is None:
+            return
+        # The initial weights are published in the survey
+        with SURVEY_LOCK:
+            self.calibration.reset()
         self.pop_checkbox.setChecked(False)
         self.pop_spinbox.setDisabled(True)
         self.pop_spinbox.spin.setDisabled(True)
@@ -767,6 +426,8 @@ class CalibrationWidget(OpenfiscaPluginWidget):
             return []
 
     def set_totalpop(self):
+        if not self.initialize_calibration():
+            return
         if self.pop_checkbox.isChecked():
             self.pop_spinbox.setEnabled(True)
             self.pop_spinbox.spin.setEnabled(True)
@@ -793,6 +454,7 @@ class CalibrationWidget(OpenfiscaPluginWidget):
             self.view.set_dataframe(df_view)
         self.view.reset()
         self.plotWeightsRatios()
+        self.plotConvergence()
 
     def set_param(self):
         '''
@@ -830,8 +492,20 @@ class CalibrationWidget(OpenfiscaPluginWidget):
         """
         Calibrate accoding to margins found in frame
         """
+        if not self.initialize_calibration():
+            return
         self.starting_long_process(_("Starting calibration"))
-        self.calibration.calibrate()
+        try:
+            # The margins are read from the survey and the output table
+            with SURVEY_LOCK:
+                self.calibration.calibrate()
+        except Exception, e:
+            self.plotConvergence()
+            self.ending_long_process(_("Calibration failed"))
+            QMessageBox.critical(
+                self, "Erreur", u"Le calage a échoué : " + unicode(e),
+                QMessageBox.Ok, QMessageBox.NoButton)
+            return
         self.update_view()
         self.ending_long_process(_("Microsimulation data calibrated"))
         self.calibrate_btn.setDisabled(True)
@@ -850,6 +524,21 @@ class CalibrationWidget(OpenfiscaPluginWidget):
         except:
             pass
 
+    def plotConvergence(self):
+        ax = self.convergence_mplwidget.axes
+        ax.clear()
+
+        trace = self.calibration.trace if self.calibration is not None else None
+        if trace is None or len(trace) == 0:
+            self.convergence_mplwidget.draw()
+            return
+        ax.semilogy(trace['iteration'], trace['max_gap'], 'o-', label = u"Écart relatif maximal")
+        ax.set_xlabel(u"Itération")
+        ax.set_ylabel(u"Écart relatif maximal aux marges")
+        last = trace.iloc[-1]
+        ax.set_title(u"Ratios des poids : [%.2f, %.2f]" % (last['ratio_min'], last['ratio_max']))
+        self.convergence_mplwidget.draw()
+
     def get_name_label_dict(self, variables_list):
         '''
         Builds a dict with label as keys and varname as value
@@ -881,7 +570,7 @@ class CalibrationWidget(OpenfiscaPluginWidget):
         # TODO: add  param
         # param_dict = self.get_param()
         year     = CONF.get('parameters','datesim')[:4]
-        df = self.calibration.frame
+        df = self.calibration.frame if self.calibration is not None else None
 
         if df is None:
             QMessageBox.critical(
@@ -907,24 +596,46 @@ class CalibrationWidget(OpenfiscaPluginWidget):
         calib_dir = CONF.get('paths','calib_dir')
         default_fileName = os.path.join(calib_dir, 'sans-titre')
         fileName = QFileDialog.getSaveFileName(self,
-                                               u"Enregistrer un calage", default_fileName, u"Calage OpenFisca (*.csv)")
+                                               u"Enregistrer un calage", default_fileName,
+                                               u"Calage OpenFisca (*.csv);;Calage OpenFisca avec poids (*.npz)")
         if fileName:
             try:
-                saved.to_csv(fileName, index=False)
+                if unicode(fileName).endswith('.npz'):
+                    self.calibration.save_bundle(unicode(fileName))
+                else:
+                    saved.to_csv(fileName, index=False)
             except Exception, e:
                 QMessageBox.critical(
                     self, "Erreur", u"Impossible d'enregistrer le fichier : " + str(e),
                     QMessageBox.Ok, QMessageBox.NoButton)
 
     def load_config(self):
+        if not self.initialize_calibration():
+            return
         self.reset()
         calib_dir = CONF.get('paths','calib_dir')
         fileName  = QFileDialog.getOpenFileName(self,
-                                               u"Ouvrir un calage", calib_dir, u"Calages OpenFisca (*.csv)")
+                                               u"Ouvrir un calage", calib_dir,
+                                               u"Calages OpenFisca (*.csv);;Calages OpenFisca avec poids (*.npz)")
         # TODO: should read the date from the calibration file
         year      = str(CONF.get('simulation','datesim').year)
 
-        if fileName:
+        if fileName and unicode(fileName).endswith('.npz'):
+            QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
+            with SURVEY_LOCK:
+                restored = self.calibration.load_bundle(unicode(fileName))
+            self.init_totalpop()
+            QApplication.restoreOverrideCursor()
+            self.param_or_margins_changed()
+            if restored:
+                # The restored weights are published in the survey
+                self.calibrate_btn.setDisabled(True)
+                self.main.refresh_survey_plugins()
+            else:
+                QMessageBox.warning(
+                    self, "Attention", u"Les données d'enquête ont changé : les marges sont chargées mais le calage doit être relancé",
+                    QMessageBox.Ok, QMessageBox.NoButton)
+        elif fileName:
             QApplication.setOverrideCursor(QCursor(Qt.WaitCursor))
             self.set_margins_from_file(fileName, year=year, source='config')
             self.init_totalpop()
@@ -935,8 +646,11 @@ class CalibrationWidget(OpenfiscaPluginWidget):
         '''
         Updates inputs weights
         '''
+        if self.calibration is None:
+            return
         self.starting_long_process(_("Setting calibrated weights ..."))
-        self.calibration.set_calibrated_weights()
+        with SURVEY_LOCK:
+            self.calibration.set_calibrated_weights()
         self.ending_long_process(_("Calibration weights set"))
         self.main.refresh_survey_plugins()
 # TODO: remove me when done
@@ -985,24 +699,49 @@ class CalibrationWidget(OpenfiscaPluginWidget):
         """
         Register plugin in OpenFisca's main window
         """
-        simulation = self.main.survey_simulation
-        if simulation.input_table is None:
+        if self.main.survey_simulation is None:
             return
-        calibration = Calibration()
-        if simulation is not None:
+        # The calibration is initialized on its first use, so that the survey is not read
+        # at startup when the survey explorer reads it lazily
+        self.main.add_dockwidget(self)
+
+    def initialize_calibration(self):
+        """
+        Initializes the calibration on its first use, loading the survey if it is not already
+
+        Returns
+        -------
+        initialized : bool
+                      False if there is no survey data to calibrate
+        """
+        if self.calibration is not None:
+            return True
+        simulation = self.main.survey_simulation
+        if simulation is None:
+            return False
+        # The survey is not modified by a computation meanwhile
+        with SURVEY_LOCK:
+            # The weights are needed, even when the survey explorer reads the survey lazily
+            if not self.main.survey_explorer.is_input_loaded():
+                self.starting_long_process(_("Loading survey data ..."))
+                self.main.survey_explorer.load_input_table()
+                self.ending_long_process(_("Survey data loaded"))
+            if simulation.input_table is None:
+                return False
+            calibration = Calibration()
             calibration.set_simulation(simulation)
-            calibration.set_param('invlo', 2)
-            calibration.set_param('up', 2)
-            calibration.set_param('method', 'linear')
+        calibration.set_param('invlo', 2)
+        calibration.set_param('up', 2)
+        calibration.set_param('method', 'linear')
 
-            self.set_calibration(calibration)
-            try:
-                self.set_inputs_margins_from_file()
-                self.init_totalpop()
-                self.init_param()
-            except:
-                pass
-        self.main.add_dockwidget(self)
+        self.set_calibration(calibration)
+        try:
+            self.set_inputs_margins_from_file()
+            self.init_totalpop()
+            self.init_param()
+        except:
+            pass
+        return True
 
     def refresh_plugin(self):
         '''
@@ -1010,6 +749,12 @@ class CalibrationWidget(OpenfiscaPluginWidget):
         '''
 
         self.starting_long_process(_("Refreshing calibration table ..."))
+        # Output variables may have changed with the new computation
+        if self.calibration is not None:
+            self.calibration.invalidate_margin_values()
+        elif self.main.survey_explorer.is_input_loaded():
+            # The computation loaded the survey
+            self.initialize_calibration()
         self.ending_long_process(_("Calibration table updated"))
 
 
@@ -1025,7 +770,7 @@ class CalibrationWidget(OpenfiscaPluginWidget):
 
 def test():
     from openfisca_core.simulations import SurveySimulation
-    from .aggregates import Aggregates
+    from ...survey.aggregates import Aggregates
 
     yr = 2006
     simulation = SurveySimulation()
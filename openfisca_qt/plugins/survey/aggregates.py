@@ -0,0 +1,246 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import os
+
+from pandas import ExcelWriter
+
+from ...gui.baseconfig import get_translation
+from ...gui.config import get_icon
+from ...gui.qt.QtCore import SIGNAL, Qt
+from ...gui.qt.QtGui import (QWidget, QDockWidget, QVBoxLayout, QGroupBox, QFileDialog, QMessageBox)
+from ...gui.qthelpers import DataFrameViewWidget, OfSs
+from ...gui.utils.qthelpers import create_action
+from ...survey.aggregates import Aggregates
+from .. import OpenfiscaPluginWidget, PluginConfigPage
+from .worker import ComputationRunner, SURVEY_LOCK
+
+
+_ = get_translation('openfisca_qt')
+
+
+class AggregatesConfigPage(PluginConfigPage):
+    def __init__(self, plugin, parent):
+        PluginConfigPage.__init__(self, plugin, parent)
+        self.get_name = lambda: _("Aggregates")
+
+    def setup_page(self):
+        group = QGroupBox(_("Columns"))
+        layout = QVBoxLayout()
+        for option, label in [('show_dep', _("Expenditures")),
+                              ('show_benef', _("Beneficiaries")),
+                              ('show_default', _("Reference simulation")),
+                              ('show_real', _("Administrative data")),
+                              ('show_diff', _("Differences")),
+                              ('show_diff_abs', _("Absolute differences")),
+                              ('show_diff_rel', _("Relative differences"))]:
+            layout.addWidget(self.create_checkbox(label, option))
+        group.setLayout(layout)
+
+        vlayout = QVBoxLayout()
+        vlayout.addWidget(group)
+        vlayout.addStretch(1)
+        self.setLayout(vlayout)
+
+
+class AggregatesWidget(OpenfiscaPluginWidget):
+    """
+    Aggregates Widget
+    """
+    CONF_SECTION = 'aggregates'
+    CONFIGWIDGET_CLASS = AggregatesConfigPage
+    LOCATION = Qt.LeftDockWidgetArea
+    FEATURES = QDockWidget.DockWidgetClosable | \
+               QDockWidget.DockWidgetFloatable | \
+               QDockWidget.DockWidgetMovable
+    DISABLE_ACTIONS_WHEN_HIDDEN = False
+
+    def __init__(self, parent = None):
+        super(AggregatesWidget, self).__init__(parent)
+        self.setStyleSheet(OfSs.dock_style)
+        # Create geometry
+        self.setObjectName(_("Aggregates"))
+        self.setWindowTitle(_("Aggregates"))
+        self.dockWidgetContents = QWidget()
+        self.view = DataFrameViewWidget(self.dockWidgetContents)
+
+        verticalLayout = QVBoxLayout(self.dockWidgetContents)
+        verticalLayout.addWidget(self.view)
+        self.setLayout(verticalLayout)
+
+        # Initialize attributes
+        self.parent = parent
+        self.aggregates = Aggregates()
+        # Aggregates are computed in a worker thread
+        self.runner = ComputationRunner(self, lock = SURVEY_LOCK)
+
+    #------ Public API ---------------------------------------------
+
+    def set_simulation(self, simulation):
+        '''
+        Set the simulation
+
+        Parameters
+        ----------
+
+        simulation : SurveySimulation
+                     the simulation object to extract the data from
+        '''
+        self.aggregates.set_simulation(simulation)
+        self.aggregates.show_default = self.get_option('show_default')
+        self.aggregates.show_real = self.get_option('show_real')
+        self.aggregates.show_diff = self.get_option('show_diff')
+
+    def compute(self, progress = None):
+        """
+        Computes the aggregates (run in the worker thread)
+        """
+        self.aggregates.compute(progress = progress)
+        return self.aggregates.aggr_frame
+
+    def get_view_frame(self, frame):
+        """
+        Returns the columns of the aggregates selected in the options
+        """
+        labels = self.aggregates.labels
+        keys = ['var']
+        if self.get_option('show_dep'):
+            keys += ['dep', 'dep_default', 'dep_real']
+        if self.get_option('show_benef'):
+            keys += ['benef', 'benef_default', 'benef_real']
+        if not self.get_option('show_default'):
+            keys = [key for key in keys if not key.endswith('_default')]
+        if not self.get_option('show_real'):
+            keys = [key for key in keys if not key.endswith('_real')]
+        if self.get_option('show_diff'):
+            for diff in ['abs', 'rel']:
+                if self.get_option('show_diff_' + diff):
+                    keys += [key + '_diff_' + diff for key in ['dep', 'benef']
+                             if self.get_option('show_' + key)]
+        columns = [label for key, label in labels.iteritems() if key in keys and label in frame]
+        return frame[columns]
+
+    def update_view(self, frame):
+        """
+        Displays the aggregates computed by compute (in the GUI thread)
+        """
+        self.view.set_dataframe(self.get_view_frame(frame))
+        self.view.reset()
+        self.calculated()
+
+    def calculated(self):
+        '''
+        Emits signal indicating that aggregates are computed
+        '''
+        self.emit(SIGNAL('calculated()'))
+
+    def save_table(self):
+        '''
+        Saves the aggregates table
+        '''
+        table_format = self.get_option('table/format')
+        output_dir = self.get_option('table/export_dir')
+        filename = os.path.join(output_dir, _("Untitled.") + table_format)
+        extension = table_format.upper() + "   (*." + table_format + ")"
+        fname = QFileDialog.getSaveFileName(self, _("Save table"), filename, extension)
+        if not fname or self.aggregates.aggr_frame is None:
+            return
+        self.set_option('table/export_dir', os.path.dirname(unicode(fname)))
+        try:
+            frame = self.get_view_frame(self.aggregates.aggr_frame)
+            if table_format == "xls":
+                writer = ExcelWriter(unicode(fname))
+                frame.to_excel(writer, "aggregates", index = False, header = True)
+                self.aggregates.create_description().to_excel(writer, "description", index = False, header = False)
+                writer.save()
+            elif table_format == "csv":
+                frame.to_csv(unicode(fname), index = False, header = True, sep = ';', encoding = 'utf-8')
+        except Exception, e:
+            QMessageBox.critical(self, "Error saving file", str(e), QMessageBox.Ok, QMessageBox.NoButton)
+
+    #------ OpenfiscaPluginMixin API ---------------------------------------------
+
+    def apply_plugin_settings(self, options):
+        """
+        Apply configuration file's plugin settings
+        """
+        if self.aggregates.aggr_frame is not None:
+            if 'show_default' in options or 'show_real' in options or 'show_diff' in options:
+                self.refresh_plugin()
+            else:
+                self.update_view(self.aggregates.aggr_frame)
+
+    #------ OpenfiscaPluginWidget API ---------------------------------------------
+
+    def get_plugin_title(self):
+        """
+        Return plugin title
+        Note: after some thinking, it appears that using a method
+        is more flexible here than using a class attribute
+        """
+        return _("Aggregates")
+
+    def get_plugin_icon(self):
+        """
+        Return plugin icon (QIcon instance)
+        Note: this is required for plugins creating a main window
+              and for configuration dialog widgets creation
+        """
+        return get_icon('OpenFisca22.png')
+
+    def get_plugin_actions(self):
+        """
+        Return a list of actions related to plugin
+        Note: these actions will be enabled when plugin's dockwidget is visible
+              and they will be disabled when it's hidden
+        """
+        self.save_action = create_action(self, _("Save &table"),
+                                         icon = 'filesave.png', tip = _("Save aggregates table"),
+                                         triggered = self.save_table)
+        return [self.save_action]
+
+    def register_plugin(self):
+        """
+        Register plugin in OpenFisca's main window
+        """
+        self.main.add_dockwidget(self)
+
+    def refresh_plugin(self):
+        '''
+        Update aggregates table
+        '''
+        self.set_simulation(self.main.survey_simulation)
+        self.runner.start(self.compute, self.update_view, _("Computing aggregates ..."),
+                          done_message = _("Aggregates computed"))
+
+    def closing_plugin(self, cancelable=False):
+        """
+        Perform actions before parent main window is closed
+        Return True or False whether the plugin may be closed immediately or not
+        Note: returned value is ignored if *cancelable* is False
+        """
+        self.runner.cancel()
+        return True
@@ -22,12 +22,6 @@ This file is part of openFisca.
 
 from __future__ import division
 
-import numpy as np
-from pandas import DataFrame, merge
-
-#from openfisca_core import model
-from openfisca_france.surveys import SurveyScenario
-
 from ...gui.baseconfig import get_translation
 from ...gui.qt.compat import from_qvariant
 from ...gui.qt.QtCore import SIGNAL, QSize
@@ -35,177 +29,14 @@ from ...gui.qt.QtGui import (QWidget, QVBoxLayout, QHBoxLayout, QComboBox, QSort
                          QSpacerItem, QSizePolicy, QPushButton, QInputDialog, QGroupBox)
 from ...gui.qthelpers import OfSs, DataFrameViewWidget, MyComboBox
 from ...gui.utils.qthelpers import  get_icon
+from ...survey.pivot_table import OpenfiscaPivotTable
 from .. import OpenfiscaPluginWidget, PluginConfigPage
+from .worker import ComputationRunner, SURVEY_LOCK
 
 
 _ = get_translation('openfisca_qt')
 
 
-class OpenfiscaPivotTable(object):
-    def __init__(self):
-        super(OpenfiscaPivotTable, self).__init__()
-
-        self.data = DataFrame() # Pandas DataFrame
-        self.data_default   = None
-        self.by_var_choices = None
-
-        # List of variable entering the level 0 (rows) index
-        self.row_index = None
-
-        # TODO:
-        # Dict of variables in the level 1 (columns)
-        # exemple { revdisp : { data : [ 'current', 'default'], transform : ['mean', 'median'],  diff: ['absolute', 'relative', 'winners', 'loosers']
-
-
-    def set_simulation(self, simulation):
-        """
-        Set the survey_simulation
-
-        Parameters
-        ----------
-
-        simulation : SurveySimulation
-        """
-        if isinstance(simulation, SurveySimulation):
-            self.simulation = simulation
-            self.by_var_choices = self.simulation.var_list
-        else:
-            raise Exception('OpenfiscaPivotTable:  %s should be an instance of %s class'  %(simulation, SurveySimulation))
-
-    @property
-    def vars(self):
-        return set(self.simulation.var_list)
-
-    def set_data(self, output_data, default=None):
-        self.data = output_data
-        if default is not None:
-            self.data_default = default
-
-        self.wght = self.data[model.WEIGHT]
-
-    def get_table(self, by = None, vars = None, entity = None, champm = True, do_not_use_weights = False):
-        """
-        Build pivot table dataframe
-
-        Parameters
-        ----------
-
-        by : string, default None
-             Name of the variable against which the selected variables are distributed
-        vars : list, default None
-               Varaibles to be distributed
-        entity : string, default TODO:
-                 Name of the entity at which level varaibles are summed
-        champm : bool default, default True
-                 Use filtering variable champm
-        do_not_use_weights : bool default False
-                             Do not use weights to compute the statistics
-        """
-        by_var = by
-        if by_var is None:
-            raise Exception("OpenfiscaPivotTable : get_table needs a 'by' variable")
-
-        if vars is None:
-            raise Exception("OpenfiscaPivotTable : get_table needs a 'vars' variable")
-
-        if champm:
-            initial_set = set([by_var, 'champm'] + list(vars))
-        else:
-            initial_set = set([by_var] + list(vars))
-
-        WEIGHT = model.WEIGHT
-
-        if entity is None:
-            entity = model.ENTITIES_INDEX[0]
-
-        try:
-            data, data_default = self.simulation.aggregated_by_entity(entity, initial_set)
-        except:
-            self.simulation.compute()
-            data, data_default = self.simulation.aggregated_by_entity(entity, initial_set)
-
-        self.set_data(data, data_default)
-
-        dist_frame_dict = self.group_by(vars, by_var, champm=champm, do_not_use_weights=do_not_use_weights)
-
-        frame = None
-        for dist_frame in dist_frame_dict.itervalues():
-            if frame is None:
-                frame = dist_frame.copy()
-            else:
-                try:
-                    dist_frame.pop(WEIGHT)
-                except:
-                    pass
-                frame = merge(frame, dist_frame, on=by_var)
-
-        frame = frame.reset_index(drop=True)
-
-        for col in frame.columns:
-            if col[-6:] == "__init":
-                frame.rename(columns = { col : self.simulation.io_column_by_name[col[:-6]].label + " init."}, inplace = True)
-            else:
-                frame.rename(columns = { col : self.simulation.io_column_by_name[col].label }, inplace = True)
-
-        by_var_column = self.simulation.io_column_by_name[by_var]
-        enum = getattr(by_var_column, 'enum', None)
-        if enum is not None:
-            try:
-                frame[by_var_column.label] = frame[by_var_column.label].apply(lambda x: enum._vars[x])
-            except Exception as e:
-                print "Error in enum in distribution"
-                print e
-        return frame
-
-    def group_by(self, varlist, category, champm=True, do_not_use_weights=False):
-        '''
-        Computes grouped aggregates
-        '''
-        datasets = {'data': self.data}
-        aggr_dict = {}
-        if self.data_default is not None:
-            datasets['default'] = self.data_default
-
-        WEIGHT = model.WEIGHT
-        for name, data in datasets.iteritems():
-            # Computes aggregates by category
-            if champm:
-                keep = [category, WEIGHT, 'champm']
-                temp_data = data[keep].copy()
-                temp_data[WEIGHT] = temp_data[WEIGHT]*temp_data['champm']
-                keep.remove('champm')
-                del temp_data['champm']
-            else:
-                keep = [category, WEIGHT]
-                temp_data = data[keep].copy()
-
-            temp = []
-            for var in varlist:
-                temp_data[var] = temp_data[WEIGHT]*data[var]
-                temp.append(var)
-                keep.append(var)
-
-            # TODO: we may use the pandas pivot_table
-            grouped = temp_data[keep].groupby(category, as_index = False)
-            aggr_dict[name] = grouped.aggregate(np.sum)
-
-            # Normalizing to have the average
-            for varname in temp:
-                if name=='default':
-                    label = varname + '__init'
-                    aggr_dict[name][label] = aggr_dict[name][varname]/aggr_dict[name][WEIGHT]
-                    del aggr_dict[name][varname]
-                else:
-                    aggr_dict[name][varname] = aggr_dict[name][varname]/aggr_dict[name][WEIGHT]
-
-        return aggr_dict
-
-
-    def clear(self):
-        self.view.clear()
-        self.data = None
-        self.wght = None
-
 class DistributionConfigPage(PluginConfigPage):
     def __init__(self, plugin, parent):
         PluginConfigPage.__init__(self, plugin, parent)
@@ -231,8 +62,29 @@ class DistributionConfigPage(PluginConfigPage):
         variables_layout.addWidget(colvar_combo)
         variables_group.setLayout(variables_layout)
 
+        reform_group = QGroupBox(_("Reform"))
+        aligned_diff = self.create_checkbox(_("Compute the reference statistics within the groups of the reform"),
+                                            'aligned_diff')
+        reform_layout = QVBoxLayout()
+        reform_layout.addWidget(aligned_diff)
+        reform_group.setLayout(reform_layout)
+
+        chunks_group = QGroupBox(_("Large surveys"))
+        chunks_enable = self.create_checkbox(_("Compute the table by chunks from the stored results of the microsimulation"),
+                                             'chunks/enable')
+        chunks_count = self.create_spinbox(_("Number of chunks"), "", 'chunks/count',
+                                           min_ = 1, max_ = 1000, step = 1)
+        self.connect(chunks_enable, SIGNAL("toggled(bool)"), chunks_count.setEnabled)
+        chunks_count.setEnabled(self.get_option('chunks/enable'))
+        chunks_layout = QVBoxLayout()
+        chunks_layout.addWidget(chunks_enable)
+        chunks_layout.addWidget(chunks_count)
+        chunks_group.setLayout(chunks_layout)
+
         vlayout = QVBoxLayout()
         vlayout.addWidget(variables_group)
+        vlayout.addWidget(reform_group)
+        vlayout.addWidget(chunks_group)
         vlayout.addStretch(1)
         self.setLayout(vlayout)
 
@@ -296,6 +148,8 @@ class DistributionWidget(OpenfiscaPluginWidget):
         self.openfisca_pivot_table = None
         self.distribution_by_var = None
         self.selected_vars = None
+        # Pivot tables are computed in a worker thread
+        self.runner = ComputationRunner(self, lock = SURVEY_LOCK)
 
         self.setLayout(verticalLayout)
         self.initialize()
@@ -325,7 +179,7 @@ class DistributionWidget(OpenfiscaPluginWidget):
         var = self.ask()
         if var is not None:
             self.selected_vars.add(var)
-            self.refresh_plugin()
+            self.update_view()
         else:
             return
 
@@ -333,7 +187,7 @@ class DistributionWidget(OpenfiscaPluginWidget):
         var = self.ask(remove=True)
         if var is not None:
             self.selected_vars.remove(var)
-            self.refresh_plugin()
+            self.update_view()
         else:
             return
 
@@ -361,7 +215,7 @@ class DistributionWidget(OpenfiscaPluginWidget):
             by_var = unicode( from_qvariant(data))
 
             self.distribution_by_var = by_var
-            self.refresh_plugin()
+            self.update_view()
 
     def set_distribution_choices(self):
         '''
@@ -420,19 +274,50 @@ class DistributionWidget(OpenfiscaPluginWidget):
         return get_icon('OpenFisca22.png')
 
     def refresh_plugin(self):
+        '''
+        Update distribution view after the simulation is computed
+        '''
+        if self.openfisca_pivot_table is not None:
+            self.openfisca_pivot_table.invalidate()
+        self.update_view()
+
+    def update_view(self):
         '''
         Update distribution view
         '''
-        self.starting_long_process(_("Refreshing distribution table ..."))
+        if self.openfisca_pivot_table is None:
+            self.view.reset()
+            return
+        # A copy of the selection is used since it may change while the table is computed
+        kwargs = dict(by = self.distribution_by_var, vars = list(self.selected_vars),
+                      aligned = self.get_option('aligned_diff', False))
+        stored_results = self.main.survey_explorer.get_stored_results()
+        if self.get_option('chunks/enable', False) and stored_results is not None:
+            # The whole aggregated tables are not built
+            kwargs.update(chunks_count = self.get_option('chunks/count', 20), stored_results = stored_results)
+        self.runner.start(self.compute_table, self.set_table, _("Refreshing distribution table ..."),
+                          done_message = _("Distribution table refreshed"), kwargs = kwargs)
+
+    def compute_table(self, by, vars, aligned = False, chunks_count = None, stored_results = None, progress = None):
+        '''
+        Computes the pivot table (run in the worker thread)
 
-        by_var = self.distribution_by_var
-        selection = self.selected_vars
-        if self.openfisca_pivot_table is not None:
-            frame = self.openfisca_pivot_table.get_table(by = by_var, vars = selection)
-            self.view.set_dataframe(frame)
+        The table is read by chunks from the stored results of the simulation when chunks_count
+        is given
+        '''
+        if chunks_count is not None:
+            store, key = stored_results
+            return self.openfisca_pivot_table.get_table(by = by, vars = vars, chunks_count = chunks_count,
+                                                        store = store, key = key, progress = progress)
+        return self.openfisca_pivot_table.get_table(by = by, vars = vars, aligned = aligned, progress = progress)
+
+    def set_table(self, frame):
+        '''
+        Displays the pivot table computed by compute_table (in the GUI thread)
+        '''
+        self.view.set_dataframe(frame)
         self.view.reset()
         self.calculated()
-        self.ending_long_process(_("Distribution table refreshed"))
 
     def get_plugin_actions(self):
         """
@@ -459,5 +344,5 @@ class DistributionWidget(OpenfiscaPluginWidget):
         Return True or False whether the plugin may be closed immediately or not
         Note: returned value is ignored if *cancelable* is False
         """
-
+        self.runner.cancel()
         return True
@@ -22,12 +22,7 @@ This file is part of openFisca.
 """
 
 
-from datetime import datetime
-
-#from openfisca_core import model
-from openfisca_france.surveys import SurveyScenario
-from openfisca_france_data.model.statshelpers import gini, lorenz, mark_weighted_percentiles
-from pandas import DataFrame
+from openfisca_france_data.model.statshelpers import lorenz
 
 from ...gui.baseconfig import get_translation
 from ...gui.config import get_icon
@@ -35,118 +30,15 @@ from ...gui.qt.QtCore import SIGNAL, Qt
 from ...gui.qt.QtGui import (QWidget, QApplication, QCursor, QDockWidget, QGroupBox, QVBoxLayout)
 from ...gui.qthelpers import DataFrameViewWidget, OfSs
 from ...widgets.matplotlibwidget import MatplotlibWidget
+from ...survey import model
+from ...survey.inequality import Inequality
 from .. import OpenfiscaPluginWidget, PluginConfigPage
+from .worker import ComputationRunner, SURVEY_LOCK
 
 
 _ = get_translation('inequality', 'openfisca_qt.plugins.survey')
 
 
-class Inequality(object):
-    def __init__(self):
-        super(Inequality, self).__init__()
-        self.simulation = None
-
-        self.data = DataFrame()
-        self.data_default = None
-        self.vars = {'nivvie_ini': ['men'],
-                     'nivvie_net':  ['men'],
-                     'nivvie' : ['men']}
-
-#        self.vars = {'nivvie_prim': ['ind', 'men'],
-#                     'nivvie_init': ['ind', 'men'],
-#                     'nivvie_net':  ['ind', 'men'],
-#                     'nivvie' : ['ind', 'men']}
-        self.gini = None
-        self.inequality_dataframe = None
-        self.poverty = None
-
-    def set_simulation(self, simulation):
-        """
-        Set simulation
-        """
-        if isinstance(simulation, SurveySimulation):
-            self.simulation = simulation
-        else:
-            raise Exception('Inequality:  %s should be an instance of %s class'  %(simulation, SurveySimulation))
-
-
-    def compute(self):
-        """
-        Compute inequality dataframe
-        """
-        output = self.simulation.output_table
-        final_df = None
-
-        WEIGHT = model.WEIGHT
-        FILTERING_VARS = model.FILTERING_VARS
-        for varname, entities in self.vars.iteritems():
-            for entity in entities:
-                #idx =  output.index[entity]
-
-                val  = output.get_value(varname, entity)
-                weights = output._inputs.get_value(WEIGHT, entity)
-                filter_var_name = FILTERING_VARS[0]
-                filter_var= output._inputs.get_value(filter_var_name, entity)
-
-            items = []
-            # Compute mean
-            moy = (weights*filter_var*val).sum()/(weights*filter_var).sum()
-            items.append( ("Moyenne",  [moy]))
-
-            # Compute deciles
-            labels = range(1,11)
-            method = 2
-            decile, values = mark_weighted_percentiles(val, labels, weights*filter_var, method, return_quantiles=True)
-
-            labels = [ 'D'+str(d) for d in range(1,11)]
-            del decile
-            for l, v in zip(labels[:-1],values[1:-1]):
-                items.append( (l, [v]))
-
-            # Compute Gini
-            gini_coeff = gini(val, weights*filter_var)
-            items.append( ( _("Gini index"), [gini_coeff]))
-
-            df = DataFrame.from_items(items, orient = 'index', columns = [varname])
-            df = df.reset_index()
-            if final_df is None:
-                final_df = df
-            else:
-                final_df = final_df.merge(df, on='index')
-
-        final_df[u"Initial à net"] = (final_df['nivvie_net']-final_df['nivvie_ini'])/final_df['nivvie_ini']
-        final_df[u"Net à disponible"] = (final_df['nivvie']-final_df['nivvie_net'])/final_df['nivvie_net']
-        final_df = final_df[['index','nivvie_ini', u"Initial à net", 'nivvie_net',u"Net à disponible",'nivvie']]
-        self.inequality_dataframe = final_df
-
-        # poverty
-        poverty = dict()
-        entity = "men"
-        varname = "nivvie"
-        for percentage in [ 40, 50, 60]:
-#            idx =  output.index[entity]
-            varname = "pauvre" + str(percentage)
-            val = output.get_value(varname, entity)
-            weights = output._inputs.get_value(WEIGHT, entity)
-            filter_var_name = FILTERING_VARS[0]
-            filter_var= output._inputs.get_value(filter_var_name, entity)
-            poverty[percentage] =  (weights*filter_var*val).sum()/(weights*filter_var).sum()
-
-        self.poverty = poverty
-
-    def create_description(self):
-        '''
-        Creates a description dataframe
-        '''
-        now = datetime.now()
-        descr =  [u'OpenFisca',
-                         u'Calculé le %s à %s' % (now.strftime('%d-%m-%Y'), now.strftime('%H:%M')),
-                         u'Système socio-fiscal au %s' % self.simulation.datesim,
-                         u"Données d'enquêtes de l'année %s" %str(self.simulation.survey.survey_year) ]
-        return DataFrame(descr)
-
-
-
 class InequalityConfigPage(PluginConfigPage):
     def __init__(self, plugin, parent):
         PluginConfigPage.__init__(self, plugin, parent)
@@ -205,18 +97,16 @@ class InequalityWidget(OpenfiscaPluginWidget):
         self.parent = parent
 
         self.inequality = Inequality()
+        # Inequality indices and Lorenz curves are computed in a worker thread
+        self.runner = ComputationRunner(self, lock = SURVEY_LOCK)
 
     #------ Public API ---------------------------------------------
 
 
-    def plot(self):
+    def get_lorenz_curves(self):
         '''
-        Plots the Lorenz Curve
+        Returns the Lorenz curves of the variables as a list of (label, x, y)
         '''
-        axes = self.lorenzWidget.axes
-        axes.clear()
-
-
         output = self.inequality.simulation.output_table
         simulation = self.inequality.simulation
         WEIGHT = model.WEIGHT
@@ -226,6 +116,7 @@ class InequalityWidget(OpenfiscaPluginWidget):
         for entity in entities:
             weights[entity] = output._inputs.get_value(WEIGHT, entity)
 
+        curves = []
         for varname, entities in self.inequality.vars.iteritems():
             for entity in entities:
 
@@ -233,9 +124,24 @@ class InequalityWidget(OpenfiscaPluginWidget):
 
                 x, y = lorenz(values, weights[entity])
                 label = varname + ' (' + entity + ') '
-                axes.plot(x,y, linewidth = 2, label = label)
+                curves.append((label, x, y))
+        return curves
+
+    def plot(self, curves):
+        '''
+        Plots the Lorenz Curves
 
-        axes.plot(x,x, label ="")
+        Parameters
+        ----------
+        curves : list
+                 (label, x, y) of the curves, as returned by get_lorenz_curves
+        '''
+        axes = self.lorenzWidget.axes
+        axes.clear()
+        for label, x, y in curves:
+            axes.plot(x,y, linewidth = 2, label = label)
+
+        axes.plot([0, 1], [0, 1], label ="")
         axes.legend(loc= 2, prop = {'size':'medium'})
         axes.set_xlim([0,1])
         axes.set_ylim([0,1])
@@ -254,11 +160,27 @@ class InequalityWidget(OpenfiscaPluginWidget):
         self.inequality.set_simulation(simulation)
 
 
+    def compute(self, progress = None):
+        """
+        Computes the inequality dataframe and the Lorenz curves (run in the worker thread)
+        """
+        self.inequality.compute(progress = progress)
+        if progress is not None:
+            progress(_("Computing Lorenz curves ..."))
+        return self.get_lorenz_curves()
+
+    def computed_results(self, curves):
+        """
+        Displays the results of compute (in the GUI thread)
+        """
+        self.update_frame()
+        self.plot(curves)
+        self.calculated()
+
     def update_frame(self):
         """
         Update frame
         """
-        self.inequality.compute()
         self.ineqFrameWidget.set_dataframe(self.inequality.inequality_dataframe)
         self.ineqFrameWidget.reset()
 
@@ -304,11 +226,9 @@ class InequalityWidget(OpenfiscaPluginWidget):
         '''
         Update Inequality Table
         '''
-        self.starting_long_process(_("Refreshing inequality widget ..."))
         self.set_simulation(self.main.survey_simulation)
-        self.update_frame()
-        self.plot()
-        self.ending_long_process(_("Inequality widget refreshed"))
+        self.runner.start(self.compute, self.computed_results, _("Refreshing inequality widget ..."),
+                          done_message = _("Inequality widget refreshed"))
 
     def closing_plugin(self, cancelable=False):
         """
@@ -316,4 +236,5 @@ class InequalityWidget(OpenfiscaPluginWidget):
         Return True or False whether the plugin may be closed immediately or not
         Note: returned value is ignored if *cancelable* is False
         """
+        self.runner.cancel()
         return True
@@ -22,7 +22,10 @@ from ...gui.qt.QtGui import (QWidget, QLabel, QVBoxLayout, QHBoxLayout, QPushBut
 from ...gui.qt.QtCore import SIGNAL, Signal,Qt
 from ...gui.qthelpers import OfSs, DataFrameViewWidget, MyComboBox
 from ...gui.utils.qthelpers import create_action
+from ...survey.lazy_table import LazyTable, get_survey_key
+from ...survey.result_store import ResultStore, compute_simulation
 from .. import OpenfiscaPluginWidget, PluginConfigPage
+from .worker import ComputationRunner, SURVEY_LOCK
 
 
 _ = get_translation('openfisca_qt')
@@ -77,8 +80,31 @@ class SurveyExplorerConfigPage(PluginConfigPage):
 #        reform_group.setLayout(layout)
 
 
+        store_group = QGroupBox(_("Result store"))
+        store_enable = self.create_checkbox(_("Store the results of the microsimulation"), 'store/enable')
+        store_dir = self.create_browsedir(_("Directory"), 'store/dir')
+        self.connect(store_enable, SIGNAL("toggled(bool)"), store_dir.setEnabled)
+        store_dir.setEnabled(self.get_option('store/enable'))
+        store_layout = QVBoxLayout()
+        store_layout.addWidget(store_enable)
+        store_layout.addWidget(store_dir)
+        store_group.setLayout(store_layout)
+
+        lazy_group = QGroupBox(_("Survey data loading"))
+        lazy_enable = self.create_checkbox(_("Read the variables of the survey on first use"), 'lazy/enable')
+        lazy_budget = self.create_spinbox(_("Memory budget of the variables"), _("MB"), 'lazy/budget',
+                                          min_ = 16, max_ = 16384, step = 16)
+        self.connect(lazy_enable, SIGNAL("toggled(bool)"), lazy_budget.setEnabled)
+        lazy_budget.setEnabled(self.get_option('lazy/enable'))
+        lazy_layout = QVBoxLayout()
+        lazy_layout.addWidget(lazy_enable)
+        lazy_layout.addWidget(lazy_budget)
+        lazy_group.setLayout(lazy_layout)
+
         vlayout = QVBoxLayout()
         vlayout.addWidget(survey_group)
+        vlayout.addWidget(lazy_group)
+        vlayout.addWidget(store_group)
 #        vlayout.addWidget(reform_group)
         vlayout.addStretch(1)
         self.setLayout(vlayout)
@@ -136,6 +162,13 @@ class SurveyExplorerWidget(OpenfiscaPluginWidget):
         self.view_data = None
         self.dataframes = {}
         self.vars = set()
+        # Survey table read on first access, until the simulation loads the whole survey
+        self.lazy_table = None
+        self.input_loaded = False
+        # Result store and key of the last computation, when the results are stored
+        self.stored_results = None
+        # The survey simulation is computed in a worker thread
+        self.runner = ComputationRunner(self, lock = SURVEY_LOCK)
 
         self.initialize()
         self.connect(self.add_btn, SIGNAL('clicked()'), self.add_var)
@@ -168,21 +201,33 @@ class SurveyExplorerWidget(OpenfiscaPluginWidget):
     def load_data(self):
         simulation = self.main.survey_simulation
         fname = self.get_option('data_file')
+        self.simulation = simulation
+        with SURVEY_LOCK:
+            self.input_loaded = False
+        if self.lazy_table is not None:
+            self.lazy_table.close()
+            self.lazy_table = None
 #         if path.isfile(fname):
 #             try:
         if True:
-                simulation.initialize_input_table()
-                simulation.input_table.load_data_from_survey(simulation.survey_filename,
-                                               num_table = 1,
-                                               subset=None,
-                                               print_missing=True)
-                year = simulation.input_table.survey_year
+                if self.get_option('lazy/enable'):
+                    # Only the ids are read, the simulation reads the whole survey when computed
+                    year = datetime.strptime(CONF.get('parameters', 'datesim'), "%Y-%m-%d").date().year
+                    key = get_survey_key(simulation.survey_filename, year)
+                    self.lazy_table = LazyTable(simulation.survey_filename, key,
+                                                budget = self.get_option('lazy/budget'))
+                    table = self.lazy_table
+                    year = key[-4:]
+                else:
+                    self.load_input_table()
+                    table = simulation.input_table.table
+                    year = simulation.input_table.survey_year
 
 
                 # Sets year in label
                 self.data_label.setText("Survey data from year " + str(year))
-                self.add_dataframe(simulation.input_table.table, name = "input")
-                self.set_dataframe(simulation.input_table.table, name = "input")
+                self.add_dataframe(table, name = "input")
+                self.set_dataframe(table, name = "input")
 
                 self.update_view(fill_default=True)
 #             except:
@@ -191,7 +236,42 @@ class SurveyExplorerWidget(OpenfiscaPluginWidget):
 
                 #raise Exception('Survey data loading failed')
 
-        self.simulation = simulation
+    def load_input_table(self):
+        '''
+        Loads the whole survey in the input table of survey_simulation
+
+        The survey lock is taken, since the GUI thread (calibration) and the worker thread
+        (computation) may both load the survey
+        '''
+        with SURVEY_LOCK:
+            if self.input_loaded:
+                return
+            simulation = self.simulation
+            simulation.initialize_input_table()
+            if self.lazy_table is not None:
+                # The survey file is also read by the lazy table in the GUI thread
+                with self.lazy_table.lock:
+                    simulation.input_table.load_data_from_survey(simulation.survey_filename, num_table = 1,
+                                                                 subset = None, print_missing = True)
+            else:
+                simulation.input_table.load_data_from_survey(simulation.survey_filename, num_table = 1,
+                                                             subset = None, print_missing = True)
+            self.input_loaded = True
+
+    def is_input_loaded(self):
+        '''
+        Returns True if the whole survey is in the input table of survey_simulation
+        '''
+        with SURVEY_LOCK:
+            return self.input_loaded
+
+    def get_stored_results(self):
+        '''
+        Returns the result store and the key of the results of the last computation, or None
+        when the results are not stored
+        '''
+        with SURVEY_LOCK:
+            return self.stored_results
 
     def update_btns(self):
         if (self.vars - self.selected_vars):
@@ -315,6 +395,9 @@ class SurveyExplorerWidget(OpenfiscaPluginWidget):
         """
         self.view.clear()
         self.data = None
+        if self.lazy_table is not None:
+            self.lazy_table.close()
+            self.lazy_table = None
         self.datatables_choices = []
         self.dataframes = {}
         self.update_btns()
@@ -324,14 +407,64 @@ class SurveyExplorerWidget(OpenfiscaPluginWidget):
         '''
         Compute survey_simulation
         '''
-        self.starting_long_process(_("Ongoing microsimulation ..."))
         P, P_default = self.main.parameters.getParam(), self.main.parameters.getParam(defaut = True)
-        self.simulation.set_param(P, P_default)
-        self.simulation.compute()
+        # The results of the other survey plugins are stale
+        for plugin in self.main.survey_plugins:
+            if plugin is not self and hasattr(plugin, 'runner'):
+                plugin.runner.cancel()
         self.action_compute.setEnabled(False)
-        self.ending_long_process(_("Microsimulation results are updated"))
+        self.runner.start(self.compute_simulation, self.simulation_computed, _("Ongoing microsimulation ..."),
+                          done_message = _("Microsimulation results are updated"),
+                          on_error = self.simulation_failed, args = (P, P_default))
+
+    def compute_simulation(self, P, P_default, progress = None):
+        '''
+        Computes survey_simulation with the given parameters (run in the worker thread)
+
+        The computation can be cancelled until the simulation itself is started
+        '''
+        def prepare():
+            if progress is not None:
+                progress(_("Loading survey data ..."))
+            self.load_input_table()
+            if progress is not None:
+                progress(_("Ongoing microsimulation ..."))
+
+        self.simulation.set_param(P, P_default)
+        with SURVEY_LOCK:
+            self.stored_results = None
+        if self.get_option('store/enable'):
+            store = ResultStore(self.get_option('store/dir'))
+            # Results of an identical computation are loaded from the store
+            loaded = compute_simulation(self.simulation, store, prepare = prepare)
+            with SURVEY_LOCK:
+                if loaded:
+                    self.input_loaded = True
+                self.stored_results = (store, store.get_key(self.simulation))
+        else:
+            prepare()
+            self.simulation.compute()
+
+    def simulation_computed(self, result):
+        '''
+        Refreshes the survey plugins once survey_simulation is computed (in the GUI thread)
+        '''
+        if self.lazy_table is not None:
+            # The whole survey is now in the input table of the simulation
+            input_table = self.simulation.input_table.table
+            if self.data is self.lazy_table:
+                self.data = input_table
+            self.dataframes["input"] = input_table
+            self.lazy_table.close()
+            self.lazy_table = None
         self.main.refresh_survey_plugins()
 
+    def simulation_failed(self, exception):
+        '''
+        Enables a new computation after a failed one
+        '''
+        self.action_compute.setEnabled(True)
+
     def set_reform(self, reform):
         """
         Set reform mode
@@ -446,6 +579,7 @@ class SurveyExplorerWidget(OpenfiscaPluginWidget):
         Return True or False whether the plugin may be closed immediately or not
         Note: returned value is ignored if *cancelable* is False
         """
+        self.runner.cancel()
         return True
 
 
@@ -0,0 +1,181 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+import threading
+import traceback
+
+from ...gui.qt.QtCore import QObject, QThread, Signal
+
+
+# The survey plugins share the survey simulation: their computations are run one at a time, and
+# the GUI thread takes the lock too whenever it modifies the survey (loading it, publishing
+# weights). It is reentrant so that a computation may load the survey itself
+SURVEY_LOCK = threading.RLock()
+
+
+class Cancelled(Exception):
+    """
+    Raised in a worker thread when its computation was superseded by a new one
+    """
+    pass
+
+
+class ComputationThread(QThread):
+    """
+    Runs a computation in a worker thread
+
+    The computation is called with a progress keyword argument: a function taking a message
+    that reports the progress in the status bar and raises Cancelled when the computation
+    is stale. The result (or the error) is emitted with the id of the run.
+    """
+    computed = Signal(int, object)
+    failed = Signal(int, object)
+    progressed = Signal(int, object)
+
+    def __init__(self, run_id, function, args = (), kwargs = None, lock = None):
+        QThread.__init__(self)
+        self.run_id = run_id
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs or {}
+        self.lock = lock
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+    def report(self, message):
+        """
+        Reports the progress of the computation (raises Cancelled when the run is stale)
+        """
+        if self.cancelled:
+            raise Cancelled()
+        self.progressed.emit(self.run_id, message)
+
+    def run(self):
+        if self.lock is not None:
+            self.lock.acquire()
+        try:
+            if self.cancelled:
+                return
+            result = self.function(*self.args, progress = self.report, **self.kwargs)
+            if not self.cancelled:
+                self.computed.emit(self.run_id, result)
+        except Cancelled:
+            pass
+        except Exception, e:
+            self.failed.emit(self.run_id, (e, traceback.format_exc()))
+        finally:
+            if self.lock is not None:
+                self.lock.release()
+
+
+class ComputationRunner(QObject):
+    """
+    Runs the computations of a plugin in a worker thread, one at a time
+
+    Starting a computation cancels the running one: its result is dropped and it stops at its
+    next progress report. The new computation starts as soon as the previous thread is done,
+    so the results are always delivered, in the GUI thread, for the last parameters.
+    """
+    def __init__(self, plugin, lock = None):
+        QObject.__init__(self)
+        self.plugin = plugin
+        self.lock = lock
+        self.run_id = 0
+        self.worker = None
+        self.pending = None
+        self.callbacks = None
+
+    def is_running(self):
+        return self.worker is not None
+
+    def start(self, function, on_result, message, done_message = "", on_error = None, args = (), kwargs = None):
+        """
+        Starts a computation in a worker thread
+
+        Parameters
+        ----------
+        function : callable
+                   computation, called with args, kwargs and a progress keyword argument
+        on_result : callable
+                    called in the GUI thread with the result of the computation
+        message : str
+                  status bar message while computing
+        done_message : str, default ""
+                       status bar message when the result is delivered
+        on_error : callable, default None
+                   called in the GUI thread with the exception when the computation failed
+        """
+        self.cancel()
+        self.run_id += 1
+        self.pending = (self.run_id, function, args, kwargs, (on_result, on_error, done_message))
+        self.plugin.show_message(message)
+        if self.worker is None:
+            self.start_pending()
+
+    def cancel(self):
+        """
+        Cancels the running and the pending computations
+        """
+        self.pending = None
+        if self.worker is not None:
+            self.worker.cancel()
+
+    def start_pending(self):
+        run_id, function, args, kwargs, self.callbacks = self.pending
+        self.pending = None
+        thread = ComputationThread(run_id, function, args, kwargs, lock = self.lock)
+        thread.computed.connect(self.computed)
+        thread.failed.connect(self.failed)
+        thread.progressed.connect(self.progressed)
+        thread.finished.connect(self.worker_finished)
+        self.worker = thread
+        thread.start()
+
+    def worker_finished(self):
+        self.worker = None
+        if self.pending is not None:
+            self.start_pending()
+
+    def computed(self, run_id, result):
+        if run_id != self.run_id:
+            return
+        on_result, on_error, done_message = self.callbacks
+        on_result(result)
+        self.plugin.show_message(done_message, timeout = 2000)
+
+    def failed(self, run_id, error):
+        if run_id != self.run_id:
+            return
+        exception, trace = error
+        self.plugin.main.debug_print(trace)
+        on_result, on_error, done_message = self.callbacks
+        self.plugin.show_message(unicode(exception), timeout = 5000)
+        if on_error is not None:
+            on_error(exception)
+
+    def progressed(self, run_id, message):
+        if run_id == self.run_id:
+            self.plugin.show_message(message)
@@ -8,11 +8,12 @@
 
 # Script to compute the aggregates for all the referenced years
 
-from openfisca_core.simulations import SurveySimulation
-from openfisca_qt.plugins.survey.aggregates import Aggregates
-from openfisca_qt.plugins.survey.inequality import Inequality
-from pandas import ExcelWriter, ExcelFile
+import argparse
 import os
+
+from openfisca_qt.survey.aggregates import DEFAULT_VARLIST
+from openfisca_qt.survey.aggregates_batch import compute_all, TASKS
+from pandas import ExcelWriter, ExcelFile
 from openfisca_france.data.sources.config import destination_dir
 
 
@@ -30,37 +31,25 @@ def get_loyer_inflator(year):
 #    print irl
     return float(irl.values/irl_2006.values)
 
-def build_aggregates():
-
-    writer = None
-    years = range(2006,2010)
-    for year in years:
-        yr = str(year)
-#        fname = "Agg_%s.%s" %(str(yr), "xls")
-        simu = SurveySimulation()
-        simu.set_config(year = yr)
-        simu.set_param()
-        simu.set_survey()
-        inflator = get_loyer_inflator(year)
-        simu.inflate_survey({'loyer' : inflator})
-        simu.compute()
-
-        agg = Aggregates()
-        agg.set_simulation(simu)
-        agg.compute()
-
-        if writer is None:
-            writer = ExcelWriter(str(fname_all))
-        agg.aggr_frame.to_excel(writer, yr, index= False, header= True, float_format="%.2f")
-        print agg.aggr_frame.to_string()
-        del simu
-        del agg
-        import gc
-        gc.collect()
+def get_inflators(years):
+    return dict((year, {'loyer' : get_loyer_inflator(year)}) for year in years)
 
+def print_frames(year, frames):
+    for name, frame in sorted(frames.iteritems()):
+        print year, name
+        print frame.to_string()
 
-    writer.save()
-
+def build_aggregates(years = range(2006, 2010), varlist = None, processes = None, memory_limit = None,
+                     filename = fname_all, store_dir = None):
+    """
+    Compute the aggregates of the years in a process pool and save them in a single file
+    """
+    frames_by_year, errors = compute_all(years, filename, task = 'aggregates', varlist = varlist,
+                                         inflators = get_inflators(years), processes = processes,
+                                         memory_limit = memory_limit, store_dir = store_dir,
+                                         callback = print_frames)
+    for year, error in sorted(errors.iteritems()):
+        print "Aggregates of %s failed: %s" % (year, error)
 
 
 def diag_aggregates():
@@ -97,30 +86,40 @@ def diag_aggregates():
     df_final.to_excel(writer, sheet_name="diagnostics", float_format="%.2f")
     writer.save()
 
-def test_gini():
+def test_gini(years = range(2006, 2010), processes = None, memory_limit = None, filename = None, store_dir = None):
     """
     Compute Gini coefficients
     """
-    years = range(2006, 2010)
-    for year in years:
-        yr = str(year)
-#        fname = "Agg_%s.%s" %(str(yr), "xls")
-        simu = SurveySimulation()
-        simu.set_config(year = yr)
-        simu.set_param()
-        inflator = get_loyer_inflator(year)
-        simu.inflate_survey({'loyer' : inflator})
-        simu.compute()
-
-        inequality = Inequality()
-        inequality.set_simulation(simu)
-        inequality.compute()
-        print inequality.inequality_dataframe
-        print inequality.poverty
-        del simu
+    frames_by_year, errors = compute_all(years, filename, task = 'inequality',
+                                         inflators = get_inflators(years), processes = processes,
+                                         memory_limit = memory_limit, store_dir = store_dir,
+                                         callback = print_frames)
+    for year, error in sorted(errors.iteritems()):
+        print "Inequality of %s failed: %s" % (year, error)
+
+def get_parser():
+    parser = argparse.ArgumentParser(description = "Compute the aggregates or the inequality indicators of several years")
+    parser.add_argument('task', nargs = '?', default = 'aggregates', choices = TASKS + ['diag'])
+    parser.add_argument('-y', '--years', type = int, nargs = '+', default = range(2006, 2010),
+                        help = "years to compute")
+    parser.add_argument('-v', '--variables', nargs = '+', default = None,
+                        help = "variables of the aggregates (default: %s)" % ' '.join(DEFAULT_VARLIST))
+    parser.add_argument('-p', '--processes', type = int, default = None,
+                        help = "number of worker processes (default: number of cpus)")
+    parser.add_argument('-m', '--memory', type = float, default = None,
+                        help = "memory limit of each worker in megabytes")
+    parser.add_argument('-o', '--output', default = None,
+                        help = "Excel (.xlsx) or HDF5 (.h5) output file (default: %s)" % fname_all)
+    parser.add_argument('-s', '--store', default = None,
+                        help = "directory of the result store, where the simulations are loaded from when already computed")
+    return parser
 
 if __name__ == '__main__':
 
-#    build_aggregates()
-#    diag_aggregates()
-    test_gini()
+    args = get_parser().parse_args()
+    if args.task == 'aggregates':
+        build_aggregates(args.years, args.variables, args.processes, args.memory, args.output or fname_all, args.store)
+    elif args.task == 'inequality':
+        test_gini(args.years, args.processes, args.memory, args.output, args.store)
+    else:
+        diag_aggregates()
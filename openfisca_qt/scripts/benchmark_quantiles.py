@@ -0,0 +1,107 @@
+# -*- coding:utf-8 -*-
+# This file is part of OpenFisca.
+# OpenFisca is a socio-fiscal microsimulation software
+# Copyright © 2013 Clément Schaff, Mahdi Ben Jelloul
+# Licensed under the terms of the GVPLv3 or later license
+# (see openfisca/__init__.py for details)
+
+# Benchmark of the weighted quantiles against mark_weighted_percentiles: accuracy and speed
+# of the exact engine (WeightedQuantiles) and of the merged quantile sketches
+
+
+from __future__ import division
+
+import time
+
+import numpy as np
+from openfisca_core.statshelpers import mark_weighted_percentiles
+from pandas import DataFrame
+
+from openfisca_qt.survey.quantiles import WeightedQuantiles, WeightedQuantileSketch
+
+
+def get_sample(size, seed = 0):
+    '''
+    Returns log-normal incomes with a mass of zeros and survey-like weights
+    '''
+    random_state = np.random.RandomState(seed)
+    values = random_state.lognormal(10, .8, size)
+    values[random_state.rand(size) < .05] = 0
+    weights = random_state.uniform(200, 3000, size)
+    return values, weights
+
+
+def get_rank_errors(values, weights, thresholds, reference):
+    '''
+    Returns the errors of the thresholds in cumulated weight share, relative to the reference
+    '''
+    order = np.argsort(values, kind = 'mergesort')
+    cumulated = np.concatenate(([0], np.cumsum(weights[order])))/weights.sum()
+    sorted_values = values[order]
+    ranks = cumulated[np.searchsorted(sorted_values, thresholds, side = 'right')]
+    reference_ranks = cumulated[np.searchsorted(sorted_values, reference, side = 'right')]
+    return np.abs(ranks - reference_ranks)[1:-1]
+
+
+def benchmark(size = 500000, quantiles = 10, chunks_count = 20, accuracy = .001, method = 2):
+    '''
+    Compares the thresholds of the quantiles with the ones of mark_weighted_percentiles
+
+    Parameters
+    ----------
+    size : int, default 500000
+           number of observations
+    quantiles : int, default 10
+                number of quantiles
+    chunks_count : int, default 20
+                   number of chunks of the sketches
+    accuracy : float, default .001
+               accuracy of the sketches
+    method : int, default 2
+             method of mark_weighted_percentiles
+    '''
+    values, weights = get_sample(size)
+    labels = np.arange(1, quantiles + 1)
+    results = []
+
+    start = time.time()
+    reference_labels, reference = mark_weighted_percentiles(values, labels, weights, method, return_quantiles = True)
+    reference = np.asarray(reference)
+    results.append(('mark_weighted_percentiles', time.time() - start, 0, 0))
+
+    start = time.time()
+    engine = WeightedQuantiles(weights, method)
+    engine.set_values('values', values)
+    thresholds = engine.get_quantiles('values', quantiles)
+    elapsed = time.time() - start
+    results.append(('WeightedQuantiles', elapsed, np.abs(thresholds - reference).max(),
+                    get_rank_errors(values, weights, thresholds, reference).max()))
+
+    # One sketch per chunk (or per worker), merged afterwards
+    start = time.time()
+    sketch = WeightedQuantileSketch(accuracy)
+    for chunk in np.array_split(np.arange(size), chunks_count):
+        sketch.merge(WeightedQuantileSketch(accuracy).update(values[chunk], weights[chunk]))
+    thresholds = sketch.get_quantiles(quantiles, method)
+    elapsed = time.time() - start
+    results.append(('WeightedQuantileSketch (%s chunks, %s points)' % (chunks_count, len(sketch)), elapsed,
+                    np.abs(thresholds - reference).max(),
+                    get_rank_errors(values, weights, thresholds, reference).max()))
+
+    # Small groups are exact
+    start = time.time()
+    small = WeightedQuantileSketch(accuracy).update(values[:1000], weights[:1000])
+    thresholds = small.get_quantiles(quantiles, method)
+    elapsed = time.time() - start
+    small_reference = np.asarray(mark_weighted_percentiles(values[:1000], labels, weights[:1000], method,
+                                                           return_quantiles = True)[1])
+    results.append(('WeightedQuantileSketch (1000 observations)', elapsed,
+                    np.abs(thresholds - small_reference).max(),
+                    get_rank_errors(values[:1000], weights[:1000], thresholds, small_reference).max()))
+
+    return DataFrame.from_records(results, columns = ['engine', 'seconds', 'max absolute error', 'max rank error'])
+
+
+if __name__ == '__main__':
+    for quantiles in [10, 100]:
+        print benchmark(quantiles = quantiles).to_string()
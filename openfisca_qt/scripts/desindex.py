@@ -8,11 +8,12 @@
 
 
 from numpy import arange
-from openfisca_core.statshelpers import mark_weighted_percentiles
 from openfisca_france.data.erf.datatable import ErfsDataTable
 from openfisca_france.data.sources.config import destination_dir
 from pandas import DataFrame, ExcelWriter
 
+from openfisca_qt.survey.quantiles import WeightedQuantiles, WeightedQuantileSketch
+
 
 year = 2009
 erf = ErfsDataTable(year=year)
@@ -23,11 +24,22 @@ df = erf.get_values(variables=vars, table="erf_menage" )
 
 labels = arange(1,11)
 method = 2
+# Number of rows of the chunks used to build the deciles with a quantile sketch (None for exact deciles)
+chunk_size = None
 
 nivvie = df["nivviem"].astype("float64").values
 
 wprm = df["wprm"].astype("float64").values
-decil, values = mark_weighted_percentiles(nivvie, labels, wprm, method, return_quantiles = True)
+if chunk_size is None:
+    quantiles = WeightedQuantiles(wprm, method)
+    quantiles.set_values("nivvie", nivvie)
+    decil = quantiles.get_labels("nivvie", 10, labels)
+else:
+    sketch = WeightedQuantileSketch(accuracy = .001)
+    for start in range(0, len(nivvie), chunk_size):
+        sketch.merge(WeightedQuantileSketch(accuracy = .001).update(nivvie[start:start + chunk_size],
+                                                                    wprm[start:start + chunk_size]))
+    decil = sketch.get_labels(nivvie, 10, labels, method)
 
 
 df2 = DataFrame({"decile" : decil})
@@ -9,7 +9,7 @@ Created on 20 févr. 2013
 import os
 
 from openfisca_core.simulations import SurveySimulation
-from openfisca_qt.plugins.survey.aggregates import Aggregates
+from openfisca_qt.survey.aggregates import Aggregates
 #from pandas import ExcelWriter, ExcelFile
 
 
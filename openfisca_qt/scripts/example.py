@@ -14,7 +14,7 @@ from datetime import datetime
 
 from openfisca_core.simulations import ScenarioSimulation
 from openfisca_core.simulations import SurveySimulation
-from openfisca_qt.plugins.survey.aggregates import Aggregates
+from openfisca_qt.survey.aggregates import Aggregates
 
 # destination_dir = "c:/users/utilisateur/documents/"
 # fname_all = "aggregates_inflated_loyers.xlsx"
@@ -67,7 +67,7 @@ def survey_case(year):
 
 
 # Displaying a pivot table
-    from openfisca_qt.plugins.survey.distribution import OpenfiscaPivotTable
+    from openfisca_qt.survey.pivot_table import OpenfiscaPivotTable
     pivot_table = OpenfiscaPivotTable()
     pivot_table.set_simulation(simulation)
     df2 = pivot_table.get_table(by = 'so', vars = ['nivvie'])
@@ -18,7 +18,7 @@ import random
 import numpy as np
 from openfisca_core.simulations import ScenarioSimulation, SurveySimulation, Simulation
 from openfisca_france.data.erf.aggregates import build_erf_aggregates
-from openfisca_qt.plugins.survey.aggregates import Aggregates
+from openfisca_qt.survey.aggregates import Aggregates
 # from openfisca_qt.scripts.validation.check_consistency_tests import (check_inputs_enumcols, check_entities,
 #    check_weights)
 from pandas import ExcelWriter, HDFStore
@@ -81,7 +81,7 @@ def survey_case(year = 2006):
 
 
 # Displaying a pivot table
-    from openfisca_qt.plugins.survey.distribution import OpenfiscaPivotTable
+    from openfisca_qt.survey.pivot_table import OpenfiscaPivotTable
     pivot_table = OpenfiscaPivotTable()
     pivot_table.set_simulation(simulation)
     df2 = pivot_table.get_table(by ='so', vars=['nivvie'])
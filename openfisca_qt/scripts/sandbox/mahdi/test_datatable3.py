@@ -11,7 +11,7 @@ import os
 
 from openfisca_core.simulations import SurveySimulation
 from openfisca_france.data.sources.config import destination_dir
-from openfisca_qt.plugins.survey.aggregates import Aggregates
+from openfisca_qt.survey.aggregates import Aggregates
 from openfisca_qt.plugins.survey.aggregates3 import Aggregates3
 from pandas import ExcelWriter, ExcelFile
 
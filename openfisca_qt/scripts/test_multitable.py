@@ -21,7 +21,7 @@ from openfisca_core.simulations import ScenarioSimulation
 from openfisca_core.simulations import SurveySimulation
 from openfisca_france.data.erf.build_survey.utilitaries import check_structure, control
 from openfisca_france.data.erf.datatable import DataCollection
-from openfisca_qt.plugins.survey.aggregates import Aggregates
+from openfisca_qt.survey.aggregates import Aggregates
 from openfisca_qt.scripts.data_management.separate_tables_generator import convert_to_3_tables
 import pandas as pd
 from pandas import HDFStore
@@ -156,7 +156,7 @@ def survey_case_3_tables():
 
 
 # Displaying a pivot table
-    from openfisca_qt.plugins.survey.distribution import OpenfiscaPivotTable
+    from openfisca_qt.survey.pivot_table import OpenfiscaPivotTable
     pivot_table = OpenfiscaPivotTable()
     pivot_table.set_simulation(simulation)
     df2 = pivot_table.get_table(by ='so', vars=['nivvie'])
@@ -22,7 +22,7 @@ import os
 
 from openfisca_core.simulations import SurveySimulation
 from openfisca_core import model
-from openfisca_qt.plugins.survey.distribution import OpenfiscaPivotTable
+from openfisca_qt.survey.pivot_table import OpenfiscaPivotTable
 
 
 def get_age_structure(simulation):
@@ -14,8 +14,8 @@ import os
 
 from openfisca_core.simulations import SurveySimulation
 from openfisca_france.data.sources.config import destination_dir
-from openfisca_qt.plugins.survey.aggregates import Aggregates
-from openfisca_qt.plugins.survey.inequality import Inequality
+from openfisca_qt.survey.aggregates import Aggregates
+from openfisca_qt.survey.inequality import Inequality
 from pandas import ExcelWriter, ExcelFile, HDFStore
 import pandas.rpy.common as com
 
@@ -10,6 +10,7 @@ from __future__ import division
 
 from openfisca_core.simulations import SurveySimulation
 from openfisca_france.data.erf.datatable import ErfsDataTable
+from openfisca_qt.survey.result_store import ResultStore, compute_simulation
 
 
     #def test_demography():
@@ -58,15 +59,17 @@ from openfisca_france.data.erf.datatable import ErfsDataTable
     #    #  Decompose impot sur le revenu to check intermediate aggregates vs fiscal data and erf
     #    #  Check downward prestation one by one
 
-def get_common_dataframe(variables, year = 2006):
+def get_common_dataframe(variables, year = 2006, store_dir = None):
     """
     Compare variables in erf an openfisca
+
+    The simulation is loaded from the result store of store_dir (the default store when None)
+    when it was already computed.
     """
     simulation = SurveySimulation()
     simulation.set_config(year = year)
     simulation.set_param()
-    simulation.set_survey()
-    simulation.compute()
+    compute_simulation(simulation, ResultStore(store_dir), prepare = simulation.set_survey)
 
     erf = ErfsDataTable(year=2006)
     if "ident" not in variables:
@@ -21,7 +21,8 @@ from openfisca_core.columns import Prestation
 from openfisca_core.simulations import SurveySimulation
 from openfisca_core.statshelpers import mark_weighted_percentiles as mwp
 from openfisca_france.data.erf.datatable import DataCollection
-from openfisca_qt.plugins.survey.aggregates import Aggregates
+from openfisca_qt.survey.aggregates import Aggregates
+from openfisca_qt.survey.result_store import ResultStore, compute_simulation
 import pandas as pd
 from pandas import merge
 
@@ -459,12 +460,12 @@ class Debugger(object):
                 gc.collect()
 
 
-def test(year=2006, variables = ['af']):
+def test(year=2006, variables = ['af'], store_dir = None):
     simulation = SurveySimulation()
     survey_filename = os.path.join(model.DATA_DIR, 'sources', 'test.h5')
     simulation.set_config(year=year, survey_filename=survey_filename)
     simulation.set_param()
-    simulation.compute()
+    compute_simulation(simulation, ResultStore(store_dir))
 
 #     of_aggregates = Aggregates()
 #     of_aggregates.set_simulation(simulation)
@@ -827,26 +828,23 @@ def test(year=2006, variables = ['af']):
 
 if __name__ == '__main__':
 
-    restart = True
     survey = 'survey.h5'
-    save_path = os.path.join(model.DATA_DIR, 'erf')
-    saved_simulation_filename = os.path.join(save_path, 'debugger_' + survey[:-3])
-
-    if restart:
-        year = 2006
-        simulation = SurveySimulation()
-        if survey == 'survey.h5':
-            survey_filename = os.path.join(model.DATA_DIR, survey)
-        else:
-            survey_filename = os.path.join(model.DATA_DIR, 'sources', survey)
+    store_dir = os.path.join(model.DATA_DIR, 'erf', 'results')
+
+    # The simulation is only computed when it is not in the result store
+    year = 2006
+    simulation = SurveySimulation()
+    if survey == 'survey.h5':
+        survey_filename = os.path.join(model.DATA_DIR, survey)
+    else:
+        survey_filename = os.path.join(model.DATA_DIR, 'sources', survey)
 
-        simulation.set_config(year=year, survey_filename=survey_filename)
-        simulation.set_param()
-        simulation.compute()
-        simulation.save_content('debug', saved_simulation_filename)
+    simulation.set_config(year=year, survey_filename=survey_filename)
+    simulation.set_param()
+    compute_simulation(simulation, ResultStore(store_dir))
 
     deb = Debugger()
-    deb.set_simulation(name = 'debug', filename = saved_simulation_filename)
+    deb.set_simulation(simulation)
     deb.set_variable('af')
     deb.show_aggregates()
     deb.preproc()
@@ -10,17 +10,15 @@
 """Example of a simple simulation"""
 
 
-import gc
 import os
-import random
+from multiprocessing import Pool, cpu_count
 
-from openfisca_core import model
-from openfisca_core.simulations import SurveySimulation
-from openfisca_qt.plugins.survey.aggregates import Aggregates
+from openfisca_qt.survey import model
+from openfisca_qt.survey.aggregates import Aggregates, DEFAULT_VARLIST
+from openfisca_qt.survey.aggregates_batch import iter_years
 # from openfisca_qt.scripts.validation.check_consistency_tests import (check_inputs_enumcols, check_entities,
 #    check_weights)
-from pandas import ExcelWriter
-from openfisca_france.data.erf.aggregates import build_erf_aggregates
+from pandas import ExcelWriter, HDFStore, MultiIndex, Series
 import pandas as pd
 try:
     import xlwt
@@ -29,13 +27,79 @@ except:
     pass
 
 
+def get_erf_aggregates(year, variables):
+    """
+    Returns the ERFS aggregates of variables as a Series indexed by variable
+
+    The ERFS data package is only needed for the aggregates missing from the cache (see
+    ErfAggregatesCache): it is imported on first use.
+    """
+    from openfisca_france.data.erf.aggregates import build_erf_aggregates
+    frame = build_erf_aggregates(variables = variables, year = year)
+    return frame.T.iloc[:, 0]
+
+
+def _get_erf_aggregates(args):
+    year, variables = args
+    try:
+        return year, get_erf_aggregates(year, variables), None
+    except Exception, e:
+        return year, None, "%s" % e
+
+
+class ErfAggregatesCache(object):
+    """
+    ERFS aggregates stored in a HDF5 file, by year and variable
+
+    The ERFS data never change, so that the aggregates are only computed for the variables
+    which are not yet in the file.
+    """
+    def __init__(self, filename = None):
+        super(ErfAggregatesCache, self).__init__()
+        if filename is None:
+            filename = os.path.join(model.DATA_DIR, 'erf', 'erf_aggregates.h5')
+        self.filename = filename
+
+    def get(self, year, variables):
+        """
+        Returns the cached aggregates of the variables and the variables missing from the cache
+        """
+        if not os.path.isfile(self.filename):
+            return Series(), list(variables)
+        store = HDFStore(self.filename, 'r')
+        try:
+            key = 'y%s' % year
+            cached = store[key] if key in store else Series()
+        finally:
+            store.close()
+        cached = cached.reindex([variable for variable in variables if variable in cached.index])
+        return cached, [variable for variable in variables if variable not in cached.index]
+
+    def put(self, year, aggregates):
+        """
+        Adds aggregates (Series indexed by variable) to the cache
+        """
+        store = HDFStore(self.filename)
+        try:
+            key = 'y%s' % year
+            if key in store:
+                cached = store[key]
+                aggregates = pd.concat([cached[~cached.index.isin(aggregates.index)], aggregates])
+            store[key] = aggregates.astype(float)
+        finally:
+            store.close()
+
+
 class Recap(object):
     def __init__(self):
         super(Recap, self).__init__()
         self.years = None
-        self.aggregates_variables = None
-        self.sources = None
+        self.aggregates_variables = list(DEFAULT_VARLIST)
+        self.sources = ['of', 'erfs', 'reel']
         self.survey_filename = None
+        self.processes = None
+        self.store_dir = None
+        self.erf_cache = ErfAggregatesCache()
 
     def set_years(self, years):
         self.years= years
@@ -50,188 +114,97 @@ class Recap(object):
         self.survey_filename = survey_filename
 
     def _build_multiindex(self):
-        variables = self.aggregates_variables
-        sources = self.sources
-        years = self.years
-        print variables
-        print sources
-        print years
-#        print [zip(variable, source, year) for variable in variables, source in sources, year in years]
-        index = list()
-        for variable in variables:
-            for source in sources:
-                for year in years:
-                    index.append((variable, source, year))
-
-        from pandas.core.index import MultiIndex
-        self.index = MultiIndex.from_tuples(index, names = ['measure', 'source', 'year'])
+        self.index = MultiIndex.from_product([self.aggregates_variables, self.sources, self.years],
+                                             names = ['measure', 'source', 'year'])
 
     def _generate_aggregates(self):
-        dfs = list()
-        dfs_erf = list()
+        """
+        Computes the OpenFisca aggregates (one simulation per year in a process pool) while the
+        ERFS aggregates which are not cached are computed in another process pool
+
+        The two pools share the processes (the number of cpus by default).
+        """
         years = self.years
-        for year in years:
-            # Running a standard SurveySimulation to get OF aggregates
-            simulation = SurveySimulation()
-            survey_filename = self.survey_filename
-            simulation.set_config(year=year, survey_filename=survey_filename)
-            simulation.set_param()
-            simulation.compute()
-            agg = Aggregates()
-            agg.set_simulation(simulation)
-            agg.compute()
-            df = agg.aggr_frame
-            df['year'] = year
-            label_by_name = dict(
-                (name, column.label)
-                for name, column in simulation.output_table.column_by_name.iteritems()
-                )
-            #colonnes = simulation.output_table.table.columns
-            dfs.append(df)
-            variables = agg.varlist
-            labels_variables = [
-                label_by_name[variable]
-                for variable in variables
-                ]
-            del simulation, agg, df
-            # simulation.save_content(name, filename)
-
-            gc.collect()
+        variables = self.aggregates_variables
+
+        erf_aggregates = dict((year, Series()) for year in years)
+        erf_jobs = []
+        for year in (years if 'erfs' in self.sources else []):
+            cached, missing = self.erf_cache.get(year, variables)
+            erf_aggregates[year] = cached
+            if missing:
+                erf_jobs.append((year, missing))
+
+        processes = self.processes or cpu_count()
+        erf_processes = min(len(erf_jobs), max(processes//2, 1))
+        erf_pool = None
+        erf_results = []
+        if erf_jobs:
+            erf_pool = Pool(processes = erf_processes)
+        try:
+            if erf_pool is not None:
+                erf_results = erf_pool.map_async(_get_erf_aggregates, erf_jobs)
+
+            # OpenFisca
+            self.aggregates_of_dataframe = {}
+            for year, frames, error in iter_years(years, varlist = variables,
+                                                  processes = max(processes - erf_processes, 1),
+                                                  survey_filename = self.survey_filename,
+                                                  store_dir = self.store_dir):
+                if frames is None:
+                    raise Exception("Recap: the OpenFisca aggregates of %s failed: %s" % (year, error))
+                print "OpenFisca aggregates of %s computed" % year
+                self.aggregates_of_dataframe[year] = frames['aggregates']
 
             # ERFS
-            temp = (build_erf_aggregates(variables=variables, year= year))
-            temp.rename(columns = label_by_name, inplace = True)
-            temp = temp.T
-            temp.reset_index(inplace = True)
-            temp['year'] = year
-            dfs_erf.append(temp)
-            del temp
-            gc.collect()
-
-        self.labels_variables = labels_variables
-        self.aggregates_of_dataframe = dfs
-        self.aggregates_erfs_dataframe = dfs_erf
+            if erf_pool is not None:
+                erf_results = erf_results.get()
+            for year, aggregates, error in erf_results:
+                if aggregates is None:
+                    raise Exception("Recap: the ERFS aggregates of %s failed: %s" % (year, error))
+                self.erf_cache.put(year, aggregates)
+                erf_aggregates[year] = pd.concat([erf_aggregates[year], aggregates])
+        finally:
+            if erf_pool is not None:
+                erf_pool.close()
+                erf_pool.join()
+        self.aggregates_erfs_dataframe = erf_aggregates
 
     def _reshape_tables(self):
         """
-        TODO _reshape_tables should be cleaned !!!
+        Builds the (measure, source, year) table of the expenditures and beneficiaries, with the
+        years in columns (NaN when a source has no value)
         """
-        dfs = self.aggregates_of_dataframe
-        dfs_erf = self.aggregates_erfs_dataframe
-        labels_variables = self.labels_variables
-
         agg = Aggregates()
-
-        # We need this for the columns labels to work
-
-        print 'Resetting index to avoid later trouble on manipulation'
-        for d in dfs:
-            d.reset_index(inplace = True)
-            d.set_index('Mesure', inplace = True, drop = False)
-            d.reindex_axis(labels_variables, axis = 0)
-            d.reset_index(inplace = True, drop = True)
-#             print d.to_string()
-        for d in dfs_erf:
-            d.reset_index(inplace = True)
-            d['Mesure'] = agg.labels['dep']
-            d.set_index('index', inplace = True, drop = False)
-            d.reindex_axis(agg.labels.values(), axis = 0)
-            d.reset_index(inplace = True, drop = True)
-#             print d.to_string()
-
-        # Concatening the openfisca tables for =/= years
-
-        temp = dfs[0]
-        if len(dfs) != 1:
-            for d in dfs[1:]:
-                temp = pd.concat([temp,d], ignore_index = True)
-
-
-        del temp[agg.labels['entity']], temp['index']
-        gc.collect()
-
-        print 'We split the real aggregates from the of table'
-        temp2 = temp[[agg.labels['var'], agg.labels['benef_real'], agg.labels['dep_real'], 'year']]
-        del temp[agg.labels['benef_real']], temp[agg.labels['dep_real']]
-        sauvegarde = temp.columns.get_level_values(0).unique()
-        temp['source'] = 'of'
-        temp2['source'] = 'reel'
-        temp2.rename(columns = {agg.labels['benef_real'] : agg.labels['benef'],
-                                agg.labels['dep_real'] : agg.labels['dep']},
-                     inplace = True)
-        temp = pd.concat([temp,temp2], ignore_index = True)
-
-        print 'We add the erf data to the table'
-        for df in dfs_erf:
-            del df['level_0'], df['Mesure']
-            df.rename(columns = {'index' : agg.labels['var'], 1 : agg.labels['dep']}, inplace = True)
-
-
-        temp3 = dfs_erf[0]
-        if len(dfs) != 1:
-            for d3 in dfs_erf[1:]:
-                temp3 = pd.concat([temp3, d3], ignore_index = True)
-
-        temp3['source'] = 'erfs'
-        gc.collect()
-        temp = pd.concat([temp, temp3], ignore_index = True)
-#         print temp.to_string()
-
-        print 'Index manipulation to reshape the output'
-        temp.reset_index(drop = True, inplace = True)
-        # We set the new index
-#         temp.set_index('Mesure', drop = True, inplace = True)
-#         temp.set_index('source', drop = True, append = True, inplace = True)
-#         temp.set_index('year', drop = False, append = True, inplace = True)
-        temp = temp.groupby(by=["Mesure", "source", "year"], sort = False).sum()
-        # Tricky, the [mesure, source, year] index is unique so sum() will return the only value
-        # Groupby automatically deleted the source, mesure... columns and added them to index
-        assert(isinstance(temp, pd.DataFrame))
-#         print temp.to_string()
-
-        # We want the years to be in columns, so we use unstack
-        temp_unstacked = temp.unstack()
-        # Unfortunately, unstack automatically sorts rows and columns, we have to reindex the table :
-
-        ## Reindexing rows
-        from pandas.core.index import MultiIndex
-        indtemp1 = temp.index.get_level_values(0)
-        indtemp2 = temp.index.get_level_values(1)
-        indexi = zip(*[indtemp1, indtemp2])
-        indexi_bis = []
-        for i in xrange(0,len(indexi)):
-            if indexi[i] not in indexi_bis:
-                indexi_bis.append(indexi[i])
-        indexi = indexi_bis
-        del indexi_bis
-        indexi = MultiIndex.from_tuples(indexi, names = ['Mesure', 'source'])
-#         import pdb
-#         pdb.set_trace()
-        temp_unstacked = temp_unstacked.reindex_axis(indexi, axis = 0) # axis = 0 for rows, 1 for columns
-
-        ## Reindexing columns
-        # TODO : still not working
-        col_indexi = []
-        print temp.columns
-        for i in xrange(len(sauvegarde)):
-#         for col in temp.columns.get_level_values(0).unique():
-            col = sauvegarde[i]
-            for yr in self.years:
-                col_indexi.append((col, yr))
-        col_indexi = MultiIndex.from_tuples(col_indexi)
-#         print col_indexi
-#         print temp_unstacked.columns
-        print col_indexi
-        print temp_unstacked.columns
-        temp_unstacked = temp_unstacked.reindex_axis(col_indexi, axis = 1)
-
-        # Our table is ready to be turned to Excel worksheet !
-#         print temp_unstacked.to_string()
-        del temp_unstacked['Mesure'], temp_unstacked['year']
-        temp_unstacked.fillna(0, inplace = True)
-        return temp_unstacked
+        dep, benef = agg.labels['dep'], agg.labels['benef']
+
+        frames = []
+        keys = []
+        labels = {}
+        for year in self.years:
+            frame = self.aggregates_of_dataframe[year]
+            labels.update(frame[agg.labels['var']].iteritems())
+            frames.append(frame[[dep, benef]])
+            keys.append(('of', year))
+            if agg.labels['dep_real'] in frame:
+                frames.append(frame[[agg.labels['dep_real'], agg.labels['benef_real']]].rename(
+                        columns = {agg.labels['dep_real']: dep, agg.labels['benef_real']: benef}))
+                keys.append(('reel', year))
+            frames.append(self.aggregates_erfs_dataframe[year].to_frame(dep))
+            keys.append(('erfs', year))
+
+        table = pd.concat(frames, keys = keys, names = ['source', 'year', 'measure'])[[dep, benef]]
+        table = table.reorder_levels(['measure', 'source', 'year']).reindex(self.index)
+        # unstack sorts the rows and the columns
+        rows = self.index.droplevel('year').unique()
+        columns = MultiIndex.from_product([[dep, benef], self.years], names = [None, 'year'])
+        table = table.unstack('year').reindex(index = rows, columns = columns)
+        # Measures are labelled as in the aggregates table
+        return table.rename(index = dict((variable, label) for variable, label in labels.iteritems()
+                                         if variable in self.aggregates_variables))
 
     def build_dataframe(self):
+        self._build_multiindex()
         self._generate_aggregates()
         self.dataframe = self._reshape_tables()
 
@@ -277,7 +250,6 @@ def test_recap(source_file_name=None, export_file_name = "myrecap.xls"):
     recap.set_years(years)
     recap.set_aggregates_variables(variables)
     recap.set_sources(sources)
-    recap._build_multiindex()
     recap.build_dataframe()
     print recap.dataframe.to_string()
     recap.save(filename=export_file_name, alter_method=False)
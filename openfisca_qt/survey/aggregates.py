@@ -0,0 +1,294 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# Expenditures and beneficiaries of the survey variables, without any GUI dependency (shared by
+# the aggregates widget and the scripts)
+
+
+from __future__ import division
+
+from collections import OrderedDict
+from datetime import datetime
+import logging
+import os
+
+import numpy as np
+from pandas import DataFrame, HDFStore
+
+from ..gui.baseconfig import get_translation
+from . import model
+
+
+_ = get_translation('openfisca_qt')
+log = logging.getLogger(__name__)
+
+DEFAULT_VARLIST = ['cotsoc_noncontrib', 'csg', 'crds', 'irpp', 'ppe', 'af', 'af_base', 'af_majo', 'af_forf', 'cf',
+                   'paje_base', 'paje_nais', 'paje_clca', 'paje_clmg', 'ars', 'aeeh', 'asf', 'aspa', 'aah', 'caah',
+                   'rsa', 'rsa_act', 'aefa', 'api', 'majo_rsa', 'psa', 'logt', 'alf', 'als', 'apl']
+
+
+def get_weighted_totals(matrix, weights):
+    """
+    Returns the weighted sums and the weighted numbers of nonzero values of the columns of a matrix
+
+    Parameters
+    ----------
+    matrix : array
+             (observations x variables) matrix of values
+    weights : array
+              weights of the observations
+
+    Returns
+    -------
+    amounts, beneficiaries : array
+                             totals of the variables
+    """
+    weights = np.asarray(weights, dtype = float)
+    return weights.dot(matrix), weights.dot(matrix != 0)
+
+
+class Aggregates(object):
+    """
+    Expenditures and beneficiaries of the variables of varlist, compared to the default
+    (reference) simulation and to the administrative (real) aggregates
+
+    The variables of an entity are stacked in a single (entities x variables) matrix and their
+    totals are computed by two products with the weights.
+    """
+    def __init__(self):
+        super(Aggregates, self).__init__()
+        self.labels = OrderedDict((('var', u"Mesure"),
+                                   ('entity', u"Entité"),
+                                   ('dep', u"Dépense \n(millions d'€)"),
+                                   ('benef', u"Bénéficiaires \n(milliers)"),
+                                   ('dep_default', u"Dépense initiale \n(millions d'€)"),
+                                   ('benef_default', u"Bénéficiaires \ninitiaux \n(milliers)"),
+                                   ('dep_real', u"Dépenses \nréelles \n(millions d'€)"),
+                                   ('benef_real', u"Bénéficiaires \nréels \n(milliers)"),
+                                   ('dep_diff_abs', u"Diff. absolue \nDépenses \n(millions d'€)"),
+                                   ('benef_diff_abs', u"Diff. absolue \nBénéficiaires \n(milliers)"),
+                                   ('dep_diff_rel', u"Diff. relative \nDépenses"),
+                                   ('benef_diff_rel', u"Diff. relative \nBénéficiaires")))
+        self.show_default = False
+        self.show_real = True
+        self.show_diff = True
+        self.varlist = list(DEFAULT_VARLIST)
+        # Variables of varlist available in the simulation, in the order of the rows of aggr_frame
+        self.varnames = None
+        self.filter_by = None
+        self.simulation = None
+        self.year = None
+        self.totals_df = None
+        self.aggr_frame = None
+
+    def __repr__(self):
+        return '%s \n year %s \n varlist %s ' % (self.__class__.__name__, self.year, self.varlist)
+
+    def set_simulation(self, simulation):
+        """
+        Set simulation
+        """
+        self.simulation = simulation
+        self.year = simulation.datesim.year
+        self.filter_by = model.FILTERING_VARS[0]
+
+    def get_output_tables(self):
+        """
+        Returns the output tables of the simulation indexed by 'data' and 'default'
+        """
+        tables = {'data': self.simulation.output_table}
+        output_table_default = getattr(self.simulation, 'output_table_default', None)
+        if output_table_default is not None and output_table_default is not self.simulation.output_table:
+            tables['default'] = output_table_default
+        return tables
+
+    def get_totals(self, output_table, varnames, filter_by = None):
+        """
+        Returns the expenditures (millions) and beneficiaries (thousands) of variables
+
+        Parameters
+        ----------
+        output_table : DataTable
+                       output table of a simulation
+        varnames : list
+                   names of the variables
+        filter_by : str, default None
+                    name of the filtering variable
+
+        Returns
+        -------
+        totals : dict
+                 (expenditure, beneficiaries) indexed by variable
+        """
+        WEIGHT = model.WEIGHT
+        by_entity = {}
+        for varname in varnames:
+            by_entity.setdefault(output_table.column_by_name[varname].entity, []).append(varname)
+
+        totals = {}
+        for entity, names in by_entity.iteritems():
+            weights = output_table._inputs.get_value(WEIGHT, entity)
+            if filter_by is not None:
+                weights = weights*output_table._inputs.get_value(filter_by, entity)
+            matrix = np.empty((len(weights), len(names)))
+            for position, varname in enumerate(names):
+                matrix[:, position] = output_table.get_value(varname, entity)
+            amounts, beneficiaries = get_weighted_totals(matrix, weights)
+            for position, varname in enumerate(names):
+                totals[varname] = (amounts[position]/1e6, beneficiaries[position]/1e3)
+        return totals
+
+    def get_aggregate(self, variable, filter_by = None):
+        """
+        Returns the expenditure and the beneficiaries of a variable for the current and default
+        simulations, indexed by 'data' and 'default'
+        """
+        return dict((name, self.get_totals(output_table, [variable], filter_by)[variable])
+                    for name, output_table in self.get_output_tables().iteritems())
+
+    def compute_aggregates(self, filter_by = None, progress = None):
+        """
+        Compute aggregate amounts
+
+        Parameters
+        ----------
+        filter_by : str, default None
+                    name of the filtering variable
+        progress : callable, default None
+                   called with a message before the totals of each output table are computed
+        """
+        output_tables = self.get_output_tables()
+        column_by_name = output_tables['data'].column_by_name
+        varlist = [varname for varname in self.varlist if varname in column_by_name]
+        self.varnames = varlist
+
+        columns = OrderedDict()
+        columns['var'] = [column_by_name[varname].label for varname in varlist]
+        columns['entity'] = [column_by_name[varname].entity for varname in varlist]
+        for name, output_table in sorted(output_tables.iteritems()):
+            if progress is not None:
+                progress(_("Computing aggregates of the %s simulation ...") % name)
+            totals = self.get_totals(output_table, varlist, filter_by)
+            suffix = '_default' if name == 'default' else ''
+            columns['dep' + suffix] = [totals[varname][0] for varname in varlist]
+            columns['benef' + suffix] = [totals[varname][1] for varname in varlist]
+
+        self.aggr_frame = DataFrame(OrderedDict((self.labels[key], values) for key, values in columns.iteritems()),
+                                    index = varlist)
+
+    def load_amounts_from_file(self, filename = None, year = None):
+        """
+        Loads the administrative totals (amounts and beneficiaries) from file
+        """
+        if year is None:
+            year = self.year
+        if filename is None:
+            filename = os.path.join(model.DATA_SOURCES_DIR, "amounts.h5")
+        try:
+            store = HDFStore(filename, 'r')
+            try:
+                amounts, beneficiaries = store['amounts'], store['benef']
+            finally:
+                store.close()
+            self.set_real_aggregates(DataFrame({"amount": amounts[year]/1e6, "benef": beneficiaries[year]/1e3}))
+        except Exception, e:
+            log.warning("No administrative data available for year %s in file %s: %s", year, filename, e)
+            self.totals_df = None
+
+    def set_real_aggregates(self, totals_df):
+        """
+        Sets the administrative totals
+
+        Parameters
+        ----------
+        totals_df : DataFrame
+                    'amount' (millions) and 'benef' (thousands) columns indexed by variable
+        """
+        totals_df = totals_df.copy()
+        # Housing allowances and rsa (with rmi) are also given as a whole
+        for varname, components in [('logt', ['apl', 'alf', 'als']), ('rsa', ['rmi', 'rsa'])]:
+            available = [component for component in components if component in totals_df.index]
+            if available:
+                totals_df.loc[varname] = totals_df.loc[available].sum()
+        # Taxes are negative amounts in the simulation
+        taxes = [varname for varname in ['irpp', 'csg', 'crds', 'cotsoc_noncontrib'] if varname in totals_df.index]
+        totals_df.loc[taxes, 'amount'] = -totals_df.loc[taxes, 'amount']
+        self.totals_df = totals_df
+
+    def compute_real(self):
+        """
+        Adds the administrative totals to the aggregates
+        """
+        if self.totals_df is None:
+            return
+        totals = self.totals_df.reindex(self.aggr_frame.index)
+        self.aggr_frame[self.labels['dep_real']] = totals['amount'].values
+        self.aggr_frame[self.labels['benef_real']] = totals['benef'].values
+
+    def compute_diff(self):
+        """
+        Adds the absolute and relative differences with the default simulation (show_default) or
+        with the administrative totals (show_real)
+        """
+        if self.show_default and self.labels['dep_default'] in self.aggr_frame:
+            reference = 'default'
+        elif self.show_real and self.labels['dep_real'] in self.aggr_frame:
+            reference = 'real'
+        else:
+            return
+        for key in ['dep', 'benef']:
+            values = self.aggr_frame[self.labels[key]]
+            reference_values = self.aggr_frame[self.labels[key + '_' + reference]]
+            self.aggr_frame[self.labels[key + '_diff_abs']] = values - reference_values
+            self.aggr_frame[self.labels[key + '_diff_rel']] = (values - reference_values)/abs(reference_values)
+
+    def compute(self, progress = None):
+        """
+        Compute the whole table
+
+        Parameters
+        ----------
+        progress : callable, default None
+                   called with a message at each step (see worker.ComputationThread)
+        """
+        self.compute_aggregates(self.filter_by, progress = progress)
+        if self.show_real:
+            if progress is not None:
+                progress(_("Loading administrative data ..."))
+            self.load_amounts_from_file()
+            self.compute_real()
+        if self.show_diff:
+            self.compute_diff()
+        self.aggr_frame = self.aggr_frame.reset_index(drop = True)
+
+    def create_description(self):
+        '''
+        Creates a description dataframe
+        '''
+        now = datetime.now()
+        descr = [u'OpenFisca',
+                 u'Calculé le %s à %s' % (now.strftime('%d-%m-%Y'), now.strftime('%H:%M')),
+                 u'Système socio-fiscal au %s' % self.simulation.datesim,
+                 u"Données d'enquêtes de l'année %s" % str(self.simulation.survey.survey_year)]
+        return DataFrame(descr)
@@ -0,0 +1,258 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# Headless computation of the aggregates and inequality indicators of several years
+
+
+from __future__ import division
+
+import os
+from multiprocessing import Pool
+
+from openfisca_core.simulations import SurveySimulation
+from pandas import DataFrame, ExcelWriter, HDFStore, Index
+
+from .aggregates import Aggregates
+from .inequality import Inequality
+from .result_store import ResultStore, compute_simulation
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+
+TASKS = ['aggregates', 'inequality']
+
+
+def set_memory_limit(megabytes = None):
+    """
+    Caps the address space of the current process (a MemoryError is then raised by the
+    simulation instead of swapping the whole machine)
+    """
+    if megabytes is None or resource is None:
+        return
+    limit = int(megabytes*1024*1024)
+    resource.setrlimit(resource.RLIMIT_AS, (limit, limit))
+
+
+def get_simulation(year, inflators = None, survey_filename = None, store_dir = None):
+    """
+    Returns the computed simulation of a year
+
+    Parameters
+    ----------
+    year : int
+           year of the simulation
+    inflators : dict, default None
+                inflators of the survey variables
+    survey_filename : str, default None
+                      survey file used instead of the configured one
+    store_dir : str, default None
+                directory of the result store (the simulation is always computed when None)
+
+    The key of the store only needs the survey file, the date and the parameters, so the survey
+    is loaded and inflated only when the results are not stored.
+    """
+    simulation = SurveySimulation()
+    if survey_filename is None:
+        simulation.set_config(year = year)
+    else:
+        simulation.set_config(year = year, survey_filename = survey_filename)
+    simulation.set_param()
+
+    def prepare():
+        simulation.set_survey()
+        if inflators:
+            simulation.inflate_survey(inflators)
+
+    if store_dir is None:
+        prepare()
+        simulation.compute()
+    else:
+        compute_simulation(simulation, ResultStore(store_dir), options = inflators, prepare = prepare)
+    return simulation
+
+
+def run_year(year, task = 'aggregates', varlist = None, inflators = None, survey_filename = None, store_dir = None):
+    """
+    Computes the frames of a single year
+
+    Parameters
+    ----------
+    year : int
+           year of the simulation
+    task : str, default 'aggregates'
+           'aggregates' or 'inequality'
+    varlist : list, default None
+              variables of the aggregates (the default varlist of Aggregates when None)
+    inflators : dict, default None
+                inflators of the survey variables
+    survey_filename : str, default None
+                      survey file used instead of the configured one
+    store_dir : str, default None
+                directory of the result store (the simulation is always computed when None)
+
+    Returns
+    -------
+    frames : dict
+             frames of the year indexed by name (the aggregates are indexed by variable)
+    """
+    if task not in TASKS:
+        raise Exception("run_year: unknown task %s, should be one of %s" % (task, TASKS))
+    simulation = get_simulation(year, inflators, survey_filename, store_dir)
+    if task == 'aggregates':
+        aggregates = Aggregates()
+        if varlist is not None:
+            aggregates.varlist = list(varlist)
+        aggregates.set_simulation(simulation)
+        aggregates.compute()
+        frame = aggregates.aggr_frame
+        frame.index = Index(aggregates.varnames, name = 'variable')
+        return {'aggregates': frame}
+
+    inequality = Inequality()
+    inequality.set_simulation(simulation)
+    inequality.compute()
+    poverty = DataFrame({'poverty': inequality.poverty, 'poverty_gap': inequality.poverty_gap})
+    poverty.index.name = 'percentage'
+    return {'inequality': inequality.inequality_dataframe, 'poverty': poverty.reset_index()}
+
+
+def _run_year(args):
+    year, task, varlist, inflators, survey_filename, store_dir = args
+    try:
+        return year, run_year(year, task, varlist, inflators, survey_filename, store_dir), None
+    except MemoryError:
+        return year, None, "memory limit reached"
+    except Exception, e:
+        return year, None, "%s" % e
+
+
+def iter_years(years, task = 'aggregates', varlist = None, inflators = None, processes = None,
+               memory_limit = None, survey_filename = None, store_dir = None):
+    """
+    Computes the years in a process pool and yields the frames of each year as soon as it is ready
+
+    Every worker computes a single year and is then replaced, so that the memory of a
+    simulation is given back to the system between years.
+
+    Parameters
+    ----------
+    years : list
+            years to compute
+    task : str, default 'aggregates'
+           'aggregates' or 'inequality'
+    varlist : list, default None
+              variables of the aggregates
+    inflators : dict, default None
+                inflators of the survey variables indexed by year
+    processes : int, default None
+                number of worker processes (number of cpus by default)
+    memory_limit : float, default None
+                   memory limit of each worker in megabytes
+    survey_filename : str, default None
+                      survey file used instead of the configured one
+    store_dir : str, default None
+                directory of the result store (the simulations are always computed when None)
+
+    Yields
+    ------
+    year, frames, error
+        frames is None and error the error message when the computation of the year failed
+    """
+    if inflators is None:
+        inflators = {}
+    pool = Pool(processes = processes, initializer = set_memory_limit, initargs = (memory_limit,),
+                maxtasksperchild = 1)
+    try:
+        arguments = [(year, task, varlist, inflators.get(year), survey_filename, store_dir) for year in years]
+        for result in pool.imap_unordered(_run_year, arguments):
+            yield result
+    finally:
+        pool.close()
+        pool.join()
+
+
+def save_frames(frames_by_year, filename):
+    """
+    Writes the frames of every year to a single Excel (.xls, .xlsx) or HDF5 (.h5) file
+
+    The Excel sheets are named after the year (<name>_<year> when there are several frames
+    by year) and the HDF5 keys are y<year>/<name>.
+    """
+    extension = os.path.splitext(filename)[1].lower()
+    if extension in ['.h5', '.hdf5']:
+        store = HDFStore(filename)
+        try:
+            for year, frames in sorted(frames_by_year.iteritems()):
+                for name, frame in frames.iteritems():
+                    store['y%s/%s' % (year, name)] = frame
+        finally:
+            store.close()
+    elif extension in ['.xls', '.xlsx']:
+        writer = ExcelWriter(str(filename))
+        for year, frames in sorted(frames_by_year.iteritems()):
+            for name, frame in sorted(frames.iteritems()):
+                sheet_name = str(year) if len(frames) == 1 else "%s_%s" % (name, year)
+                frame.to_excel(writer, sheet_name, index = False, header = True, float_format = "%.2f")
+        writer.save()
+    else:
+        raise Exception("save_frames: unknown file format %s" % extension)
+
+
+def compute_all(years, filename = None, task = 'aggregates', varlist = None, inflators = None, processes = None,
+                memory_limit = None, survey_filename = None, store_dir = None, callback = None):
+    """
+    Computes the years in a process pool and writes all the frames to a single file at the end
+
+    Parameters
+    ----------
+    years : list
+            years to compute
+    filename : str, default None
+               Excel or HDF5 output file (nothing is written when None)
+    callback : callable, default None
+               called with (year, frames) as soon as a year is computed
+
+    See iter_years for the other parameters
+
+    Returns
+    -------
+    frames_by_year, errors : dict
+                             frames and error messages indexed by year
+    """
+    frames_by_year = {}
+    errors = {}
+    for year, frames, error in iter_years(years, task, varlist, inflators, processes, memory_limit,
+                                          survey_filename, store_dir):
+        if frames is None:
+            errors[year] = error
+            continue
+        frames_by_year[year] = frames
+        if callback is not None:
+            callback(year, frames)
+    if filename is not None and frames_by_year:
+        save_frames(frames_by_year, filename)
+    return frames_by_year, errors
@@ -0,0 +1,161 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+from pandas import DataFrame
+
+
+class AggregationCache(object):
+    """
+    Variables of a survey simulation aggregated at the entity level, kept between requests
+
+    The columns are stored by (revision, entity, variable): only the variables not yet
+    aggregated for the entity are requested from the simulation. The revision is incremented
+    by invalidate, which is called when the output tables of the simulation are replaced.
+
+    The cache is not thread safe: a thread other than the one reading the cache (the GUI thread
+    when the simulation was computed again) replaces it with a new AggregationCache instead of
+    calling invalidate.
+    """
+    def __init__(self, simulation):
+        super(AggregationCache, self).__init__()
+        self.simulation = simulation
+        self.revision = 0
+        self.columns = {}
+        # Columns added by the simulation to every aggregated table (weights, ...)
+        self.implicit_columns = {}
+        self.output_tables = self.get_output_tables()
+
+    def __repr__(self):
+        return '%s \n revision %s \n columns %s ' % (self.__class__.__name__, self.revision,
+                                                      sorted(self.columns))
+
+    def get_output_tables(self):
+        return (getattr(self.simulation, 'output_table', None),
+                getattr(self.simulation, 'output_table_default', None))
+
+    def invalidate(self):
+        """
+        Forgets every aggregated column
+        """
+        self.revision += 1
+        self.columns = {}
+        self.implicit_columns = {}
+        self.output_tables = self.get_output_tables()
+
+    def check_revision(self):
+        """
+        Invalidates the cache if the output tables of the simulation were replaced
+        """
+        output_tables = self.get_output_tables()
+        if any(table is not cached for table, cached in zip(output_tables, self.output_tables)):
+            self.invalidate()
+
+    def aggregate(self, entity, varnames):
+        """
+        Aggregates the variables with the simulation and stores the columns
+        """
+        try:
+            data, data_default = self.simulation.aggregated_by_entity(entity, varnames)
+        except:
+            self.simulation.compute()
+            self.invalidate()
+            data, data_default = self.simulation.aggregated_by_entity(entity, varnames)
+
+        for name in data.columns:
+            default = None
+            if data_default is not None and name in data_default:
+                default = data_default[name]
+            self.columns[(self.revision, entity, name)] = (data[name], default)
+        implicit = set(data.columns) - set(varnames)
+        if entity in self.implicit_columns:
+            implicit &= self.implicit_columns[entity]
+        self.implicit_columns[entity] = implicit
+
+    def fetch(self, entity, varnames):
+        """
+        Aggregates the variables missing from the cache and returns the names of the columns
+        (the variables and the implicit columns)
+        """
+        self.check_revision()
+        # A second pass is needed when the simulation had to be computed (the cache was emptied)
+        for attempt in range(2):
+            missing = [name for name in varnames if (self.revision, entity, name) not in self.columns]
+            if not missing and entity in self.implicit_columns:
+                break
+            self.aggregate(entity, missing)
+        return sorted(set(varnames) | self.implicit_columns[entity])
+
+    def get_arrays(self, entity, varnames):
+        """
+        Returns the values of the variables aggregated at the entity level as aligned arrays
+
+        Parameters
+        ----------
+        entity : str
+                 name of the entity
+        varnames : list
+                   variables to aggregate
+
+        Returns
+        -------
+        arrays : dict
+                 (values, default values) indexed by column name, the default values being None
+                 when there is no default simulation
+        """
+        names = self.fetch(entity, varnames)
+        arrays = {}
+        for name in names:
+            column, default = self.columns[(self.revision, entity, name)]
+            arrays[name] = (column.values, default.values if default is not None else None)
+        return arrays
+
+    def get(self, entity, varnames):
+        """
+        Returns the tables of the variables aggregated at the entity level
+
+        Parameters
+        ----------
+        entity : str
+                 name of the entity
+        varnames : list
+                   variables to aggregate
+
+        Returns
+        -------
+        data, data_default : DataFrame
+                             aggregated variables of the simulation and of the default simulation
+                             (None when there is no default simulation)
+        """
+        names = self.fetch(entity, varnames)
+        data = DataFrame(dict((name, self.columns[(self.revision, entity, name)][0]) for name in names),
+                         columns = names)
+        defaults = dict((name, self.columns[(self.revision, entity, name)][1]) for name in names)
+        if all(default is None for default in defaults.itervalues()):
+            return data, None
+        data_default = DataFrame(dict((name, default) for name, default in defaults.iteritems()
+                                      if default is not None),
+                                 columns = [name for name in names if defaults[name] is not None])
+        return data, data_default
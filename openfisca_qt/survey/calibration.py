@@ -0,0 +1,875 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# Calibration of the survey weights on margins, without any GUI dependency (shared by the
+# calibration widget and the headless calibration_batch runner)
+
+
+from __future__ import division
+
+import hashlib
+import json
+
+import numpy as np
+from numpy import logical_not
+from openfisca_core.columns import EnumCol, BoolCol, AgeCol, DateCol, IntCol
+from pandas import read_csv, read_json, DataFrame, MultiIndex, Series, concat
+
+from . import model
+from .calmar_engine import CalmarEngine, factorize, get_design_key
+from .streaming import GroupedAccumulator
+from .weights import WeightsRegistry
+
+
+MODCOLS = [EnumCol, BoolCol, IntCol, AgeCol, DateCol]
+
+
+class Calibration(object):
+    """
+    An object to calibrate survey data of a SurveySimulation
+
+    Parameters
+    ----------
+    weight : str, default None
+             name of the weights column of the survey (WEIGHT of the survey model by default)
+    weight_ini : str, default None
+                 name of the initial weights column of the survey (WEIGHT_INI of the survey model
+                 by default)
+    """
+    def __init__(self, weight = None, weight_ini = None):
+        super(Calibration, self).__init__()
+
+        self.weight = weight
+        self.weight_ini = weight_ini
+        self.simulation = None
+        self.param = {}
+        self.frame = None
+        self.input_margins_df = None
+        self.output_margins_df = None
+
+        self.totalpop = None
+        self.ini_totalpop = None
+        self.engine = None
+        self.engine_fingerprint = None
+        self.lambdasol = None
+        self.lambdasol_param = None
+        self.trace = None
+        self.margin_values = {}
+        self.crossed_vars = {}
+        self.weights_registry = None
+        self.margins = None
+        self.margins_param = None
+        self.replicate_weights = None
+        self.replicate_method = None
+
+        self.param = {'use_proportions' : True, 'pondini': None, 'method' : None, 'up' : None, 'lo':None}
+
+        # TODO: add a champm option
+
+    def __repr__(self):
+        return '%s \n simulation %s ' % (self.__class__.__name__, self.simulation)
+
+    def set_totalpop(self, totalpop):
+        """
+        Sets total population
+        """
+        self.totalpop = totalpop
+
+
+    def reset(self):
+        """
+        Reset the calibration to it initial state
+        """
+        self.frame = None
+        self.invalidate_margin_values()
+        self.clear_solution()
+        self.activate_weights('initial')
+
+
+    def set_simulation(self, simulation):
+        """
+        Set simulation
+        """
+        self.simulation = simulation
+        self.invalidate_margin_values()
+        self.clear_solution()
+        self.weights_registry = None
+        inputs = self.simulation.input_table
+        if inputs is None:
+            return
+        self.entity = 'men' # TODO: shoud not be france specific
+        if self.weight is None:
+            self.weight = model.WEIGHT
+        if self.weight_ini is None:
+            self.weight_ini = model.WEIGHT_INI
+
+        self.weights = 1*inputs.get_value(self.weight, self.entity)
+        self.weights_init = inputs.get_value(self.weight_ini, self.entity)
+        self.champm =  inputs.get_value("champm", self.entity)
+
+        self.ini_totalpop = sum(self.weights_init*self.champm)
+
+
+    def invalidate_margin_values(self):
+        """
+        Empty the cache of margin variables values (to be called whenever the simulation is recomputed)
+
+        The solver state is kept: update_weights rebuilds the design matrix only if the values
+        of the margin variables changed, and warm starts from the last Lagrange multipliers
+        """
+        self.margin_values = {}
+
+    def get_margin_value(self, varname, entity = None):
+        """
+        Returns the values of a margin variable at the entity level
+
+        The values are fetched from the survey or the output table (and summed over the members
+        of the entity, unless entity is 'ind') only once and kept until invalidate_margin_values
+        is called
+
+        Parameters
+        ----------
+        varname : str
+                  name of the variable
+        entity : str, default None
+                 entity at which level the values are returned (defaults to the calibration entity)
+        """
+        if entity is None:
+            entity = self.entity
+        key = (varname, entity)
+        if key not in self.margin_values and varname in self.crossed_vars:
+            # The values of a crossed variable are the tuple of the values of its components
+            self.margin_values[key] = tuple(self.get_margin_value(component, entity)
+                                            for component in self.crossed_vars[varname])
+        if key not in self.margin_values:
+            inputs = self.simulation.survey
+            output_table = self.simulation.output_table
+            if varname in inputs.column_by_name:
+                value = inputs.get_value(varname, entity)
+            elif output_table is not None and varname in output_table.column_by_name:
+                if entity == 'ind':
+                    value = output_table.get_value(varname, entity=entity)
+                else:
+                    enum = inputs.column_by_name.get('qui'+entity).enum
+                    people = [x[1] for x in enum]
+                    value = output_table.get_value(varname, entity=entity, opt=people, sum_=True)
+            else:
+                raise Exception("Calibration: variable %s is absent from both inputs and output_table" % varname)
+            self.margin_values[key] = value
+        return self.margin_values[key]
+
+    def clear_solution(self):
+        """
+        Forget the design matrix and the Lagrange multipliers of the last calibration
+        """
+        self.engine = None
+        self.engine_fingerprint = None
+        self.lambdasol = None
+        self.lambdasol_param = None
+        self.trace = None
+        self.margins = None
+        self.margins_param = None
+        self.replicate_weights = None
+        self.replicate_method = None
+
+    def set_param(self, parameter, value):
+        """
+        Set parameter
+        """
+        if parameter == 'lo':
+            self.param['lo'] = 1/value
+        else:
+            self.param[parameter] = value
+
+    def set_inputs_margins_from_file(self, filename, year):
+        self.set_margins_from_file(filename, year, source="input")
+
+    def set_margins_from_file(self, filename, year, source):
+        """
+        Sets margins for inputs variable from file
+        """
+        # TODO read from h5 files
+        with open(filename) as f_tot:
+            totals = read_csv(f_tot,index_col = (0,1))
+        # if data for the configured year is not availbale leave margins empty
+        year = str(year)
+        if year not in totals:
+            return
+        marges = {}
+        if source == "input":
+            self.input_margins_df = totals.rename(columns = {year : 'target'}, inplace = False)
+        elif source =='output':
+            self.output_margins_df = totals.rename(columns = {year : 'target'}, inplace = False)
+
+        for var, mod in totals.index:
+            if not marges.has_key(var):
+                marges[var] = {}
+            marges[var][mod] =  totals.get_value((var,mod),year)
+
+        for var in marges.keys():
+            if var == 'totalpop':
+                if source == "input" or source == "config":
+                    totalpop = marges.pop('totalpop')[0]
+                    marges['totalpop'] = totalpop
+                    self.totalpop = totalpop
+            else:
+                self.add_var2(var, marges[var], source = source)
+
+    def add_var2(self, varname, target=None, source = 'free', entity = None):
+        """
+        Add a variable in the dataframe
+
+        Parameters
+        ----------
+
+        varname : str
+                  name of the variable
+        target : float
+                 target for the margin of the variable
+        source : str, default 'free'
+                 database source
+        entity : str, default None
+                 entity of the margin: the calibration entity (default) or 'ind' for margins
+                 on individuals, fitted by the household weights in the same calibration
+        """
+        if entity is None:
+            entity = self.entity
+        w_init = self.weights_init*self.champm
+        w = self.weights*self.champm
+        champm = self.champm
+        if entity != self.entity:
+            members = self.get_members_index(entity)
+            w_init, w, champm = w_init[members], w[members], champm[members]
+
+        value = self.get_margin_value(varname, entity)
+        if varname in self.crossed_vars:
+            components = [self.simulation.get_col(component) for component in self.crossed_vars[varname]]
+            varcol = None
+            label = u" x ".join(col.label or col.name for col in components)
+            categorical = True
+        else:
+            varcol = self.simulation.get_col(varname)
+            label = varcol.label
+            categorical = varcol.__class__ in MODCOLS
+
+        if categorical:
+            # Weighted counts of the categories from their integer codes
+            champm = np.asarray(champm, dtype = bool)
+            if isinstance(value, tuple):
+                # Categories of crossed variables are tuples, kept out of the index
+                mods, codes = factorize(tuple(component[champm] for component in value))
+                index = range(len(mods))
+            else:
+                mods, codes = factorize(value[champm])
+                index = mods
+            res = DataFrame({'marge': np.bincount(codes, weights = w[champm], minlength = len(mods)),
+                             'marge initiale': np.bincount(codes, weights = w_init[champm], minlength = len(mods))},
+                            index = index, columns = ['marge', 'marge initiale'])
+        else:
+            res = DataFrame(index = ['total'],
+                            data = {'marge' : (value*w).sum(),
+                                    'marge initiale' : (value*w_init).sum()  } )
+        res.insert(0, u"modalités",u"")
+        res.insert(2, "cible", 0)
+        res.insert(2, u"cible ajustée", 0)
+        res.insert(4, "source", source)
+        if varcol is not None:
+            mods = res.index
+
+        if target is not None:
+            if len(mods) != len(target.keys()):
+                drop_indices = [ (varname, mod) for mod in target.keys()]
+                if source == 'input':
+                    self.input_margins_df.drop(drop_indices, inplace=True)
+                    self.input_margins_df.index.names = ['var','mod']
+                if source == 'output':
+                    self.output_margins_df.drop(drop_indices, inplace=True)
+                    self.output_margins_df.index.names = ['var','mod']
+                return
+
+        if varcol is None:
+            res[u'modalités'] = [u" x ".join(self.get_modality(col, component_mod)
+                                             for col, component_mod in zip(components, mod))
+                                 for mod in mods]
+            res['mod'] = Series(mods, index = res.index)
+        elif isinstance(varcol, EnumCol):
+            if varcol.enum:
+                enum = varcol.enum
+                res[u'modalités'] = [enum._vars[mod] for mod in mods]
+                res['mod'] = mods
+            else:
+                res[u'modalités'] = [mod for mod in mods]
+                res['mod'] = mods
+        elif isinstance(varcol, BoolCol):
+            res[u'modalités'] = bool(mods)
+            res['mod']        = mods
+        elif isinstance(varcol, IntCol):
+            res[u'modalités'] = mods
+            res['mod']        = mods
+        elif isinstance(varcol, AgeCol):
+            res[u'modalités'] = mods
+            res['mod'] = mods
+        else:
+            res[u'modalités'] = "total"
+            res['mod']  = 0
+
+        if label is not None:
+            res['variable'] = label
+        else:
+            res['variable'] = varname
+        res['var'] = varname
+        res['entity'] = entity
+
+        if target is not None and varcol is None:
+            res['cible'] = [target.get(mod, 0) for mod in mods]
+        elif target is not None:
+            for mod, margin in target.iteritems():
+                if mod == varname:    # dirty to deal with non catgorical data
+                    res['cible'][0] = margin
+                else:
+                    res['cible'][mod] = margin
+
+        if self.frame is None:
+            self.frame = res
+        else:
+            self.frame = concat([self.frame, res])
+
+        self.frame = self.frame.reset_index(drop=True)
+
+
+    def add_crossed_var(self, varnames, target = None, source = 'free', entity = None):
+        """
+        Add a crossed categorical variable (age x sex, ...) in the dataframe
+
+        Parameters
+        ----------
+
+        varnames : list
+                   names of the crossed categorical variables
+        target : dict
+                 targets of the margins indexed by tuples of categories of the variables
+        source : str, default 'free'
+                 database source
+        entity : str, default None
+                 entity of the margin (see add_var2)
+
+        Returns
+        -------
+        varname : str
+                  name of the crossed variable
+        """
+        varname = " x ".join(varnames)
+        self.crossed_vars[varname] = list(varnames)
+        self.add_var2(varname, target = target, source = source, entity = entity)
+        return varname
+
+    def get_margins_from_chunks(self, chunks, varnames, weight = None):
+        """
+        Returns the margins of variables computed from a stream of chunks of entity level data
+
+        The weighted counts of the categories of the categorical variables and the weighted
+        totals of the other variables are accumulated chunk by chunk (the sums are exact).
+
+        Parameters
+        ----------
+
+        chunks : iterable
+                 DataFrames holding the variables, the weights and champm for chunks of the
+                 calibration entity
+        varnames : list
+                   names of the variables (crossed variables are not supported)
+        weight : str, default None
+                 name of the weights column (the weights column of the calibration by default)
+
+        Returns
+        -------
+        margins : DataFrame
+                  'marge' column indexed by (var, mod), mod being 'total' for the totals
+        """
+        if weight is None:
+            weight = self.weight
+        categorical = {}
+        for varname in varnames:
+            if varname in self.crossed_vars:
+                raise Exception("Calibration: margins of crossed variable %s cannot be computed from chunks" % varname)
+            categorical[varname] = self.simulation.get_col(varname).__class__ in MODCOLS
+        accumulators = dict((varname, GroupedAccumulator()) for varname in varnames if categorical[varname])
+        totals = dict((varname, 0) for varname in varnames if not categorical[varname])
+        for chunk in chunks:
+            weights = chunk[weight].values*chunk['champm'].values
+            for varname, accumulator in accumulators.iteritems():
+                accumulator.update(chunk[varname].values, weights, {})
+            for varname in totals:
+                totals[varname] += (chunk[varname].values*weights).sum()
+
+        index, margins = [], []
+        for varname in varnames:
+            if categorical[varname]:
+                accumulator = accumulators[varname]
+                index += [(varname, mod) for mod in accumulator.groups]
+                margins += list(accumulator.totals)
+            else:
+                index.append((varname, 'total'))
+                margins.append(totals[varname])
+        return DataFrame({'marge': margins}, index = MultiIndex.from_tuples(index, names = ['var', 'mod']))
+
+    def get_modality(self, varcol, mod):
+        """
+        Returns the label of a category of a variable
+        """
+        if isinstance(varcol, EnumCol) and varcol.enum:
+            return unicode(varcol.enum._vars[mod])
+        elif isinstance(varcol, BoolCol):
+            return unicode(bool(mod))
+        return unicode(mod)
+
+    def get_param(self):
+        p = {}
+        p['method'] = self.param['method']
+        p['lo']     = 1/self.param['invlo']
+        p['up']     = self.param['up']
+        p['use_proportions'] = True
+        p['pondini']  = self.weight + ""
+        return p
+
+    def build_calmar_data(self, marges, weights_in, members = None):
+        """
+        Builds the data dictionnary used as calmar input argument
+
+        Parameters
+        ----------
+        marges : dict
+                 Variables and their margins. A scalar var for numeric variables and a dict with
+                 categories key and population
+        weights_in : str
+                     name of the original weight variable
+        members : list, default None
+                  variables whose margins are on individuals
+
+        Returns
+        -------
+        data : TODO:
+        """
+        # Select only champm ménages by nullifying weight for irrelevant ménages
+        data = {weights_in: self.weights_init*self.champm}
+        for var in marges:
+            if var == 'totalpop':
+                continue
+            if members and var in members:
+                data[var] = self.get_margin_value(var, 'ind')
+            else:
+                data[var] = self.get_margin_value(var)
+        return data
+
+
+    def build_engine(self, marges, weights_in, members, fingerprint):
+        """
+        Builds the calibration engine (design matrix) of the margins
+
+        Parameters
+        ----------
+        marges : dict
+                 Variables and their margins
+        weights_in : str
+                     name of the original weight variable
+        members : dict
+                  position in the calibration entity of each individual indexed by the
+                  variables whose margins are on individuals
+        fingerprint : str
+                      fingerprint of the survey data of the margins
+        """
+        data = self.build_calmar_data(marges, weights_in, members)
+        self.engine = CalmarEngine()
+        self.engine_fingerprint = None
+        try:
+            self.engine.set_data(data, marges, pondini = weights_in, members = members)
+        except Exception, e:
+            self.engine = None
+            raise Exception("Calmar returned error '%s'" % e)
+        self.engine_fingerprint = fingerprint
+        # The replicates were calibrated on other data
+        self.replicate_weights = None
+        self.replicate_method = None
+
+    def update_weights(self, marges, param = {}, weights_in=None, members = None):
+        """
+        Runs the calibration engine, stores new weights and returns adjusted margins
+
+        Parameters
+        ----------
+        marges : dict
+                 Variables and their margins. A scalar var for numeric variables and a dict with
+                 categories key and population
+        param : dict
+                parameters of the calibration
+        weights_in : str
+                     name of the original weight variable
+        members : list, default None
+                  variables whose margins are on individuals (aggregated to the calibration
+                  entity through the survey index)
+
+        Returns
+        -------
+        marge_new : dict
+                    computed values of the margins
+        """
+        if weights_in is None:
+            weights_in = self.weight + "_ini"
+
+        # The design matrix is rebuilt only when the margin variables, their categories or their
+        # values changed
+        variables = [(var, 'ind' if members and var in members else self.entity)
+                     for var in sorted(marges) if var != 'totalpop']
+        fingerprint = self.get_fingerprint(variables)
+        if members:
+            members_index = self.get_members_index('ind')
+            members = dict((var, members_index) for var in members)
+        if (self.engine is None or self.engine.design_key != get_design_key(marges, members)
+                or self.engine_fingerprint != fingerprint):
+            self.build_engine(marges, weights_in, members, fingerprint)
+
+        # Warm start from the previous solution when only the targets changed
+        solve_param = (repr(self.engine.design_key), param.get('method'), param.get('lo'), param.get('up'))
+        lambda0 = self.lambdasol if solve_param == self.lambdasol_param else None
+        try:
+            try:
+                val_pondfin, lambdasol, marge_new = self.engine.solve(marges, param = param, lambda0 = lambda0)
+            except Exception:
+                if lambda0 is None:
+                    raise
+                val_pondfin, lambdasol, marge_new = self.engine.solve(marges, param = param)
+        except Exception, e:
+            self.trace = self.engine.get_trace()
+            raise Exception("Calmar returned error '%s'" % e)
+        self.trace = self.engine.get_trace()
+        self.lambdasol = lambdasol
+        self.lambdasol_param = solve_param
+        if marges != self.margins:
+            self.replicate_weights = None
+            self.replicate_method = None
+        self.margins = marges
+        self.margins_param = param
+
+        # Updating only champm weights
+        self.weights = val_pondfin*self.champm + self.weights*(logical_not(self.champm))
+        return marge_new
+
+    def get_fingerprint(self, variables = None):
+        """
+        Returns a fingerprint of the survey data used by the calibration
+
+        Parameters
+        ----------
+        variables : list, default None
+                    (variable, entity) of the margins, the variables of frame by default
+        """
+        if variables is None:
+            variables = []
+            if self.frame is not None:
+                entities = self.frame['entity'] if 'entity' in self.frame else [self.entity]*len(self.frame)
+                variables = sorted(set(zip(self.frame['var'], entities)))
+        values = [self.weights_init, self.champm]
+        for var, entity in variables:
+            value = self.get_margin_value(var, entity)
+            values.extend(value if isinstance(value, tuple) else [value])
+        fingerprint = hashlib.sha1()
+        for value in values:
+            value = np.ascontiguousarray(value)
+            fingerprint.update(str(value.dtype) + str(value.shape))
+            fingerprint.update(value.tostring())
+        return fingerprint.hexdigest()
+
+    def save_bundle(self, filename):
+        """
+        Saves the margins, the parameters, the calibrated weights and the solver state
+
+        Parameters
+        ----------
+        filename : str
+                   name of the .npz file
+        """
+        if self.frame is None:
+            raise Exception("Calibration: no margins to save")
+        np.savez_compressed(filename,
+            fingerprint = self.get_fingerprint(),
+            frame = self.frame.to_json(orient = 'split'),
+            param = json.dumps(dict((key, self.param.get(key)) for key in ['method', 'invlo', 'up'])),
+            totalpop = np.nan if self.totalpop is None else self.totalpop,
+            weights = self.weights,
+            lambdasol = self.lambdasol if self.lambdasol is not None else np.array([]),
+            lambdasol_param = json.dumps(self.lambdasol_param),
+            crossed_vars = json.dumps(self.crossed_vars),
+            )
+
+    def load_bundle(self, filename):
+        """
+        Loads margins and parameters saved by save_bundle
+
+        The calibrated weights and the solver state (engine and Lagrange multipliers) are
+        restored only when the survey data matches the fingerprint of the bundle, and the
+        weights are then published as the 'calibrated' weights of the survey; otherwise the
+        margins are added back and the calibration has to be run again.
+
+        Parameters
+        ----------
+        filename : str
+                   name of the .npz file
+
+        Returns
+        -------
+        restored : bool
+                   True if the calibrated weights were restored
+        """
+        bundle = np.load(filename)
+        frame = read_json(unicode(bundle['frame']), orient = 'split')
+        # Categories of crossed variables are tuples, stored as lists
+        frame['mod'] = [tuple(mod) if isinstance(mod, list) else mod for mod in frame['mod']]
+        if 'crossed_vars' in bundle:
+            self.crossed_vars.update(json.loads(unicode(bundle['crossed_vars'])))
+        for key, value in json.loads(unicode(bundle['param'])).iteritems():
+            if value is not None:
+                self.param[key] = value
+        totalpop = float(bundle['totalpop'])
+        self.totalpop = None if np.isnan(totalpop) else totalpop
+
+        self.frame = None
+        self.clear_solution()
+        entities = frame['entity'] if 'entity' in frame else Series(self.entity, index = frame.index)
+        variables = sorted(set(zip(frame['var'], entities)))
+        fingerprint = self.get_fingerprint(variables)
+        if fingerprint == str(bundle['fingerprint']):
+            self.frame = frame
+            # The engine is rebuilt on the saved margins so that recalibrations warm start
+            # from the saved solution
+            margins, members = self.get_frame_margins()
+            members_index = self.get_members_index('ind') if members else None
+            self.build_engine(margins, self.weight + "_ini",
+                              dict((var, members_index) for var in members) or None, fingerprint)
+            self.margins = margins
+            self.margins_param = self.get_param()
+            if len(bundle['lambdasol']):
+                self.lambdasol = bundle['lambdasol']
+                self.lambdasol_param = tuple(json.loads(unicode(bundle['lambdasol_param'])))
+            self.weights = bundle['weights']
+            self.set_calibrated_weights()
+            return True
+
+        for var, entity in variables:
+            rows = frame[(frame['var'] == var) & (entities == entity)]
+            if (rows[u"modalités"] == 'total').all():
+                target = {var: rows['cible'].iloc[0]}
+            else:
+                target = dict(zip(rows['mod'], rows['cible']))
+            self.add_var2(var, target = target, source = rows['source'].iloc[0], entity = entity)
+        return False
+
+    def build_replicate_weights(self, replicates = 100, method = 'bootstrap', seed = None):
+        """
+        Returns (replicates x households) float32 matrix of replicate initial weights
+
+        Parameters
+        ----------
+        replicates : int, default 100
+                     number of replicates
+        method : str, default 'bootstrap'
+                 'bootstrap' (households drawn with replacement) or 'jackknife' (delete-a-group
+                 jackknife with one random group of households per replicate)
+        seed : int, default None
+               seed of the random generator
+        """
+        random_state = np.random.RandomState(seed)
+        weights_init = self.weights_init*self.champm
+        sample = np.flatnonzero(weights_init > 0)
+        nb = len(sample)
+        replicate_weights = np.zeros((replicates, len(weights_init)), dtype = np.float32)
+        if method == 'bootstrap':
+            for r in range(replicates):
+                draws = np.bincount(random_state.randint(0, nb, nb), minlength = nb)
+                replicate_weights[r, sample] = weights_init[sample]*draws
+        elif method == 'jackknife':
+            groups = random_state.permutation(nb) % replicates
+            for r in range(replicates):
+                replicate_weights[r, sample] = weights_init[sample]*(groups != r)*replicates/(replicates - 1)
+        else:
+            raise Exception("Calibration: replicate method should be 'bootstrap' or 'jackknife'")
+        return replicate_weights
+
+    def calibrate_replicates(self, replicates = 100, method = 'bootstrap', seed = None, chunk_size = None):
+        """
+        Calibrates replicate weights on the margins of the last calibration in one batched solve
+
+        The calibrated (replicates x households) float32 matrix is kept in replicate_weights
+
+        Parameters
+        ----------
+        replicates : int, default 100
+                     number of replicates
+        method : str, default 'bootstrap'
+                 'bootstrap' or 'jackknife'
+        seed : int, default None
+               seed of the random generator
+        chunk_size : int, default None
+                     number of replicates solved together (by default, bounded by the memory
+                     they use, see CalmarEngine.solve_replicates)
+        """
+        if self.engine is None or self.margins is None:
+            raise Exception("Calibration: calibrate should be run before calibrate_replicates")
+        replicate_weights = self.build_replicate_weights(replicates, method = method, seed = seed)
+        try:
+            replicate_weights = self.engine.solve_replicates(replicate_weights, self.margins,
+                                                             param = self.margins_param, chunk_size = chunk_size)
+        except Exception, e:
+            raise Exception("Calmar returned error '%s'" % e)
+        # Households outside champm keep their weights
+        replicate_weights[:, logical_not(self.champm)] = self.weights[logical_not(self.champm)]
+        self.replicate_weights = replicate_weights
+        self.replicate_method = method
+
+    def get_replicate_variance(self, values):
+        """
+        Returns the replicate variance of the weighted totals of the values
+
+        Parameters
+        ----------
+        values : array
+                 household level values, one column per variable (n or n x k)
+
+        Returns
+        -------
+        variance : float or array
+                   variance of the weighted total of each variable
+        """
+        if self.replicate_weights is None:
+            raise Exception("Calibration: calibrate_replicates should be run before get_replicate_variance")
+        values = np.asarray(values, dtype = float)
+        replicates = len(self.replicate_weights)
+        # Totals are accumulated in double precision, a few replicates at a time
+        estimates = np.concatenate([self.replicate_weights[start:start + 50].astype(float).dot(values)
+                                    for start in range(0, replicates, 50)])
+        deviations = estimates - estimates.mean(axis = 0)
+        if self.replicate_method == 'jackknife':
+            return (replicates - 1)/replicates*(deviations**2).sum(axis = 0)
+        return (deviations**2).sum(axis = 0)/(replicates - 1)
+
+    def get_frame_margins(self):
+        """
+        Returns the margins found in frame and the total population
+
+        Returns
+        -------
+        margins : dict
+                  targets of the variables (a dict of categories targets for categorical
+                  variables) and 'totalpop'
+        members : list
+                  variables whose margins are on individuals
+        """
+        df = self.frame
+        margins = {}
+        members = []
+
+        if df is not None:
+            if 'entity' in df:
+                members = list(df['var'][df['entity'] != self.entity].unique())
+            for var, mod, modality, target in zip(df['var'], df['mod'], df[u"modalités"], df['cible']):
+                # Dealing with non categorical vars ...
+                if modality == 'total':
+                    margins[var] = target
+                #  ... and categorical vars
+                else:
+                    margins.setdefault(var, {})[mod] = target
+
+        if self.totalpop is not None:
+            margins['totalpop'] = self.totalpop
+        return margins, members
+
+    def calibrate(self):
+        """
+        Calibrate according to margins found in frame
+        """
+        df = self.frame
+        margins, members = self.get_frame_margins()
+        param = self.get_param()
+        adjusted_margins = self.update_weights(margins, param=param, members=members)
+
+        if df is None:
+            return
+
+        # Margins reached by the new weights are read from the design matrix of the engine
+        updated_margins = self.engine.get_margins(self.weights*self.champm)
+        adjusted, reached = [], []
+        for var, mod in zip(df['var'], df['mod']):
+            if isinstance(adjusted_margins[var], dict):
+                adjusted.append(adjusted_margins[var][mod])
+                reached.append(updated_margins[var][mod])
+            else:
+                adjusted.append(adjusted_margins[var])
+                reached.append(updated_margins[var])
+
+        df = df.reset_index(drop=True)
+        df[u"cible ajustée"] = adjusted
+        df[u"marge"] = reached
+        self.frame = df
+
+    def get_weights_registry(self):
+        """
+        Returns the registry of the weights of the survey, holding the initial weights at first
+        """
+        if self.weights_registry is None:
+            self.weights_registry = WeightsRegistry(self.simulation.survey, self.entity, self.weight)
+            self.weights_registry.add('initial', self.weights_init)
+        return self.weights_registry
+
+    def get_members_index(self, entity = 'ind'):
+        """
+        Returns the position in the calibration entity of each individual
+        """
+        if entity != 'ind':
+            raise Exception("Calibration: margins on entity %s are not supported, use %s or 'ind'"
+                            % (entity, self.entity))
+        return self.get_weights_registry().members_index
+
+    def activate_weights(self, name):
+        """
+        Use the named weights of the registry as the survey weights
+
+        Parameters
+        ----------
+        name : str
+               'initial', 'calibrated' or any name given to set_calibrated_weights
+        """
+        registry = self.get_weights_registry()
+        registry.activate(name)
+        registry.publish()
+
+    def set_calibrated_weights(self, name = 'calibrated'):
+        """
+        Modify the weights to use the calibrated weight
+
+        Parameters
+        ----------
+        name : str, default 'calibrated'
+               name under which the calibrated weights are kept in the weights registry
+        """
+        self.get_weights_registry().add(name, self.weights)
+        self.activate_weights(name)
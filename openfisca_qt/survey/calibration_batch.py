@@ -0,0 +1,172 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+# Headless calibration of a survey for several years and margins files
+
+
+from __future__ import division
+
+import os
+from multiprocessing import cpu_count, Pool
+
+from openfisca_core.simulations import SurveySimulation
+from pandas import HDFStore, Series
+
+from .calibration import Calibration
+
+
+# Simulation of the worker process, loaded once per year
+_worker_simulation = None
+_worker_year = None
+
+
+def get_job_key(job):
+    """
+    Returns the HDF5 group name of a job (year, margins filename, method, invlo, up)
+    """
+    year, filename, method, invlo, up = job
+    name = os.path.splitext(os.path.basename(filename))[0]
+    key = 'y%s/%s/%s_%g_%g' % (year, name, method, invlo, up)
+    return key.replace(' ', '_').replace('.', '_').replace('-', '_')
+
+
+def get_worker_simulation(year, survey_filename = None):
+    """
+    Returns the simulation of the current worker process for the given year
+    """
+    global _worker_simulation, _worker_year
+    if _worker_simulation is None or _worker_year != year:
+        # The survey of the previous year is released before the next one is loaded
+        _worker_simulation = None
+        simulation = SurveySimulation()
+        if survey_filename is None:
+            simulation.set_config(year = year)
+        else:
+            simulation.set_config(year = year, survey_filename = survey_filename)
+        simulation.set_param()
+        simulation.set_survey()
+        _worker_simulation, _worker_year = simulation, year
+    return _worker_simulation
+
+
+def run_job(job, survey_filename = None):
+    """
+    Calibrates the survey for a single job
+
+    Parameters
+    ----------
+    job : tuple
+          (year, margins filename, method, invlo, up)
+    survey_filename : str, default None
+                      survey file used instead of the configured one
+
+    Returns
+    -------
+    job, weights, frame
+    """
+    year, filename, method, invlo, up = job
+    simulation = get_worker_simulation(year, survey_filename)
+    calibration = Calibration()
+    calibration.set_simulation(simulation)
+    calibration.set_param('invlo', invlo)
+    calibration.set_param('up', up)
+    calibration.set_param('method', method)
+    calibration.set_margins_from_file(filename, year, source = "input")
+    calibration.calibrate()
+    return job, calibration.weights, calibration.frame
+
+
+def _run_job(args):
+    job, survey_filename = args
+    try:
+        return run_job(job, survey_filename)
+    except Exception, e:
+        return job, None, "%s" % e
+
+
+def calibrate_all(jobs, store_filename, processes = None, survey_filename = None):
+    """
+    Runs the calibration jobs in a process pool and stores the results in a HDF5 file
+
+    Every job is a task of its own, so that all the processes are used even with few years. A
+    worker keeps the survey of the year of its last job, and the jobs are dispatched by year, so
+    that the consecutive jobs of a worker often share their survey.
+
+    Parameters
+    ----------
+    jobs : list
+           list of (year, margins filename, method, invlo, up) tuples
+    store_filename : str
+                     HDF5 file where the calibrated weights and adjusted margins are stored
+                     under /<job key>/weights and /<job key>/margins
+    processes : int, default None
+                number of worker processes (number of cpus by default, at most one per job)
+    survey_filename : str, default None
+                      survey file used instead of the configured one
+
+    Returns
+    -------
+    errors : dict
+             error messages of the failed jobs indexed by job
+    """
+    arguments = [(job, survey_filename) for job in sorted(jobs)]
+    errors = {}
+    if not arguments:
+        return errors
+    pool = Pool(processes = min(processes or cpu_count(), len(arguments)))
+    store = HDFStore(store_filename)
+    try:
+        for job, weights, frame in pool.imap_unordered(_run_job, arguments):
+            if weights is None:
+                errors[job] = frame
+                continue
+            key = get_job_key(job)
+            store[key + '/weights'] = Series(weights)
+            frame = frame.copy()
+            frame['mod'] = frame['mod'].astype(unicode)
+            store[key + '/margins'] = frame
+            store.flush()
+    finally:
+        pool.close()
+        pool.join()
+        store.close()
+    return errors
+
+
+def test():
+    calibrations_dir = "../../countries/france/calibrations"
+    jobs = []
+    for year in range(2006, 2015):
+        filename = os.path.join(calibrations_dir, "calib_%s.csv" % year)
+        if os.path.isfile(filename):
+            jobs.append((year, filename, 'logit', 3, 3))
+            jobs.append((year, filename, 'linear', 3, 3))
+
+    errors = calibrate_all(jobs, "calibrations.h5")
+    for job, error in errors.iteritems():
+        print job, error
+
+
+if __name__ == '__main__':
+
+    test()
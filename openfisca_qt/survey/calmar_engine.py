@@ -0,0 +1,601 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import time
+import warnings
+
+import numpy as np
+from pandas import DataFrame
+from scipy import linalg, sparse
+from scipy.sparse.linalg import spsolve
+from scipy.special import expit
+
+
+POPULATION = 'dummy_is_in_pop'
+# Hessians with more rows are solved as sparse matrices
+DENSE_HESSIAN_SIZE = 500
+# Memory (bytes) of the working arrays of the replicates solved together by solve_replicates
+REPLICATES_MEMORY = 256*2**20
+
+
+def linear(u):
+    return 1 + u
+
+
+def linear_prime(u):
+    return np.ones(u.shape, dtype = float)
+
+
+def raking_ratio(u):
+    return np.exp(u)
+
+
+def raking_ratio_prime(u):
+    return np.exp(u)
+
+
+def _logit_share(u, lo, up):
+    a = (up - lo)/((1 - lo)*(up - 1))
+    return a, expit(a*u - np.log((up - 1)/(1 - lo)))
+
+
+def logit(u, lo, up):
+    a, s = _logit_share(u, lo, up)
+    return lo + (up - lo)*s
+
+
+def logit_prime(u, lo, up):
+    a, s = _logit_share(u, lo, up)
+    return a*(up - lo)*s*(1 - s)
+
+
+def get_distance_functions(param):
+    """
+    Returns the distance function and its derivative according to param['method']
+    """
+    method = param.get('method') or 'linear'
+    if method == 'linear':
+        return linear, linear_prime
+    elif method == 'raking ratio':
+        return raking_ratio, raking_ratio_prime
+    elif method == 'logit':
+        lo, up = param.get('lo'), param.get('up')
+        if up is None or lo is None:
+            raise Exception("When method is 'logit', 'lo' and 'up' parameters are needed in param")
+        if up <= 1:
+            raise Exception("When method is 'logit', 'up' should be strictly greater than 1")
+        if lo >= 1:
+            raise Exception("When method is 'logit', 'lo' should be strictly less than 1")
+        return (lambda u: logit(u, lo, up)), (lambda u: logit_prime(u, lo, up))
+    else:
+        raise Exception("method should be 'linear', 'raking ratio' or 'logit'")
+
+
+def get_distance_primitive(param):
+    """
+    Returns a primitive of the distance function according to param['method']
+
+    sum(d*primitive(X.lambda)) - lambda.targets is the dual objective of the calibration: its
+    gradient is the margins gap and its hessian the Newton hessian, so that it is the merit
+    function of the line search.
+    """
+    method = param.get('method') or 'linear'
+    if method == 'linear':
+        return lambda u: u + u**2/2
+    elif method == 'raking ratio':
+        return lambda u: np.exp(u) - 1
+    elif method == 'logit':
+        lo, up = param['lo'], param['up']
+        a = (up - lo)/((1 - lo)*(up - 1))
+        c = np.log((up - 1)/(1 - lo))
+        return lambda u: lo*u + (up - lo)/a*(np.logaddexp(0, a*u - c) - np.logaddexp(0, - c))
+    else:
+        raise Exception("method should be 'linear', 'raking ratio' or 'logit'")
+
+
+def get_design_key(margins, members = None):
+    """
+    Returns a hashable description of the structure of the margins (variables, categories and
+    whether the variable is given at the members level)
+    """
+    if members is None:
+        members = {}
+    key = []
+    for var in sorted(margins):
+        if var == 'totalpop':
+            continue
+        val = margins[var]
+        if isinstance(val, dict):
+            key.append((var, var in members, tuple(sorted(val.keys()))))
+        else:
+            key.append((var, var in members, None))
+    return tuple(key)
+
+
+def factorize(values):
+    """
+    Returns the sorted distinct values of a categorical variable and the integer code of every
+    observation
+
+    Parameters
+    ----------
+    values : array or tuple of arrays
+             values of the variable. A tuple of arrays is a crossed variable whose categories
+             are the tuples of the values of its components
+    """
+    if not isinstance(values, tuple):
+        uniques, codes = np.unique(np.asarray(values), return_inverse = True)
+        return uniques.tolist(), codes
+    factors = [factorize(component) for component in values]
+    shape = [max(len(labels), 1) for labels, codes in factors]
+    crossed = np.ravel_multi_index([codes for labels, codes in factors], shape)
+    # Only the combinations present in the data are kept
+    uniques, codes = np.unique(crossed, return_inverse = True)
+    positions = np.unravel_index(uniques, shape)
+    labels = zip(*[[component_labels[position] for position in component_positions]
+                   for (component_labels, component_codes), component_positions in zip(factors, positions)])
+    return labels, codes
+
+
+def get_newton_step(hessian, gap):
+    """
+    Returns the solution of hessian.step = - gap
+
+    The hessian is first scaled to a unit diagonal (Jacobi scaling), so that margins of very
+    different magnitudes (counts and totals in euros) are solved with the same relative
+    precision. The scaled hessian is singular when margins are collinear (the categories of a
+    variable add up to the population): a negligible ridge makes it positive definite, so that
+    it can be factorized instead of pseudo inverted. Large hessians (margins with hundreds or
+    thousands of categories) are mostly empty and are factorized as sparse matrices.
+    """
+    if sparse.issparse(hessian) and hessian.shape[0] <= DENSE_HESSIAN_SIZE:
+        hessian = hessian.toarray()
+    diagonal = hessian.diagonal()
+    # Columns without any weighted observation are left unscaled
+    jacobi = 1/np.sqrt(np.where(diagonal > 0, diagonal, 1))
+    ridge = 1e-10
+    if sparse.issparse(hessian):
+        scaling = sparse.diags(jacobi)
+        scaled = scaling.dot(hessian).dot(scaling)
+    else:
+        scaled = jacobi[:, np.newaxis]*hessian*jacobi[np.newaxis, :]
+    try:
+        if sparse.issparse(scaled):
+            step = - jacobi*spsolve((scaled + ridge*sparse.identity(len(gap))).tocsc(), jacobi*gap)
+        else:
+            factor = linalg.cho_factor(scaled + ridge*np.eye(len(gap)), check_finite = False)
+            step = - jacobi*linalg.cho_solve(factor, jacobi*gap, check_finite = False)
+        if np.isfinite(step).all():
+            return step
+    except linalg.LinAlgError:
+        pass
+    if sparse.issparse(scaled):
+        scaled = scaled.toarray()
+    return - jacobi*np.linalg.pinv(scaled, rcond = 1e-12).dot(jacobi*gap)
+
+
+class CalmarEngine(object):
+    """
+    Calibrates weights on margins with Newton iterations on a sparse design matrix
+
+    The design matrix (one dummy column per category of the categorical margins, one dense column
+    per total and one column for the total population) is built once by set_data and reused
+    by every subsequent call to solve.
+    """
+    def __init__(self):
+        super(CalmarEngine, self).__init__()
+        self.weights_init = None
+        self.weights_original = None
+        self.valid = None
+        self.design = None
+        self.constraints = None
+        self.design_key = None
+        self.members = []
+        self.lambdasol = None
+        self.iterations = 0
+        self.trace = []
+
+    def __repr__(self):
+        return '%s \n constraints %s ' % (self.__class__.__name__, self.constraints)
+
+    def set_data(self, data, margins, pondini, members = None):
+        """
+        Builds the design matrix
+
+        Parameters
+        ----------
+        data : dict
+               Arrays of the observations indexed by variable name (same as calmar). A crossed
+               categorical variable is given as a tuple of arrays and its categories are tuples
+        margins : dict
+                  Variables and their margins. A scalar for numeric variables and a dict with
+                  categories key and population
+        pondini : str
+                  name of the initial weight variable in data
+        members : dict, default None
+                  For the variables given at the members level (individuals), the position of the
+                  observation each member belongs to. The column of such a variable holds the
+                  number of members in each category (or the sum of the members values), so that
+                  the weights of the observations also fit the members margins (integrated
+                  calibration)
+        """
+        if members is None:
+            members = {}
+        weights_init = np.asarray(data[pondini], dtype = float)
+        self.weights_original = weights_init
+        self.valid = np.isfinite(weights_init) & (weights_init > 0)
+        self.weights_init = np.where(self.valid, weights_init, 0)
+        nk = len(weights_init)
+
+        columns = []
+        constraints = []
+        for var, val in sorted(margins.iteritems()):
+            if var == 'totalpop':
+                continue
+            if var not in data:
+                raise Exception("calmar: variable %s is missing from data" % var)
+            if var in members:
+                owners = np.asarray(members[var])
+            else:
+                owners = np.arange(nk)
+            if isinstance(val, dict):
+                categories = sorted(val.keys())
+                labels, codes = factorize(data[var])
+                column_by_code = -np.ones(len(labels), dtype = int)
+                position_by_label = dict((label, position) for position, label in enumerate(labels))
+                for j, category in enumerate(categories):
+                    if category not in position_by_label:
+                        raise Exception("calmar: category %s of variable %s is absent from data" % (category, var))
+                    column_by_code[position_by_label[category]] = j
+                column = column_by_code[codes]
+                selected = np.flatnonzero(column >= 0)
+                # Duplicated (row, column) entries of members are summed into counts
+                columns.append(sparse.csc_matrix((np.ones(len(selected)), (owners[selected], column[selected])),
+                                                 shape = (nk, len(categories))))
+                constraints += [(var, category) for category in categories]
+            else:
+                values = np.asarray(data[var], dtype = float)
+                columns.append(sparse.csc_matrix((values, (owners, np.zeros(len(owners), dtype = int))),
+                                                 shape = (nk, 1)))
+                constraints.append((var, None))
+
+        columns.append(sparse.csc_matrix(np.ones((nk, 1))))
+        constraints.append((POPULATION, None))
+
+        self.design = sparse.hstack(columns, format = 'csc')
+        self.constraints = constraints
+        self.design_key = get_design_key(margins, members)
+        self.members = sorted(members)
+        self.lambdasol = None
+
+    def get_targets(self, margins, param = {}):
+        """
+        Returns the vector of targets matching the design columns and the margins actually used
+
+        Categorical margins inconsistent with the total population are rescaled when
+        param['use_proportions'] is True (as calmar does). Members level margins count members,
+        not observations, and are left as they are.
+        """
+        if 'totalpop' in margins:
+            totalpop = margins['totalpop']
+        else:
+            totalpop = self.weights_init.sum()
+        use_proportions = param.get('use_proportions', False)
+
+        margins_new = {}
+        for var, val in margins.iteritems():
+            if var == 'totalpop':
+                continue
+            if isinstance(val, dict):
+                pop = sum(val.values())
+                ratio = 1
+                # Sums of many categories are compared up to rounding errors
+                if abs(pop - totalpop) > 1e-9*abs(totalpop) and var not in self.members:
+                    if use_proportions:
+                        warnings.warn('calmar: categorical variable %s is inconsistent with population; using proportions' % var)
+                        ratio = totalpop/pop
+                    else:
+                        raise Exception('calmar: categorical variable %s is inconsistent with population' % var)
+                margins_new[var] = dict((category, nb*ratio) for category, nb in val.iteritems())
+            else:
+                margins_new[var] = val
+
+        targets = np.empty(len(self.constraints))
+        for j, (var, category) in enumerate(self.constraints):
+            if var == POPULATION:
+                targets[j] = totalpop
+            elif category is None:
+                targets[j] = margins_new[var]
+            else:
+                targets[j] = margins_new[var][category]
+        return targets, margins_new
+
+    def get_margins(self, weights):
+        """
+        Returns the margins reached with the given weights as a dict shaped like the margins
+        """
+        totals = self.design.T.dot(np.asarray(weights, dtype = float))
+        margins = {}
+        for (var, category), total in zip(self.constraints, totals):
+            if var == POPULATION:
+                continue
+            if category is None:
+                margins[var] = total
+            else:
+                margins.setdefault(var, {})[category] = total
+        return margins
+
+    def solve(self, margins, param = {}, lambda0 = None):
+        """
+        Runs the Newton iterations
+
+        Parameters
+        ----------
+        margins : dict
+                  Variables and their margins (same structure as the one given to set_data)
+        param : dict
+                parameters of the calibration: 'method', 'lo', 'up', 'use_proportions',
+                'xtol' (relative precision on margins) and 'maxiter'
+        lambda0 : array, default None
+                  initial Lagrange multipliers
+
+        Returns
+        -------
+        pondfin : array
+                  calibrated weights
+        lambdasol : array
+                    Lagrange multipliers
+        margins_new : dict
+                      margins actually targeted
+        """
+        if self.design is None:
+            raise Exception("calmar: set_data should be called before solve")
+        if get_design_key(margins, dict.fromkeys(self.members)) != self.design_key:
+            raise Exception("calmar: margins do not match the design matrix")
+
+        F, F_prime = get_distance_functions(param)
+        primitive = get_distance_primitive(param)
+        xtol = param.get('xtol', 1e-6)
+        maxiter = param.get('maxiter', 100)
+
+        d = self.weights_init
+        targets, margins_new = self.get_targets(margins, param)
+        # Every column is divided by its target, so that counts and totals in euros weigh the
+        # same in the newton system and in the convergence criterion
+        scale = np.where(targets != 0, np.abs(targets), 1)
+        x = self.design.dot(sparse.diags(1/scale)).tocsc()
+        xt = x.T.tocsr()
+        targets = targets/scale
+
+        if lambda0 is None:
+            lambdasol = np.zeros(len(targets))
+        else:
+            lambdasol = np.array(lambda0, dtype = float)*scale
+
+        def evaluate(lambdas):
+            u = x.dot(lambdas)
+            gap = xt.dot(d*F(u)) - targets
+            return u, gap, d.dot(primitive(u)) - lambdas.dot(targets)
+
+        self.trace = []
+        start = time.time()
+        u, gap, objective = evaluate(lambdasol)
+        self.record_iteration(0, gap, F(u), time.time() - start)
+        iterations = 0
+        while np.abs(gap).max() > xtol:
+            if iterations >= maxiter:
+                raise Exception("calmar: no convergence after %s iterations (%s)"
+                                % (iterations, self.describe_gap(gap)))
+            start = time.time()
+            hessian = xt.dot(sparse.diags(d*F_prime(u)).dot(x))
+            step = get_newton_step(hessian, gap)
+            # Backtracking line search on the dual objective (Armijo condition). Close to the
+            # solution its decrease is lost in rounding errors, and a step reducing the margins
+            # gap is then accepted
+            rounding = 1e-12*(abs(objective) + d.sum())
+            for halving in range(30):
+                candidate = lambdasol + step
+                # Overflowing candidates are rejected
+                with np.errstate(over = 'ignore', invalid = 'ignore'):
+                    u_candidate, gap_candidate, objective_candidate = evaluate(candidate)
+                if np.isfinite(objective_candidate) and np.isfinite(gap_candidate).all():
+                    if objective_candidate <= objective + 1e-4*gap.dot(step):
+                        break
+                    if (objective_candidate <= objective + rounding
+                            and gap_candidate.dot(gap_candidate) < gap.dot(gap)):
+                        break
+                step = step/2
+            else:
+                raise Exception("calmar: line search failed after %s iterations (%s)"
+                                % (iterations, self.describe_gap(gap)))
+            lambdasol, u, gap, objective = candidate, u_candidate, gap_candidate, objective_candidate
+            iterations += 1
+            self.record_iteration(iterations, gap, F(u), time.time() - start, halving)
+
+        self.iterations = iterations
+        self.lambdasol = lambdasol/scale
+        # Observations without a valid initial weight are left untouched
+        pondfin = np.where(self.valid, d*F(u), self.weights_original)
+        return pondfin, self.lambdasol, margins_new
+
+    def record_iteration(self, iteration, relative_gap, ratio, duration, halvings = 0):
+        """
+        Appends the convergence statistics of an iteration to the trace
+        """
+        worst = np.abs(relative_gap).argmax()
+        ratio = ratio[self.valid]
+        self.trace.append({'iteration': iteration,
+                           'max_gap': np.abs(relative_gap).max(),
+                           'worst_margin': self.constraints[worst],
+                           'ratio_min': ratio.min() if len(ratio) else np.nan,
+                           'ratio_max': ratio.max() if len(ratio) else np.nan,
+                           'halvings': halvings,
+                           'time': duration})
+
+    def describe_gap(self, relative_gap):
+        """
+        Returns a description of the margin farthest from its target
+        """
+        worst = np.abs(relative_gap).argmax()
+        var, category = self.constraints[worst]
+        if category is not None:
+            var = '%s = %s' % (var, category)
+        return "max relative margin gap %s on %s" % (relative_gap[worst], var)
+
+    def get_trace(self):
+        """
+        Returns the iterations trace of the last solve as a DataFrame
+        """
+        columns = ['iteration', 'max_gap', 'ratio_min', 'ratio_max', 'halvings', 'time', 'worst_margin']
+        return DataFrame(self.trace, columns = columns)
+
+    def solve_replicates(self, replicates, margins, param = {}, chunk_size = None):
+        """
+        Calibrates replicate initial weights on the same margins in batched Newton iterations
+
+        Parameters
+        ----------
+        replicates : array
+                     (R x n) matrix of replicate initial weights
+        margins : dict
+                  Variables and their margins (same structure as the one given to set_data)
+        param : dict
+                parameters of the calibration
+        chunk_size : int, default None
+                     number of replicates solved together. By default, as many replicates as
+                     fit in REPLICATES_MEMORY bytes of working arrays
+
+        Returns
+        -------
+        pondfin : array
+                  (R x n) float32 matrix of calibrated replicate weights
+        """
+        if self.design is None:
+            raise Exception("calmar: set_data should be called before solve_replicates")
+        F, F_prime = get_distance_functions(param)
+        primitive = get_distance_primitive(param)
+        xtol = param.get('xtol', 1e-6)
+        maxiter = param.get('maxiter', 100)
+
+        targets, margins_new = self.get_targets(margins, param)
+        # Same scaling of the design columns as in solve
+        scale = np.where(targets != 0, np.abs(targets), 1)
+        x = self.design.dot(sparse.diags(1/scale)).tocsc()
+        xt = x.T.tocsr()
+        targets = targets/scale
+        nj = x.shape[1]
+
+        replicates = np.asarray(replicates)
+        if chunk_size is None:
+            # About ten float arrays of observations are held for each replicate of a chunk
+            chunk_size = max(1, int(REPLICATES_MEMORY//(10*8*max(replicates.shape[1], 1))))
+
+        def evaluate(d, lambdas):
+            u = x.dot(lambdas.T).T
+            gap = xt.dot((d*F(u)).T).T - targets
+            return u, gap, (d*primitive(u)).sum(axis = 1) - lambdas.dot(targets)
+
+        pondfin = np.empty(replicates.shape, dtype = np.float32)
+        for start in range(0, len(replicates), chunk_size):
+            original = np.asarray(replicates[start:start + chunk_size], dtype = float)
+            valid = np.isfinite(original) & (original > 0)
+            d = np.where(valid, original, 0)
+            if self.lambdasol is not None:
+                lambdas = np.tile(self.lambdasol*scale, (len(d), 1))
+            else:
+                lambdas = np.zeros((len(d), nj))
+            u, gap, objective = evaluate(d, lambdas)
+            iterations = 0
+            active = np.abs(gap).max(axis = 1) > xtol
+            while active.any():
+                if iterations >= maxiter:
+                    raise Exception("calmar: %s replicates did not converge after %s iterations (max relative margin gap %s)"
+                                    % (active.sum(), iterations, np.abs(gap).max()))
+                # The sparse hessian of each replicate costs a product of the design matrix
+                steps = np.zeros((len(d), nj))
+                for r in np.flatnonzero(active):
+                    hessian = xt.dot(sparse.diags(d[r]*F_prime(u[r])).dot(x))
+                    steps[r] = get_newton_step(hessian, gap[r])
+                # Backtracking line searches on the dual objectives, as in solve, independent for
+                # each replicate
+                rounding = 1e-12*(np.abs(objective) + d.sum(axis = 1))
+                pending = active.copy()
+                for halving in range(30):
+                    rows = np.flatnonzero(pending)
+                    candidate = lambdas[rows] + steps[rows]
+                    # Overflowing candidates are rejected
+                    with np.errstate(over = 'ignore', invalid = 'ignore'):
+                        u_candidate, gap_candidate, objective_candidate = evaluate(d[rows], candidate)
+                        armijo = objective_candidate <= objective[rows] + 1e-4*(gap[rows]*steps[rows]).sum(axis = 1)
+                        stalled = ((objective_candidate <= objective[rows] + rounding[rows])
+                                   & ((gap_candidate**2).sum(axis = 1) < (gap[rows]**2).sum(axis = 1)))
+                    accepted = (np.isfinite(objective_candidate) & np.isfinite(gap_candidate).all(axis = 1)
+                                & (armijo | stalled))
+                    improved = rows[accepted]
+                    lambdas[improved] = candidate[accepted]
+                    u[improved], gap[improved], objective[improved] = (u_candidate[accepted],
+                        gap_candidate[accepted], objective_candidate[accepted])
+                    pending[improved] = False
+                    if not pending.any():
+                        break
+                    steps[pending] /= 2
+                else:
+                    raise Exception("calmar: line search failed for %s replicates after %s iterations"
+                                    % (pending.sum(), iterations))
+                iterations += 1
+                active = np.abs(gap).max(axis = 1) > xtol
+            pondfin[start:start + chunk_size] = np.where(valid, d*F(u), original)
+        return pondfin
+
+
+def calmar(data_in, margins, param = {}, pondini = 'wprm_init', members = None):
+    """
+    Calibrates weights according to some margins (drop-in replacement of openfisca_core.calmar)
+
+    Parameters
+    ----------
+    data_in : dict
+              Arrays of the observations indexed by variable name
+    margins : dict
+              Variables and their margins. A scalar for numeric variables and a dict with
+              categories key and population. 'totalpop' key sets the total population
+    param : dict
+            parameters of the calibration
+    pondini : str
+              name of the initial weight variable
+    members : dict, default None
+              position of the observation of each member for the members level variables
+              (see CalmarEngine.set_data)
+
+    Returns
+    -------
+    pondfin, lambdasol, margins_new
+    """
+    if not margins:
+        raise Exception("Calmar requires non empty dict of margins")
+    engine = CalmarEngine()
+    engine.set_data(data_in, margins, pondini, members = members)
+    return engine.solve(margins, param = param)
@@ -0,0 +1,157 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+from pandas import factorize
+from scipy import sparse
+
+
+def same_values(left, right):
+    """
+    Returns True if both arrays hold the same values (missing values included)
+    """
+    left, right = np.asarray(left), np.asarray(right)
+    if left is right:
+        return True
+    if left.shape != right.shape:
+        return False
+    same = left == right
+    if np.all(same):
+        return True
+    return bool(np.all(same | ((left != left) & (right != right))))
+
+
+class GroupIndex(object):
+    """
+    Groups of the observations according to the values of a variable
+
+    The variable is factorized once. The weighted sums of any variable by group are then
+    computed by a single product with a sparse (groups x observations) matrix holding the
+    weights, without any temporary weighted column.
+    """
+    def __init__(self, by, weights = None):
+        super(GroupIndex, self).__init__()
+        self.by = np.asarray(by)
+        codes, groups = factorize(self.by, sort = True)
+        # Observations with a missing group value are left out, as in a pandas groupby
+        self.selected = np.flatnonzero(codes >= 0)
+        self.codes = codes[self.selected]
+        self.groups = np.asarray(groups)
+        self.weights = None
+        self.matrix = None
+        self.totals = None
+        self.set_weights(weights)
+
+    def __repr__(self):
+        return '%s \n groups %s ' % (self.__class__.__name__, self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+    def has_groups(self, by):
+        """
+        Returns True if the observations are grouped according to the given values
+        """
+        return same_values(by, self.by)
+
+    def set_weights(self, weights = None):
+        """
+        Sets the weights of the observations (all ones when weights is None)
+        """
+        n = len(self.by)
+        if weights is None:
+            weights = np.ones(n)
+        weights = np.asarray(weights, dtype = float)
+        if len(weights) != n:
+            raise Exception("GroupIndex: weights should have one value per observation")
+        self.weights = weights
+        self.matrix = sparse.csr_matrix((weights[self.selected], (self.codes, self.selected)),
+                                        shape = (len(self.groups), n))
+        self.totals = np.asarray(self.matrix.sum(axis = 1)).ravel()
+
+    def has_weights(self, weights):
+        """
+        Returns True if the given weights are the ones of the index
+        """
+        return same_values(weights, self.weights)
+
+    def sum(self, values):
+        """
+        Returns the weighted sums of the values by group
+        """
+        return self.matrix.dot(np.asarray(values, dtype = float))
+
+    def mean(self, values):
+        """
+        Returns the weighted means of the values by group
+        """
+        return self.sum(values)/self.totals
+
+    def quantiles(self, values, probabilities):
+        """
+        Returns the weighted quantiles of the values by group
+
+        The observations are sorted once by group and value; the quantile of probability p of
+        a group is the first value at which the cumulated weight reaches p times the weight of
+        the group.
+
+        Parameters
+        ----------
+        values : array
+                 values of the observations
+        probabilities : list
+                        probabilities of the quantiles (0.5 for the median)
+
+        Returns
+        -------
+        quantiles : array
+                    (groups x probabilities) array of quantiles (nan for groups without weight)
+        """
+        values = np.asarray(values, dtype = float)[self.selected]
+        order = np.lexsort((values, self.codes))
+        sorted_values = values[order]
+        cumulated = np.cumsum(self.weights[self.selected][order])
+
+        counts = np.bincount(self.codes, minlength = len(self.groups))
+        stops = np.cumsum(counts)
+        starts = stops - counts
+        last = np.maximum(stops - 1, 0)
+        bases = np.where(starts > 0, cumulated[np.maximum(starts - 1, 0)], 0)
+        totals = np.where(counts > 0, cumulated[last], 0) - bases if len(cumulated) else np.zeros(len(counts))
+
+        probabilities = np.asarray(probabilities, dtype = float)
+        targets = bases[:, np.newaxis] + probabilities[np.newaxis, :]*totals[:, np.newaxis]
+        positions = np.searchsorted(cumulated, targets.ravel()).reshape(targets.shape)
+        positions = np.clip(positions, starts[:, np.newaxis], last[:, np.newaxis])
+        quantiles = sorted_values[positions] if len(sorted_values) else np.zeros(targets.shape)
+        quantiles[(counts == 0) | (totals <= 0)] = np.nan
+        return quantiles
+
+    def median(self, values):
+        """
+        Returns the weighted medians of the values by group
+        """
+        return self.quantiles(values, [.5])[:, 0]
@@ -0,0 +1,348 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+from pandas import DataFrame, concat
+
+
+class IncomeDistribution(object):
+    """
+    Inequality and poverty indicators of a weighted income distribution
+
+    The incomes are sorted once (a sort index computed elsewhere, by WeightedQuantiles for
+    instance, can be given) and the cumulated weights and incomes are shared by all the
+    indicators. Theil and Atkinson indices are computed on positive incomes only.
+
+    Parameters
+    ----------
+    values : array
+             incomes
+    weights : array, default None
+              weights of the observations
+    order : array, default None
+            sort index of the incomes
+    """
+    def __init__(self, values, weights = None, order = None):
+        super(IncomeDistribution, self).__init__()
+        values = np.asarray(values)
+        if weights is None:
+            weights = np.ones(len(values))
+        weights = np.asarray(weights, dtype = float)
+        if order is None:
+            order = np.argsort(values, kind = 'mergesort')
+        self.values = values[order].astype(float)
+        self.weights = weights[order]
+        self.cumulated_weights = np.cumsum(self.weights)
+        self.cumulated_incomes = np.cumsum(self.weights*self.values)
+        self.total_weight = self.cumulated_weights[-1] if len(values) else 0
+        self.total_income = self.cumulated_incomes[-1] if len(values) else 0
+        self.mean = self.total_income/self.total_weight
+        positive = self.values > 0
+        self.positive_values = self.values[positive]
+        self.positive_weights = self.weights[positive]
+
+    def __repr__(self):
+        return '%s \n mean %s \n median %s ' % (self.__class__.__name__, self.mean, self.median())
+
+    def quantile(self, probability):
+        """
+        Returns the first income at which the cumulated weight reaches probability
+        """
+        position = np.searchsorted(self.cumulated_weights, probability*self.total_weight)
+        return self.values[min(position, len(self.values) - 1)]
+
+    def median(self):
+        return self.quantile(.5)
+
+    def lorenz(self, probabilities):
+        """
+        Returns the shares of the total income held by the given shares of the poorest
+        """
+        x = np.concatenate(([0], self.cumulated_weights/self.total_weight))
+        y = np.concatenate(([0], self.cumulated_incomes/self.total_income))
+        return np.interp(probabilities, x, y)
+
+    def gini(self):
+        """
+        Returns the Gini index (same definition as statshelpers.gini)
+        """
+        incomes = self.weights*self.values
+        numerator = (self.weights*(self.cumulated_incomes - .5*incomes)).sum()
+        return 1 - 2*numerator/(self.total_income*self.total_weight)
+
+    def theil(self):
+        """
+        Returns the Theil T index of the positive incomes
+        """
+        weights = self.positive_weights
+        mean = (weights*self.positive_values).sum()/weights.sum()
+        ratios = self.positive_values/mean
+        return (weights*ratios*np.log(ratios)).sum()/weights.sum()
+
+    def atkinson(self, epsilon = 1):
+        """
+        Returns the Atkinson index of the positive incomes for the inequality aversion epsilon
+        """
+        weights = self.positive_weights
+        mean = (weights*self.positive_values).sum()/weights.sum()
+        if epsilon == 1:
+            equivalent = np.exp((weights*np.log(self.positive_values)).sum()/weights.sum())
+        else:
+            power = (weights*(self.positive_values/mean)**(1 - epsilon)).sum()/weights.sum()
+            equivalent = mean*power**(1/(1 - epsilon))
+        return 1 - equivalent/mean
+
+    def quantile_share_ratio(self, share = .2):
+        """
+        Returns the ratio of the income of the richest share to the income of the poorest share
+        (S80/S20 for share = .2)
+        """
+        low, high = self.lorenz([share, 1 - share])
+        return (1 - high)/low
+
+    def poverty(self, thresholds, alphas = (0, 1)):
+        """
+        Returns the Foster-Greer-Thorbecke indices for several poverty lines
+
+        The share of the poor (alpha = 0) and the poverty gap (alpha = 1) are obtained from the
+        cumulated weights and incomes of the incomes below each line.
+
+        Parameters
+        ----------
+        thresholds : list
+                     poverty lines
+        alphas : list, default (0, 1)
+                 poverty aversion parameters
+
+        Returns
+        -------
+        fgt : dict
+              indices indexed by (threshold, alpha)
+        """
+        fgt = {}
+        cumulated_weights = np.concatenate(([0], self.cumulated_weights))
+        cumulated_incomes = np.concatenate(([0], self.cumulated_incomes))
+        for threshold in thresholds:
+            poor = np.searchsorted(self.values, threshold, side = 'left')
+            for alpha in alphas:
+                if alpha == 0:
+                    value = cumulated_weights[poor]
+                elif alpha == 1:
+                    value = (threshold*cumulated_weights[poor] - cumulated_incomes[poor])/threshold
+                else:
+                    gaps = (threshold - self.values[:poor])/threshold
+                    value = (self.weights[:poor]*gaps**alpha).sum()
+                fgt[(threshold, alpha)] = value/self.total_weight
+        return fgt
+
+    def compute(self, epsilons = (.5, 1, 2), median_shares = (.4, .5, .6), alphas = (0, 1, 2)):
+        """
+        Returns the indicators of the distribution
+
+        Parameters
+        ----------
+        epsilons : list, default (.5, 1, 2)
+                   inequality aversions of the Atkinson indices
+        median_shares : list, default (.4, .5, .6)
+                        poverty lines as shares of the median income
+        alphas : list, default (0, 1, 2)
+                 poverty aversions of the Foster-Greer-Thorbecke indices
+
+        Returns
+        -------
+        indicators : dict
+                     indicators indexed by name: 'gini', 'theil', ('atkinson', epsilon),
+                     's80/s20', 'median', ('fgt', share, alpha)
+        """
+        median = self.median()
+        indicators = {'mean': self.mean, 'median': median, 'gini': self.gini(), 'theil': self.theil(),
+                      's80/s20': self.quantile_share_ratio(.2)}
+        for epsilon in epsilons:
+            indicators[('atkinson', epsilon)] = self.atkinson(epsilon)
+        thresholds = [share*median for share in median_shares]
+        fgt = self.poverty(thresholds, alphas)
+        for share, threshold in zip(median_shares, thresholds):
+            for alpha in alphas:
+                indicators[('fgt', share, alpha)] = fgt[(threshold, alpha)]
+        return indicators
+
+
+def get_poisson_replicates(weights, replicates = 200, chunk_size = 50, seed = None):
+    """
+    Yields Poisson bootstrap replicate weights by chunks of (chunk_size x observations)
+
+    Each observation is drawn a Poisson(1) number of times in each replicate. The chunks are
+    generated on the fly so that the whole replicate matrix is never held in memory.
+    """
+    weights = np.asarray(weights, dtype = float)
+    random_state = np.random.RandomState(seed)
+    for start in range(0, replicates, chunk_size):
+        size = min(chunk_size, replicates - start)
+        yield random_state.poisson(1, size = (size, len(weights)))*weights
+
+
+def iter_replicate_chunks(replicate_weights, chunk_size = 50):
+    """
+    Yields chunks of a (replicates x observations) weight matrix, or the chunks of a generator
+    """
+    if isinstance(replicate_weights, np.ndarray):
+        for start in range(0, len(replicate_weights), chunk_size):
+            yield replicate_weights[start:start + chunk_size]
+    else:
+        for chunk in replicate_weights:
+            yield chunk
+
+
+def _at(matrix, positions):
+    """
+    Returns matrix[r, positions[r]] for every row r (0 where the position is -1)
+    """
+    rows = np.arange(len(matrix))
+    return np.where(positions >= 0, matrix[rows, np.maximum(positions, 0)], 0)
+
+
+def compute_replicate_indicators(values, replicate_weights, order = None, epsilons = (.5, 1, 2),
+                                 median_shares = (.4, .5, .6), alphas = (0, 1), quantiles = 10,
+                                 method = 2, chunk_size = 50):
+    """
+    Returns the indicators of IncomeDistribution.compute and the quantiles for every replicate
+
+    The incomes are sorted once; each chunk of replicate weights is processed with cumulated
+    sums along the observations, so that the memory used is a few (chunk_size x observations)
+    arrays.
+
+    Parameters
+    ----------
+    values : array
+             incomes
+    replicate_weights : array or iterable
+                        (replicates x observations) matrix of weights, or iterable of chunks of
+                        such a matrix (get_poisson_replicates for instance)
+    order : array, default None
+            sort index of the incomes
+    epsilons, median_shares, alphas : list
+                                      see IncomeDistribution.compute
+    quantiles : int, default 10
+                number of quantiles (same definition as WeightedQuantiles)
+    method : int, default 2
+             quantile method (see get_cumulated_positions)
+    chunk_size : int, default 50
+                 number of replicates processed together
+
+    Returns
+    -------
+    indicators : DataFrame
+                 one row per replicate, indicators in columns (quantiles as ('quantile', k))
+    """
+    values = np.asarray(values)
+    if order is None:
+        order = np.argsort(values, kind = 'mergesort')
+    x = values[order].astype(float)
+    n = len(x)
+    positive = x > 0
+    positive_x = np.where(positive, x, 0)
+    log_x = np.where(positive, np.log(np.where(positive, x, 1)), 0)
+    breaks = np.linspace(0, 1, quantiles + 1)
+
+    rows = []
+    for chunk in iter_replicate_chunks(replicate_weights, chunk_size):
+        w = np.asarray(chunk, dtype = float)[:, order]
+        cumulated_weights = np.cumsum(w, axis = 1)
+        total_weight = cumulated_weights[:, -1]
+        weighted = w*x
+        cumulated_incomes = np.cumsum(weighted, axis = 1)
+        total_income = cumulated_incomes[:, -1]
+        indicators = {'mean': total_income/total_weight}
+        indicators['gini'] = 1 - 2*(w*(cumulated_incomes - .5*weighted)).sum(axis = 1)/(total_income*total_weight)
+        del weighted
+
+        # Theil and Atkinson indices on positive incomes
+        positive_weight = w.dot(positive.astype(float))
+        positive_mean = w.dot(positive_x)/positive_weight
+        indicators['theil'] = w.dot(positive_x*log_x)/(positive_weight*positive_mean) - np.log(positive_mean)
+        for epsilon in epsilons:
+            if epsilon == 1:
+                equivalent = np.exp(w.dot(log_x)/positive_weight)
+            else:
+                power = w.dot(np.where(positive, np.where(positive, x, 1)**(1 - epsilon), 0))/positive_weight
+                equivalent = power**(1/(1 - epsilon))
+            indicators[('atkinson', epsilon)] = 1 - equivalent/positive_mean
+
+        # Median and Lorenz shares from the first observation reaching the cumulated weight
+        median_position = np.minimum((cumulated_weights < .5*total_weight[:, np.newaxis]).sum(axis = 1), n - 1)
+        median = x[median_position]
+        indicators['median'] = median
+        shares = []
+        for share in [.2, .8]:
+            target = share*total_weight
+            high = np.minimum((cumulated_weights < target[:, np.newaxis]).sum(axis = 1), n - 1)
+            low_weight, low_income = _at(cumulated_weights, high - 1), _at(cumulated_incomes, high - 1)
+            high_weight, high_income = _at(cumulated_weights, high), _at(cumulated_incomes, high)
+            span = high_weight - low_weight
+            fraction = np.where(span > 0, (target - low_weight)/np.where(span > 0, span, 1), 0)
+            shares.append((low_income + fraction*(high_income - low_income))/total_income)
+        indicators['s80/s20'] = (1 - shares[1])/shares[0]
+
+        # Poverty indices at shares of the median of each replicate
+        cumulated_squares = np.cumsum(w*x*x, axis = 1) if any(alpha == 2 for alpha in alphas) else None
+        for share in median_shares:
+            threshold = share*median
+            poor = np.searchsorted(x, threshold, side = 'left') - 1
+            poor_weight, poor_income = _at(cumulated_weights, poor), _at(cumulated_incomes, poor)
+            for alpha in alphas:
+                if alpha == 0:
+                    value = poor_weight
+                elif alpha == 1:
+                    value = poor_weight - poor_income/threshold
+                elif alpha == 2:
+                    value = poor_weight - 2*poor_income/threshold + _at(cumulated_squares, poor)/threshold**2
+                else:
+                    gaps = np.clip((threshold[:, np.newaxis] - x)/threshold[:, np.newaxis], 0, None)
+                    value = (w*gaps**alpha).sum(axis = 1)
+                indicators[('fgt', share, alpha)] = value/total_weight
+
+        # Quantiles, with the interpolation of WeightedQuantiles
+        if method == 1:
+            positions = (cumulated_weights - .5*w)/total_weight[:, np.newaxis]
+        else:
+            positions = np.empty(w.shape)
+            positions[:, 0] = 0
+            positions[:, 1:] = np.arange(1, n)*w[:, 1:] + (n - 1)*cumulated_weights[:, :-1]
+            positions /= positions[:, -1:]
+        del cumulated_weights, cumulated_incomes, cumulated_squares
+        for k, brk in enumerate(breaks):
+            low = np.clip((positions <= brk).sum(axis = 1) - 1, 0, n - 1)
+            high = np.minimum(low + 1, n - 1)
+            low = np.where(brk >= positions[:, -1], n - 1, np.where(brk <= positions[:, 0], 0, low))
+            high = np.where(brk >= positions[:, -1], n - 1, np.where(brk <= positions[:, 0], 0, high))
+            low_position, high_position = _at(positions, low), _at(positions, high)
+            span = high_position - low_position
+            fraction = np.where(span > 0, (brk - low_position)/np.where(span > 0, span, 1), 0)
+            indicators[('quantile', k)] = x[low] + fraction*(x[high] - x[low])
+        del positions
+        rows.append(DataFrame(indicators))
+
+    return concat(rows, ignore_index = True)
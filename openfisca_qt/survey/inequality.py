@@ -0,0 +1,356 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# Inequality and poverty indicators of the standards of living of a survey simulation, without
+# any GUI dependency (shared by the inequality widget and the batch runners)
+
+
+from __future__ import division
+
+from datetime import datetime
+
+import numpy as np
+from openfisca_core.simulations import SurveySimulation
+from pandas import DataFrame, concat
+
+from ..gui.baseconfig import get_translation
+from . import model
+from .indicators import IncomeDistribution, compute_replicate_indicators, get_poisson_replicates, iter_replicate_chunks
+from .quantiles import WeightedQuantiles
+from .streaming import DistributionAccumulator
+
+
+_ = get_translation('openfisca_qt')
+
+
+def get_indicator_label(key):
+    """
+    Returns the label of an indicator of IncomeDistribution.compute or compute_replicate_indicators
+    """
+    labels = {'mean': u"Moyenne", 'median': _("Median"), 'gini': _("Gini index"), 'theil': _("Theil index"),
+              's80/s20': u"S80/S20"}
+    if key in labels:
+        return labels[key]
+    if key[0] == 'quantile':
+        return 'D' + str(key[1])
+    if key[0] == 'atkinson':
+        return _("Atkinson index (%s)") % key[1]
+    name, share, alpha = key
+    if alpha == 0:
+        return _("Poverty rate (%s%% of median)") % int(round(100*share))
+    if alpha == 1:
+        return _("Poverty gap (%s%% of median)") % int(round(100*share))
+    return "FGT(%s) (%s%%)" % (alpha, int(round(100*share)))
+
+
+class Inequality(object):
+    def __init__(self):
+        super(Inequality, self).__init__()
+        self.simulation = None
+
+        self.data = DataFrame()
+        self.data_default = None
+        self.vars = {'nivvie_ini': ['men'],
+                     'nivvie_net':  ['men'],
+                     'nivvie' : ['men']}
+
+#        self.vars = {'nivvie_prim': ['ind', 'men'],
+#                     'nivvie_init': ['ind', 'men'],
+#                     'nivvie_net':  ['ind', 'men'],
+#                     'nivvie' : ['ind', 'men']}
+        self.gini = None
+        self.inequality_dataframe = None
+        self.poverty = None
+        self.poverty_gap = None
+        self.distributions = {}
+        # Values, weights, filter and entity of the variables of the last computation
+        self.inputs = {}
+        # Sort indices of the variables, reused by every quantile computation. The variables of
+        # an entity share its weights: there is one WeightedQuantiles per entity
+        self.weighted_quantiles = {}
+
+    def set_simulation(self, simulation):
+        """
+        Set simulation
+        """
+        if isinstance(simulation, SurveySimulation):
+            self.simulation = simulation
+        else:
+            raise Exception('Inequality:  %s should be an instance of %s class'  %(simulation, SurveySimulation))
+
+
+    def compute(self, progress = None, chunks = None):
+        """
+        Compute inequality dataframe
+
+        Parameters
+        ----------
+        progress : callable, default None
+                   called with a message before each variable (or chunk) is processed
+        chunks : iterable, default None
+                 chunks of the entity level data (see compute_from_chunks), read from a survey
+                 file by LazyTable.iter_rows for instance. The values of the output table are
+                 used when None
+        """
+        if chunks is not None:
+            self.compute_from_chunks(chunks, progress = progress)
+            return
+        output = self.simulation.output_table
+        final_df = None
+
+        WEIGHT = model.WEIGHT
+        FILTERING_VARS = model.FILTERING_VARS
+        for varname, entities in self.vars.iteritems():
+            if progress is not None:
+                progress(_("Computing inequality indices of %s ...") % varname)
+            for entity in entities:
+                #idx =  output.index[entity]
+
+                val  = output.get_value(varname, entity)
+                weights = output._inputs.get_value(WEIGHT, entity)
+                filter_var_name = FILTERING_VARS[0]
+                filter_var= output._inputs.get_value(filter_var_name, entity)
+
+            self.inputs[varname] = (val, weights, filter_var, entity)
+            # The variable is sorted once for the deciles and the inequality indices
+            weighted_quantiles = self.get_weighted_quantiles(varname)
+            weighted_quantiles.set_weights(weights*filter_var)
+            weighted_quantiles.set_values(varname, val)
+            distribution = IncomeDistribution(val, weights*filter_var,
+                                              order = weighted_quantiles.get_order(varname))
+            self.distributions[varname] = distribution
+
+            deciles = weighted_quantiles.get_quantiles(varname, 10)
+            df = self.get_indicators_frame(varname, distribution, deciles)
+            if final_df is None:
+                final_df = df
+            else:
+                final_df = final_df.merge(df, on='index')
+
+        self.set_results(final_df)
+
+    def get_weighted_quantiles(self, varname):
+        """
+        Returns the weighted quantiles of the entity of a variable computed by compute
+        """
+        entity = self.inputs[varname][3]
+        if entity not in self.weighted_quantiles:
+            self.weighted_quantiles[entity] = WeightedQuantiles(method = 2)
+        return self.weighted_quantiles[entity]
+
+    def compute_from_chunks(self, chunks, accuracy = .001, progress = None):
+        """
+        Compute inequality dataframe from a stream of chunks of entity level data
+
+        The mean, Theil and Atkinson indices are accumulated exactly; the deciles, the Gini index,
+        the S80/S20 ratio and the poverty indicators come from mergeable quantile sketches.
+
+        Parameters
+        ----------
+        chunks : iterable
+                 DataFrames (or dicts of arrays) holding the variables, the weight and the
+                 filtering variable of chunks of the entities
+        accuracy : float, default .001
+                   accuracy of the quantile sketches (see WeightedQuantileSketch)
+        progress : callable, default None
+                   called with a message before each chunk is processed
+        """
+        WEIGHT = model.WEIGHT
+        filter_var_name = model.FILTERING_VARS[0]
+        # The observations are not kept: no confidence intervals nor quantiles grids for streamed data
+        self.inputs = {}
+        self.weighted_quantiles = {}
+        accumulators = dict((varname, DistributionAccumulator(epsilons = (1,), accuracy = accuracy))
+                            for varname in self.vars)
+        for count, chunk in enumerate(chunks):
+            if progress is not None:
+                progress(_("Computing inequality indices (chunk %s) ...") % (count + 1))
+            weights = np.asarray(chunk[WEIGHT])*np.asarray(chunk[filter_var_name])
+            for varname, accumulator in accumulators.iteritems():
+                accumulator.update(chunk[varname], weights)
+
+        final_df = None
+        for varname, accumulator in accumulators.iteritems():
+            self.distributions[varname] = accumulator
+            deciles = accumulator.sketch.get_quantiles(10)
+            df = self.get_indicators_frame(varname, accumulator, deciles)
+            if final_df is None:
+                final_df = df
+            else:
+                final_df = final_df.merge(df, on='index')
+
+        self.set_results(final_df)
+
+    def get_indicators_frame(self, varname, distribution, deciles):
+        """
+        Returns the frame of the mean, the deciles and the inequality indices of a variable
+        """
+        items = []
+        # Compute mean
+        items.append( ("Moyenne",  [distribution.mean]))
+
+        labels = [ 'D'+str(d) for d in range(1,11)]
+        for l, v in zip(labels[:-1],deciles[1:-1]):
+            items.append( (l, [v]))
+
+        # Compute inequality indices
+        items.append( ( _("Gini index"), [distribution.gini()]))
+        items.append( ( _("Theil index"), [distribution.theil()]))
+        items.append( ( _("Atkinson index (%s)") % 1, [distribution.atkinson(1)]))
+        items.append( ( "S80/S20", [distribution.quantile_share_ratio(.2)]))
+
+        df = DataFrame.from_items(items, orient = 'index', columns = [varname])
+        return df.reset_index()
+
+    def set_results(self, final_df):
+        """
+        Sets the inequality dataframe and the poverty indicators from the distributions
+        """
+        final_df[u"Initial à net"] = (final_df['nivvie_net']-final_df['nivvie_ini'])/final_df['nivvie_ini']
+        final_df[u"Net à disponible"] = (final_df['nivvie']-final_df['nivvie_net'])/final_df['nivvie_net']
+        final_df = final_df[['index','nivvie_ini', u"Initial à net", 'nivvie_net',u"Net à disponible",'nivvie']]
+        self.inequality_dataframe = final_df
+
+        # poverty lines are computed from the median of nivvie
+        poverty = dict()
+        poverty_gap = dict()
+        distribution = self.distributions["nivvie"]
+        median = distribution.median()
+        percentages = [40, 50, 60]
+        fgt = distribution.poverty([percentage*median/100 for percentage in percentages], alphas = [0, 1])
+        for percentage in percentages:
+            poverty[percentage] = fgt[(percentage*median/100, 0)]
+            poverty_gap[percentage] = fgt[(percentage*median/100, 1)]
+
+        self.poverty = poverty
+        self.poverty_gap = poverty_gap
+
+    def compute_confidence_intervals(self, replicate_weights = None, replicates = 200, level = .95,
+                                     chunk_size = 50, seed = None):
+        """
+        Returns bootstrap confidence intervals of the indicators of the variables computed by compute
+
+        Every variable is sorted once and the indicators of all the replicates are computed by
+        chunks of replicates, which bounds the memory used. The replicates are drawn (or read)
+        once by entity and used for all the variables of the entity.
+
+        Parameters
+        ----------
+        replicate_weights : array or dict, default None
+                            (replicates x entities) matrix of replicate weights (calibrated
+                            bootstrap weights for instance) of the entity of the variables, or
+                            dict of such matrices indexed by entity. Poisson bootstrap weights
+                            of every entity are generated when None
+        replicates : int, default 200
+                     number of generated replicates
+        level : float, default .95
+                level of the confidence intervals
+        chunk_size : int, default 50
+                     number of replicates processed together
+        seed : int, default None
+               seed of the generated replicates
+
+        Returns
+        -------
+        intervals : dict
+                    DataFrame of the estimate, standard error and bounds of every indicator,
+                    indexed by variable
+        """
+        if not self.inputs:
+            raise Exception('Inequality: compute should be called before compute_confidence_intervals')
+        varnames = sorted(self.inputs)
+        entities = sorted(set(self.inputs[varname][3] for varname in varnames))
+        if replicate_weights is not None and not isinstance(replicate_weights, dict):
+            if len(entities) > 1:
+                raise Exception('Inequality: replicate weights are needed for each of the entities %s' % entities)
+            replicate_weights = {entities[0]: replicate_weights}
+
+        results = dict((varname, []) for varname in varnames)
+        for entity in entities:
+            entity_varnames = [varname for varname in varnames if self.inputs[varname][3] == entity]
+            weights = self.inputs[entity_varnames[0]][1]
+            if replicate_weights is None:
+                chunks = get_poisson_replicates(weights, replicates, chunk_size, seed)
+            elif entity not in replicate_weights:
+                raise Exception('Inequality: no replicate weights for entity %s' % entity)
+            else:
+                entity_replicate_weights = np.asarray(replicate_weights[entity])
+                if entity_replicate_weights.shape[1] != len(weights):
+                    raise Exception('Inequality: replicate weights of entity %s should have one column per %s'
+                                    % (entity, entity))
+                chunks = iter_replicate_chunks(entity_replicate_weights, chunk_size)
+
+            # Each chunk of replicates is used for all the variables of the entity
+            for chunk in chunks:
+                for varname in entity_varnames:
+                    val, weights, filter_var, entity = self.inputs[varname]
+                    results[varname].append(compute_replicate_indicators(val, chunk*filter_var,
+                                                order = self.get_weighted_quantiles(varname).get_order(varname),
+                                                alphas = (0, 1), chunk_size = chunk_size))
+
+        intervals = {}
+        for varname in varnames:
+            replicated = concat(results[varname], ignore_index = True)
+            estimates = self.distributions[varname].compute(alphas = (0, 1))
+            thresholds = self.get_weighted_quantiles(varname).get_quantiles(varname, 10)
+            keys = [key for key in replicated.columns if key not in [('quantile', 0), ('quantile', 10)]]
+            ranks = ['mean', 'median', 'quantile', 'gini', 'theil', 'atkinson', 's80/s20', 'fgt']
+            keys.sort(key = lambda key: (ranks.index(key if isinstance(key, basestring) else key[0]), key))
+            rows = []
+            for key in keys:
+                estimate = thresholds[key[1]] if key[0] == 'quantile' else estimates[key]
+                values = replicated[key].values
+                rows.append((get_indicator_label(key), [estimate, np.nanstd(values, ddof = 1),
+                                                        np.nanpercentile(values, 50*(1 - level)),
+                                                        np.nanpercentile(values, 50*(1 + level))]))
+            intervals[varname] = DataFrame.from_items(rows, orient = 'index',
+                                                      columns = ['estimate', 'std', 'lower', 'upper'])
+        return intervals
+
+    def get_quantiles(self, grids = (10, 20, 100)):
+        """
+        Returns the thresholds of the quantiles of the variables (computed by compute)
+
+        Parameters
+        ----------
+        grids : list, default (10, 20, 100)
+                numbers of quantiles (deciles, ventiles and centiles by default)
+        """
+        frames = {}
+        for weighted_quantiles in self.weighted_quantiles.itervalues():
+            thresholds = weighted_quantiles.compute(grids = grids)
+            for (varname, quantiles), values in thresholds.iteritems():
+                frames.setdefault(quantiles, {})[varname] = values
+        return dict((quantiles, DataFrame(frame)) for quantiles, frame in frames.iteritems())
+
+    def create_description(self):
+        '''
+        Creates a description dataframe
+        '''
+        now = datetime.now()
+        descr =  [u'OpenFisca',
+                         u'Calculé le %s à %s' % (now.strftime('%d-%m-%Y'), now.strftime('%H:%M')),
+                         u'Système socio-fiscal au %s' % self.simulation.datesim,
+                         u"Données d'enquêtes de l'année %s" %str(self.simulation.survey.survey_year) ]
+        return DataFrame(descr)
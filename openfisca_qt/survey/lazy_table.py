@@ -0,0 +1,226 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+from collections import OrderedDict
+import threading
+
+import numpy as np
+from pandas import DataFrame, HDFStore, Index, Series
+
+from .streaming import get_chunk_bounds
+
+
+ID_COLUMNS = ['noi', 'idmen', 'quimen', 'idfoy', 'quifoy', 'idfam', 'quifam']
+
+
+def get_survey_key(filename, year):
+    """
+    Returns the key of the survey table of a year in a survey file (the closest previous year
+    when the year is not available)
+    """
+    store = HDFStore(filename, 'r')
+    try:
+        keys = [key.lstrip('/') for key in store.keys()]
+    finally:
+        store.close()
+    years = sorted(int(key[-4:]) for key in keys if key.startswith('survey_') and key[-4:].isdigit())
+    if not years:
+        raise Exception("get_survey_key: no survey table in file %s" % filename)
+    previous = [available for available in years if available <= year]
+    return 'survey_%s' % (previous[-1] if previous else years[0])
+
+
+class LazyTable(object):
+    """
+    Table of a survey HDF5 file whose columns are read on first access
+
+    Only the index and the columns of preload (the id columns by default) are read when the
+    table is opened. The other columns are read when they are requested and kept in memory
+    within a budget in megabytes, the least recently used ones being dropped first. The
+    columns of preload are never dropped.
+
+    Columns of a table stored in the fixed format are read one by one from their block; for a
+    table stored in the table format, pandas reads the requested columns with select.
+    """
+    def __init__(self, filename, key, budget = 256, preload = None):
+        super(LazyTable, self).__init__()
+        self.filename = filename
+        self.key = key
+        self.budget = budget
+        self.lock = threading.RLock()
+        self.cache = OrderedDict()
+        self.nbytes = 0
+        self.store = HDFStore(filename, 'r')
+        storer = self.store.get_storer(key)
+        if storer is None:
+            raise Exception("LazyTable: no table %s in file %s" % (key, filename))
+
+        self.is_table = storer.is_table
+        self.locations = {}
+        if self.is_table:
+            columns = list(storer.non_index_axes[0][1])
+            self.index = self.store.select_column(key, 'index')
+        else:
+            node = self.store.get_node(key)
+            columns = list(node.axis0[:])
+            self.index = Index(node.axis1[:])
+            for block in range(storer.nblocks):
+                items = list(getattr(node, 'block%d_items' % block)[:])
+                for position, name in enumerate(items):
+                    self.locations[name] = (block, position, len(items))
+        self.columns = Index(columns)
+
+        if preload is None:
+            preload = ID_COLUMNS
+        self.preload = [name for name in preload if name in self.columns]
+        self.fetch(self.preload)
+
+    def __repr__(self):
+        return '%s \n file %s \n key %s \n columns in memory %s/%s (%.1f MB) ' % (
+            self.__class__.__name__, self.filename, self.key, len(self.cache), len(self.columns),
+            self.nbytes/2**20)
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, name):
+        return name in self.columns
+
+    def __getitem__(self, names):
+        if isinstance(names, basestring):
+            return Series(self.fetch([names])[names], index = self.index, name = names)
+        names = list(names)
+        arrays = self.fetch(names)
+        return DataFrame(OrderedDict((name, arrays[name]) for name in names), index = self.index,
+                         columns = names)
+
+    def close(self):
+        with self.lock:
+            self.store.close()
+            self.cache = OrderedDict()
+            self.nbytes = 0
+
+    def fetch(self, names):
+        """
+        Returns the values of columns, reading the ones which are not in memory
+
+        Parameters
+        ----------
+        names : list
+                names of the columns
+
+        Returns
+        -------
+        arrays : dict
+                 values indexed by column name
+        """
+        missing = [name for name in names if name not in self.columns]
+        if missing:
+            raise KeyError("LazyTable: columns %s are not in table %s" % (missing, self.key))
+        with self.lock:
+            arrays = {}
+            for name in names:
+                if name in self.cache:
+                    # Most recently used columns are moved to the end
+                    arrays[name] = self.cache[name] = self.cache.pop(name)
+            unread = [name for name in names if name not in arrays]
+            if unread:
+                for name, values in self.read(unread).iteritems():
+                    arrays[name] = values
+                    self.cache[name] = values
+                    self.nbytes += values.nbytes
+            self.evict(keep = names)
+            return arrays
+
+    def iter_rows(self, names, chunks_count = None, chunk_size = None):
+        """
+        Yields DataFrames of chunks of rows of columns, read from the file
+
+        The rows of the columns which are not in memory are read chunk by chunk and are not
+        kept, so that the whole columns are never held in memory (except the columns of Python
+        objects, which are pickled by block)
+
+        Parameters
+        ----------
+        names : list
+                names of the columns
+        chunks_count : int, default None
+                       number of chunks
+        chunk_size : int, default None
+                     number of rows of a chunk (used when chunks_count is None)
+        """
+        missing = [name for name in names if name not in self.columns]
+        if missing:
+            raise KeyError("LazyTable: columns %s are not in table %s" % (missing, self.key))
+        for start, stop in get_chunk_bounds(len(self.index), chunks_count, chunk_size):
+            with self.lock:
+                arrays = dict((name, self.cache[name][start:stop]) for name in names if name in self.cache)
+                unread = [name for name in names if name not in arrays]
+                if unread:
+                    arrays.update(self.read(unread, start, stop))
+            yield DataFrame(OrderedDict((name, arrays[name]) for name in names), index = self.index[start:stop],
+                            columns = names)
+
+    def read(self, names, start = None, stop = None):
+        """
+        Reads columns (or the rows from start to stop of columns) from the file
+        """
+        if self.is_table:
+            frame = self.store.select(self.key, columns = names, start = start, stop = stop)
+            return dict((name, frame[name].values) for name in names)
+
+        node = self.store.get_node(self.key)
+        arrays = {}
+        for name in names:
+            block, position, items_count = self.locations[name]
+            values = getattr(node, 'block%d_values' % block)
+            if values.shape != (len(self.index), items_count) and values.shape != (items_count, len(self.index)):
+                # Python objects are pickled by block
+                if (block, None) not in arrays:
+                    arrays[(block, None)] = np.asarray(values.read()[0])
+                block_values = arrays[(block, None)]
+            else:
+                block_values = values
+            # Only the selected rows are read from the file
+            if block_values.shape == (len(self.index), items_count):
+                arrays[name] = np.asarray(block_values[start:stop, position])
+            else:
+                arrays[name] = np.asarray(block_values[position, start:stop])
+        return dict((name, arrays[name]) for name in names)
+
+    def evict(self, keep = ()):
+        """
+        Drops the least recently used columns until the columns in memory fit in the budget
+        """
+        if self.budget is None:
+            return
+        budget = self.budget*2**20
+        for name in list(self.cache):
+            if self.nbytes <= budget:
+                break
+            if name in self.preload or name in keep:
+                continue
+            self.nbytes -= self.cache.pop(name).nbytes
@@ -0,0 +1,41 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# Survey constants of the country: names of the weights, filtering variables and data directories
+# (the survey plugins used to read them from openfisca_core.model, which is gone)
+
+
+import os
+
+import openfisca_france
+
+
+COUNTRY_DIR = os.path.dirname(os.path.abspath(openfisca_france.__file__))
+DATA_DIR = os.path.join(COUNTRY_DIR, 'data')
+DATA_SOURCES_DIR = os.path.join(DATA_DIR, 'sources')
+
+ENTITIES_INDEX = ['men', 'fam', 'foy']
+FILTERING_VARS = ['champm']
+WEIGHT = 'wprm'
+WEIGHT_INI = 'wprm_init'
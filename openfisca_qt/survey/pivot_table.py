@@ -0,0 +1,609 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# Pivot tables of the survey variables (weighted statistics by category), without any GUI
+# dependency (shared by the distribution widget and the scripts)
+
+
+from __future__ import division
+
+import numpy as np
+from openfisca_core.simulations import SurveySimulation
+from pandas import DataFrame, merge
+
+from ..gui.baseconfig import get_translation
+from . import model
+from .aggregation_cache import AggregationCache
+from .grouped import GroupIndex
+from .streaming import GroupedAccumulator
+
+
+_ = get_translation('openfisca_qt')
+
+
+DEFAULT_COLUMN_SPEC = {'data': ['current', 'default'], 'transform': ['mean'], 'diff': []}
+# Labels of the suffixes of the columns names of the pivot table
+COLUMN_SUFFIX_LABELS = {'init': u"init.", 'median': u"médiane", 'diff': u"écart", 'reldiff': u"écart relatif",
+                        'winners': u"gagnants", 'loosers': u"perdants"}
+
+
+def get_quantile_probability(transform):
+    '''
+    Returns the probability of a quantile transform ('median', 'q10', 'q90', ...) or None
+    '''
+    if transform == 'median':
+        return .5
+    if transform.startswith('q') and transform[1:].isdigit():
+        return int(transform[1:])/100
+    return None
+
+
+def get_column_name(varname, transform = 'mean', suffix = None):
+    '''
+    Returns the name of the column of a statistic of a variable
+    '''
+    name = varname
+    if transform != 'mean':
+        name += '__' + transform
+    if suffix is not None:
+        name += '__' + suffix
+    return name
+
+
+class OpenfiscaPivotTable(object):
+    def __init__(self):
+        super(OpenfiscaPivotTable, self).__init__()
+
+        self.data = DataFrame() # Pandas DataFrame
+        self.data_default   = None
+        self.by_var_choices = None
+        self.aggregation_cache = None
+
+        # List of variable entering the level 0 (rows) index
+        self.row_index = None
+
+        # Dict of variables in the level 1 (columns)
+        # exemple { revdisp : { data : [ 'current', 'default'], transform : ['mean', 'median'],  diff: ['absolute', 'relative', 'winners', 'loosers']
+        # Variables not in the dict get DEFAULT_COLUMN_SPEC (means of both datasets)
+        self.columns = {}
+
+        # Group index reused by the aligned diff mode. It is replaced, never modified, since the
+        # tables may be computed in several threads
+        self.aligned_index = None
+
+    def set_column_spec(self, varname, data = None, transform = None, diff = None):
+        """
+        Sets the statistics of a variable shown in the columns of the table
+
+        Parameters
+        ----------
+
+        varname : str
+                  name of the variable
+        data : list, default ['current', 'default']
+               datasets whose statistics are shown
+        transform : list, default ['mean']
+                    statistics by group: 'mean', 'median' or quantiles 'q10', 'q25', ...
+        diff : list, default []
+               comparisons of the current and default datasets: 'absolute' and 'relative'
+               differences of the statistics, weighted number of 'winners' and 'loosers'
+        """
+        spec = {}
+        for key, value in [('data', data), ('transform', transform), ('diff', diff)]:
+            spec[key] = list(value) if value is not None else list(DEFAULT_COLUMN_SPEC[key])
+        for transform in spec['transform']:
+            if transform != 'mean' and get_quantile_probability(transform) is None:
+                raise Exception('OpenfiscaPivotTable: unknown transform %s' % transform)
+        for diff in spec['diff']:
+            if diff not in ['absolute', 'relative', 'winners', 'loosers']:
+                raise Exception('OpenfiscaPivotTable: unknown diff %s' % diff)
+        self.columns[varname] = spec
+
+    def get_column_spec(self, varname):
+        """
+        Returns the statistics of a variable shown in the columns of the table
+        """
+        return self.columns.get(varname, DEFAULT_COLUMN_SPEC)
+
+
+    def set_simulation(self, simulation):
+        """
+        Set the survey_simulation
+
+        Parameters
+        ----------
+
+        simulation : SurveySimulation
+        """
+        if isinstance(simulation, SurveySimulation):
+            self.simulation = simulation
+            self.by_var_choices = self.simulation.var_list
+            self.aggregation_cache = AggregationCache(simulation)
+        else:
+            raise Exception('OpenfiscaPivotTable:  %s should be an instance of %s class'  %(simulation, SurveySimulation))
+
+    @property
+    def vars(self):
+        return set(self.simulation.var_list)
+
+    def set_data(self, output_data, default=None):
+        self.data = output_data
+        if default is not None:
+            self.data_default = default
+
+        self.wght = self.data[model.WEIGHT]
+
+    def get_table(self, by = None, vars = None, entity = None, champm = True, do_not_use_weights = False,
+                  chunks_count = None, aligned = False, progress = None, store = None, key = None):
+        """
+        Build pivot table dataframe
+
+        Parameters
+        ----------
+
+        by : string, default None
+             Name of the variable against which the selected variables are distributed
+        vars : list, default None
+               Varaibles to be distributed
+        entity : string, default TODO:
+                 Name of the entity at which level varaibles are summed
+        champm : bool default, default True
+                 Use filtering variable champm
+        do_not_use_weights : bool default False
+                             Do not use weights to compute the statistics
+        chunks_count : int, default None
+                       When given, the stored results of the simulation (store and key) are read
+                       by this number of chunks of individual rows, aggregated chunk by chunk and
+                       the statistics are accumulated without building the whole tables (see
+                       get_table_from_chunks)
+        aligned : bool, default False
+                  Aligned diff mode: the current and default values are read as aligned arrays
+                  and all the statistics are computed within the groups of the current data
+                  (see group_by_aligned)
+        progress : callable, default None
+                   called with a message before the aggregation and before the statistics are
+                   computed (see worker.ComputationThread)
+        store : ResultStore, default None
+                store of the results of the simulation, read when chunks_count is given
+        key : str, default None
+              key of the results of the simulation in the store
+        """
+        by_var = by
+        if by_var is None:
+            raise Exception("OpenfiscaPivotTable : get_table needs a 'by' variable")
+
+        if vars is None:
+            raise Exception("OpenfiscaPivotTable : get_table needs a 'vars' variable")
+
+        if champm:
+            initial_set = set([by_var, 'champm'] + list(vars))
+        else:
+            initial_set = set([by_var] + list(vars))
+
+        WEIGHT = model.WEIGHT
+
+        if entity is None:
+            entity = model.ENTITIES_INDEX[0]
+
+        if chunks_count is not None:
+            if store is None or key is None:
+                raise Exception("OpenfiscaPivotTable : the chunked table is read from stored results, give the store and the key")
+            varnames = sorted(initial_set | set([WEIGHT]))
+            entity_varnames = [name for name in varnames
+                               if getattr(self.simulation.io_column_by_name.get(name), 'entity', None) == entity]
+            chunks = store.iter_entity_chunks(key, entity, varnames, entity_varnames, chunks_count = chunks_count)
+            return self.get_table_from_chunks(chunks, by = by_var, vars = vars, champm = champm,
+                                              do_not_use_weights = do_not_use_weights, progress = progress)
+
+        # Only the variables not aggregated since the last computation are aggregated. The cache
+        # is read once, since invalidate may replace it meanwhile
+        aggregation_cache = self.aggregation_cache
+        if progress is not None:
+            progress(_("Aggregating variables by entity ..."))
+        if aligned:
+            arrays = aggregation_cache.get_arrays(entity, initial_set)
+            if progress is not None:
+                progress(_("Computing distribution statistics ..."))
+            aggr = self.group_by_aligned(arrays, vars, by_var, champm = champm,
+                                         do_not_use_weights = do_not_use_weights)
+            return self.format_table({'data': aggr}, by_var)
+
+        data, data_default = aggregation_cache.get(entity, initial_set)
+
+        self.set_data(data, data_default)
+        if progress is not None:
+            progress(_("Computing distribution statistics ..."))
+
+        dist_frame_dict = self.group_by(vars, by_var, champm=champm, do_not_use_weights=do_not_use_weights)
+        return self.format_table(dist_frame_dict, by_var)
+
+    def get_table_from_chunks(self, chunks, by = None, vars = None, champm = True, do_not_use_weights = False,
+                              accuracy = .001, progress = None):
+        """
+        Build pivot table dataframe from a stream of chunks of entity level data
+
+        The whole aggregated data is never held in memory: the weights and weighted sums by
+        group are accumulated exactly chunk by chunk, the quantiles come from mergeable sketches.
+
+        Parameters
+        ----------
+
+        chunks : iterable
+                 chunks of the entity level data: DataFrames, or (data, data_default) tuples of
+                 row aligned DataFrames. They are aggregated from the individual rows by
+                 aggregate_entity_chunks (see ResultStore.iter_entity_chunks)
+        by : string, default None
+             Name of the variable against which the selected variables are distributed
+        vars : list, default None
+               Variables to be distributed
+        champm : bool default, default True
+                 Use filtering variable champm
+        do_not_use_weights : bool default False
+                             Do not use weights to compute the statistics
+        accuracy : float, default .001
+                   accuracy of the quantile sketches (see WeightedQuantileSketch)
+        progress : callable, default None
+                   called with a message before each chunk (see worker.ComputationThread)
+        """
+        if by is None or vars is None:
+            raise Exception("OpenfiscaPivotTable : get_table_from_chunks needs 'by' and 'vars' variables")
+        dist_frame_dict = self.group_by_chunks(chunks, vars, by, champm = champm,
+                                               do_not_use_weights = do_not_use_weights, accuracy = accuracy,
+                                               progress = progress)
+        return self.format_table(dist_frame_dict, by)
+
+    def format_table(self, dist_frame_dict, by_var):
+        """
+        Merges the grouped aggregates of the datasets and labels the columns
+        """
+        WEIGHT = model.WEIGHT
+        frame = None
+        for dist_frame in dist_frame_dict.itervalues():
+            if frame is None:
+                frame = dist_frame.copy()
+            else:
+                try:
+                    dist_frame.pop(WEIGHT)
+                except:
+                    pass
+                frame = merge(frame, dist_frame, on=by_var)
+
+        frame = frame.reset_index(drop=True)
+
+        for col in frame.columns:
+            suffixes = col.split('__')
+            label = self.simulation.io_column_by_name[suffixes.pop(0)].label
+            for suffix in suffixes:
+                if get_quantile_probability(suffix) is not None and suffix != 'median':
+                    label += u" P" + suffix[1:]
+                else:
+                    label += u" " + COLUMN_SUFFIX_LABELS[suffix]
+            frame.rename(columns = { col : label }, inplace = True)
+
+        by_var_column = self.simulation.io_column_by_name[by_var]
+        enum = getattr(by_var_column, 'enum', None)
+        if enum is not None:
+            try:
+                frame[by_var_column.label] = frame[by_var_column.label].apply(lambda x: enum._vars[x])
+            except Exception as e:
+                print "Error in enum in distribution"
+                print e
+        return frame
+
+    def group_by(self, varlist, category, champm=True, do_not_use_weights=False):
+        '''
+        Computes grouped aggregates
+
+        The category variable is factorized once and the statistics of all the variables
+        of both datasets are computed from the same group index when the categories and the
+        weights of the default dataset are the same. The differences between the datasets are
+        computed observation by observation within the groups of the current dataset.
+        '''
+        datasets = {'data': self.data}
+        aggr_dict = {}
+        if self.data_default is not None:
+            datasets['default'] = self.data_default
+
+        WEIGHT = model.WEIGHT
+        index = None
+        for name, data in sorted(datasets.iteritems()):
+            if do_not_use_weights:
+                weights = np.ones(len(data))
+            else:
+                weights = data[WEIGHT].values
+            if champm:
+                weights = weights*data['champm'].values
+
+            by = data[category].values
+            if index is None or not index.has_groups(by):
+                index = GroupIndex(by, weights)
+            elif not index.has_weights(weights):
+                index.set_weights(weights)
+
+            aggr = DataFrame({category: index.groups, WEIGHT: index.totals}, columns = [category, WEIGHT])
+            dataset = 'default' if name == 'default' else 'current'
+            suffix = 'init' if name == 'default' else None
+            for varname in varlist:
+                spec = self.get_column_spec(varname)
+                if dataset not in spec['data']:
+                    continue
+                statistics = self.get_statistics(index, data[varname].values, spec['transform'])
+                for transform in spec['transform']:
+                    aggr[get_column_name(varname, transform, suffix)] = statistics[transform]
+
+            if name == 'data' and self.data_default is not None:
+                self.add_diffs(aggr, index, varlist)
+            aggr_dict[name] = aggr
+
+        return aggr_dict
+
+    def group_by_aligned(self, arrays, varlist, category, champm=True, do_not_use_weights=False):
+        '''
+        Computes the grouped aggregates of both datasets in a single frame
+
+        The current and default values of the variables are aligned arrays over the same
+        entities: the statistics of both datasets are computed within the groups of the current
+        data, with its weights. The weighted sums of all the variables, of their default values
+        and of the winners and loosers indicators are stacked in a buffer and reduced by a single
+        product with the group matrix; no default frame is built nor merged.
+
+        Parameters
+        ----------
+        arrays : dict
+                 (values, default values) indexed by variable, as returned by
+                 AggregationCache.get_arrays
+        '''
+        WEIGHT = model.WEIGHT
+        by = arrays[category][0]
+        if do_not_use_weights:
+            weights = np.ones(len(by))
+        else:
+            weights = arrays[WEIGHT][0]
+        if champm:
+            weights = weights*arrays['champm'][0]
+
+        index = self.aligned_index
+        if index is None or not index.has_groups(by) or not index.has_weights(weights):
+            index = self.aligned_index = GroupIndex(by, weights)
+
+        # Columns of the buffer: the weighted sums of the values, default values and indicators
+        positions = {}
+        for varname in varlist:
+            values, default_values = arrays[varname]
+            if default_values is not None and len(default_values) != len(values):
+                raise Exception('OpenfiscaPivotTable: current and default data of %s are not aligned' % varname)
+            spec = self.get_column_spec(varname)
+            kinds = ['current']
+            if default_values is not None:
+                kinds.append('default')
+                kinds += [diff for diff in ['winners', 'loosers'] if diff in spec['diff']]
+            for kind in kinds:
+                positions[(varname, kind)] = len(positions)
+
+        # The buffers belong to the call
+        buffer = np.empty((len(by), len(positions)))
+        delta = np.empty(len(by))
+        for (varname, kind), position in positions.iteritems():
+            values, default_values = arrays[varname]
+            if kind == 'current':
+                buffer[:, position] = values
+            elif kind == 'default':
+                buffer[:, position] = default_values
+            else:
+                # The differences are computed in place
+                np.subtract(values, default_values, out = delta)
+                if kind == 'winners':
+                    buffer[:, position] = delta > 0
+                else:
+                    buffer[:, position] = delta < 0
+        sums = index.matrix.dot(buffer) if len(positions) else np.zeros((len(index), 0))
+
+        aggr = DataFrame({category: index.groups, WEIGHT: index.totals}, columns = [category, WEIGHT])
+        current, diffs, init = [], [], []
+        for varname in varlist:
+            spec = self.get_column_spec(varname)
+            values, default_values = arrays[varname]
+            statistics = self.get_aligned_statistics(index, sums, positions[(varname, 'current')],
+                                                     values, spec['transform'])
+            if 'current' in spec['data']:
+                current += [(get_column_name(varname, transform), statistics[transform])
+                            for transform in spec['transform']]
+            if default_values is None:
+                continue
+            default_statistics = self.get_aligned_statistics(index, sums, positions[(varname, 'default')],
+                                                             default_values, spec['transform'])
+            if 'default' in spec['data']:
+                init += [(get_column_name(varname, transform, 'init'), default_statistics[transform])
+                         for transform in spec['transform']]
+            for transform in spec['transform']:
+                if 'absolute' in spec['diff']:
+                    diffs.append((get_column_name(varname, transform, 'diff'),
+                                  statistics[transform] - default_statistics[transform]))
+                if 'relative' in spec['diff']:
+                    diffs.append((get_column_name(varname, transform, 'reldiff'),
+                                  (statistics[transform] - default_statistics[transform])/default_statistics[transform]))
+            for diff in ['winners', 'loosers']:
+                if diff in spec['diff']:
+                    diffs.append((varname + '__' + diff, sums[:, positions[(varname, diff)]]))
+        for name, column in current + diffs + init:
+            aggr[name] = column
+        return aggr
+
+    def get_aligned_statistics(self, index, sums, position, values, transforms):
+        '''
+        Returns the statistics of group_by_aligned indexed by transform, the means coming from
+        the column of the reduced buffer
+        '''
+        statistics = {}
+        quantile_transforms = [transform for transform in transforms if transform != 'mean']
+        if quantile_transforms:
+            statistics = self.get_statistics(index, values, quantile_transforms)
+        if 'mean' in transforms:
+            statistics['mean'] = sums[:, position]/index.totals
+        return statistics
+
+    def group_by_chunks(self, chunks, varlist, category, champm=True, do_not_use_weights=False, accuracy=.001,
+                        progress=None):
+        '''
+        Computes the grouped aggregates of group_by from a stream of chunks
+
+        Each dataset has a GroupedAccumulator. The differences between the datasets are
+        accumulated within the groups of the current dataset, as in group_by.
+        '''
+        WEIGHT = model.WEIGHT
+        accumulators = {}
+        for count, chunk in enumerate(chunks):
+            if progress is not None:
+                progress(_("Computing distribution statistics (chunk %s) ...") % (count + 1))
+            data, data_default = chunk if isinstance(chunk, tuple) else (chunk, None)
+            datasets = {'data': data}
+            if data_default is not None:
+                datasets['default'] = data_default
+            for name, data in datasets.iteritems():
+                if do_not_use_weights:
+                    weights = np.ones(len(data))
+                else:
+                    weights = data[WEIGHT].values
+                if champm:
+                    weights = weights*data['champm'].values
+
+                values = dict((varname, data[varname].values) for varname in varlist)
+                quantile_names = [varname for varname in varlist
+                                  if any(get_quantile_probability(transform) is not None
+                                         for transform in self.get_column_spec(varname)['transform'])]
+                if name == 'data' and data_default is not None:
+                    for varname in varlist:
+                        diffs = self.get_column_spec(varname)['diff']
+                        if not diffs:
+                            continue
+                        default_values = data_default[varname].values
+                        if len(default_values) != len(data):
+                            raise Exception('OpenfiscaPivotTable: current and default data of %s are not aligned' % varname)
+                        values[varname + '__default'] = default_values
+                        if varname in quantile_names:
+                            quantile_names.append(varname + '__default')
+                        delta = values[varname] - default_values
+                        values[varname + '__winners'] = delta > 0
+                        values[varname + '__loosers'] = delta < 0
+                if name not in accumulators:
+                    accumulators[name] = GroupedAccumulator(quantile_names, accuracy)
+                accumulators[name].update(data[category].values, weights, values)
+
+        aggr_dict = {}
+        for name, accumulator in sorted(accumulators.iteritems()):
+            aggr = DataFrame({category: accumulator.groups, WEIGHT: accumulator.totals}, columns = [category, WEIGHT])
+            dataset = 'default' if name == 'default' else 'current'
+            suffix = 'init' if name == 'default' else None
+            for varname in varlist:
+                spec = self.get_column_spec(varname)
+                if dataset in spec['data']:
+                    statistics = self.get_statistics(accumulator, varname, spec['transform'])
+                    for transform in spec['transform']:
+                        aggr[get_column_name(varname, transform, suffix)] = statistics[transform]
+                if name != 'data' or varname + '__default' not in accumulator.sums:
+                    continue
+                diffs = spec['diff']
+                statistics = self.get_statistics(accumulator, varname, spec['transform'])
+                default_statistics = self.get_statistics(accumulator, varname + '__default', spec['transform'])
+                for transform in spec['transform']:
+                    if 'absolute' in diffs:
+                        aggr[get_column_name(varname, transform, 'diff')] = statistics[transform] - default_statistics[transform]
+                    if 'relative' in diffs:
+                        aggr[get_column_name(varname, transform, 'reldiff')] = \
+                            (statistics[transform] - default_statistics[transform])/default_statistics[transform]
+                for diff in ['winners', 'loosers']:
+                    if diff in diffs:
+                        aggr[varname + '__' + diff] = accumulator.sum(varname + '__' + diff)
+            aggr_dict[name] = aggr
+        return aggr_dict
+
+    def get_statistics(self, index, values, transforms):
+        '''
+        Returns the statistics of the values by group indexed by transform
+
+        All the quantiles of a variable are computed from a single sort. The index can also be a
+        GroupedAccumulator, the values being then the name of an accumulated variable.
+        '''
+        statistics = {}
+        probabilities = [get_quantile_probability(transform) for transform in transforms]
+        quantile_probabilities = [probability for probability in probabilities if probability is not None]
+        if quantile_probabilities:
+            quantiles = index.quantiles(values, quantile_probabilities)
+        for transform, probability in zip(transforms, probabilities):
+            if probability is None:
+                # Normalizing to have the average
+                statistics[transform] = index.mean(values)
+            else:
+                statistics[transform] = quantiles[:, quantile_probabilities.index(probability)]
+        return statistics
+
+    def add_diffs(self, aggr, index, varlist):
+        '''
+        Adds the differences between the current and default datasets to the aggregates
+        '''
+        for varname in varlist:
+            diffs = self.get_column_spec(varname)['diff']
+            if not diffs:
+                continue
+            values = self.data[varname].values
+            default_values = self.data_default[varname].values
+            if len(values) != len(default_values):
+                raise Exception('OpenfiscaPivotTable: current and default data of %s are not aligned' % varname)
+
+            transforms = self.get_column_spec(varname)['transform']
+            names = [get_column_name(varname, transform) for transform in transforms]
+            if all(name in aggr for name in names):
+                statistics = dict((transform, aggr[name].values) for transform, name in zip(transforms, names))
+            else:
+                statistics = self.get_statistics(index, values, transforms)
+            default_statistics = self.get_statistics(index, default_values, transforms)
+            for transform in transforms:
+                if 'absolute' in diffs:
+                    aggr[get_column_name(varname, transform, 'diff')] = statistics[transform] - default_statistics[transform]
+                if 'relative' in diffs:
+                    aggr[get_column_name(varname, transform, 'reldiff')] = \
+                        (statistics[transform] - default_statistics[transform])/default_statistics[transform]
+
+            if 'winners' in diffs or 'loosers' in diffs:
+                delta = values - default_values
+                if 'winners' in diffs:
+                    aggr[varname + '__winners'] = index.sum(delta > 0)
+                if 'loosers' in diffs:
+                    aggr[varname + '__loosers'] = index.sum(delta < 0)
+
+
+    def invalidate(self):
+        '''
+        Forgets the aggregated variables (to be called when the simulation is computed again)
+
+        The cache is replaced by a new one rather than emptied: a computation of the worker
+        thread may still be reading it
+        '''
+        if self.aggregation_cache is not None:
+            self.aggregation_cache = AggregationCache(self.simulation)
+
+    def clear(self):
+        self.view.clear()
+        self.data = None
+        self.wght = None
@@ -0,0 +1,381 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+
+
+def get_cumulated_positions(sorted_weights, method = 2):
+    """
+    Returns the positions of the sorted observations on the [0, 1] scale of the weighted
+    percentiles (same definitions as mark_weighted_percentiles)
+
+    Parameters
+    ----------
+    sorted_weights : array
+                     weights of the observations sorted by value
+    method : int, default 2
+             1 for the wikipedia definition, 2 for the stats.stackexchange one
+    """
+    cumulated = np.cumsum(sorted_weights, dtype = float)
+    n = len(sorted_weights)
+    if method == 1:
+        return (cumulated - .5*sorted_weights)/cumulated[-1]
+    elif method == 2:
+        positions = np.empty(n)
+        positions[0] = 0
+        positions[1:] = np.arange(1, n)*sorted_weights[1:] + (n - 1)*cumulated[:-1]
+        return positions/positions[-1]
+    raise Exception("method should be 1 or 2")
+
+
+def interpolate_quantiles(sorted_values, positions, breaks):
+    """
+    Returns the values at the given breaks of the percentiles scale, interpolated between the
+    sorted observations (positions as returned by get_cumulated_positions)
+    """
+    n = len(sorted_values)
+    low = np.clip(np.searchsorted(positions, breaks, side = 'right') - 1, 0, n - 1)
+    high = np.minimum(low + 1, n - 1)
+    low[breaks >= positions[-1]] = n - 1
+    high[breaks >= positions[-1]] = n - 1
+    high[breaks <= positions[0]] = low[breaks <= positions[0]] = 0
+    span = positions[high] - positions[low]
+    fraction = np.where(span > 0, (breaks - positions[low])/np.where(span > 0, span, 1), 0)
+    return (sorted_values[low] + fraction*(sorted_values[high] - sorted_values[low])).astype(float)
+
+
+class WeightedQuantiles(object):
+    """
+    Weighted quantiles (deciles, centiles, ...) of several variables sharing the same weights
+
+    Each variable is sorted once: its sort index and the cumulated weights are cached and used
+    for every quantile grid requested. When the values of a variable change (another reform for
+    instance), the new sort starts from the previous order, which is almost sorted already.
+    Values can be given as float32 arrays; they are neither copied nor converted.
+    """
+    def __init__(self, weights = None, method = 2):
+        super(WeightedQuantiles, self).__init__()
+        self.weights = None
+        self.method = method
+        self.values = {}
+        self.orders = {}
+        self.positions = {}
+        if weights is not None:
+            self.set_weights(weights)
+
+    def __repr__(self):
+        return '%s \n variables %s ' % (self.__class__.__name__, sorted(self.values))
+
+    def set_weights(self, weights):
+        """
+        Sets the weights of the observations (the sort indices are kept)
+        """
+        weights = np.asarray(weights)
+        if self.weights is not None and weights.shape == self.weights.shape and np.array_equal(weights, self.weights):
+            return
+        if self.weights is not None and len(weights) != len(self.weights):
+            self.orders = {}
+        self.weights = weights
+        self.positions = {}
+
+    def set_values(self, name, values):
+        """
+        Sets the values of a variable (the variable is sorted again only if they changed)
+        """
+        values = np.asarray(values)
+        if self.weights is not None and len(values) != len(self.weights):
+            raise Exception("WeightedQuantiles: %s should have one value per observation" % name)
+        previous = self.values.get(name)
+        if previous is values:
+            return
+        if previous is not None and previous.shape == values.shape and np.array_equal(previous, values):
+            self.values[name] = values
+            return
+        self.values[name] = values
+        self.positions.pop(name, None)
+        order = self.orders.pop(name, None)
+        if order is not None and len(order) == len(values):
+            # Stable sort of almost sorted values
+            self.orders[name] = order[np.argsort(values[order], kind = 'mergesort')]
+
+    def get_order(self, name):
+        """
+        Returns the sort index of the values of a variable
+        """
+        if name not in self.orders:
+            index_dtype = np.int32 if len(self.values[name]) < 2**31 else np.int64
+            self.orders[name] = np.argsort(self.values[name], kind = 'mergesort').astype(index_dtype)
+        return self.orders[name]
+
+    def get_positions(self, name):
+        """
+        Returns the positions of the sorted observations of a variable on the percentiles scale
+        """
+        if name not in self.positions:
+            if self.weights is None:
+                raise Exception("WeightedQuantiles: weights should be set before computing quantiles")
+            self.positions[name] = get_cumulated_positions(self.weights[self.get_order(name)], self.method)
+        return self.positions[name]
+
+    def get_quantiles(self, name, quantiles = 10):
+        """
+        Returns the thresholds of the quantiles of a variable (quantiles + 1 values from the
+        minimum to the maximum, as mark_weighted_percentiles returns them)
+
+        Parameters
+        ----------
+        name : str
+               name of the variable
+        quantiles : int, default 10
+                    number of quantiles (10 for deciles, 100 for centiles, 20 for ventiles)
+        """
+        sorted_values = self.values[name][self.get_order(name)]
+        return interpolate_quantiles(sorted_values, self.get_positions(name), np.linspace(0, 1, quantiles + 1))
+
+    def get_labels(self, name, quantiles = 10, labels = None):
+        """
+        Returns the quantile label of every observation of a variable (1 to quantiles by default)
+
+        Parameters
+        ----------
+        name : str
+               name of the variable
+        quantiles : int, default 10
+                    number of quantiles
+        labels : list, default None
+                 labels of the quantiles
+        """
+        if labels is None:
+            labels = np.arange(1, quantiles + 1)
+        labels = np.asarray(labels)
+        if len(labels) != quantiles:
+            raise Exception("WeightedQuantiles: %s labels are needed" % quantiles)
+        thresholds = self.get_quantiles(name, quantiles)
+        positions = np.searchsorted(thresholds, self.values[name], side = 'right') - 1
+        return labels[np.clip(positions, 0, quantiles - 1)]
+
+    def compute(self, names = None, grids = (10, 20, 100)):
+        """
+        Returns the thresholds of several quantile grids for several variables
+
+        Parameters
+        ----------
+        names : list, default None
+                variables (all the variables by default)
+        grids : list, default (10, 20, 100)
+                numbers of quantiles (deciles, ventiles and centiles by default)
+
+        Returns
+        -------
+        thresholds : dict
+                     thresholds indexed by (variable, number of quantiles)
+        """
+        if names is None:
+            names = sorted(self.values)
+        thresholds = {}
+        for name in names:
+            for quantiles in grids:
+                thresholds[(name, quantiles)] = self.get_quantiles(name, quantiles)
+        return thresholds
+
+
+class WeightedQuantileSketch(object):
+    """
+    Mergeable summary of a weighted distribution giving approximate quantiles in bounded memory
+
+    The observations are kept as (value, weight) points. Sketches built on separate chunks of
+    observations (or by separate workers) are merged by pooling their points. While there are
+    at most exact_size points, the observations are kept as they are and the quantiles are
+    exact. Beyond, the sorted points are merged, as in a t-digest, into buckets whose share of
+    the total weight is at most accuracy, and smaller in the tails of the distribution; the
+    quantiles are then interpolated between the buckets, with a rank error of the order of
+    accuracy.
+
+    Parameters
+    ----------
+    accuracy : float, default .001
+               bound of the share of the total weight held by a bucket
+    exact_size : int, default 5000
+                 number of observations below which the quantiles are exact
+    """
+    def __init__(self, accuracy = .001, exact_size = 5000):
+        super(WeightedQuantileSketch, self).__init__()
+        if not 0 < accuracy < 1:
+            raise Exception("WeightedQuantileSketch: accuracy should be between 0 and 1")
+        self.accuracy = accuracy
+        # Number of buckets of the arcsine scale such that no bucket exceeds accuracy
+        self.size = int(np.ceil(np.pi/(2*accuracy)))
+        self.exact_size = max(exact_size, 2*self.size)
+        self.values = np.empty(0)
+        self.weights = np.empty(0)
+        self.minimum = np.inf
+        self.maximum = -np.inf
+        self.compressed = False
+        self.is_sorted = True
+
+    def __repr__(self):
+        return '%s \n points %s \n total weight %s \n exact %s ' % (self.__class__.__name__, len(self.values),
+                                                                   self.total_weight, not self.compressed)
+
+    def __len__(self):
+        return len(self.values)
+
+    @property
+    def total_weight(self):
+        return self.weights.sum()
+
+    def update(self, values, weights = None):
+        """
+        Adds observations to the sketch (observations without weight are left out)
+        """
+        values = np.asarray(values, dtype = float).ravel()
+        if weights is None:
+            weights = np.ones(len(values))
+        weights = np.asarray(weights, dtype = float).ravel()
+        if len(weights) != len(values):
+            raise Exception("WeightedQuantileSketch: weights should have one value per observation")
+        selected = weights > 0
+        if not selected.all():
+            values, weights = values[selected], weights[selected]
+        if len(values) == 0:
+            return self
+        self.minimum = min(self.minimum, values.min())
+        self.maximum = max(self.maximum, values.max())
+        self.add_points(values, weights)
+        return self
+
+    def merge(self, other):
+        """
+        Adds the points of another sketch
+        """
+        if len(other.values) == 0:
+            return self
+        self.minimum = min(self.minimum, other.minimum)
+        self.maximum = max(self.maximum, other.maximum)
+        self.compressed = self.compressed or other.compressed
+        self.add_points(other.values, other.weights)
+        return self
+
+    def add_points(self, values, weights):
+        self.values = np.concatenate((self.values, values))
+        self.weights = np.concatenate((self.weights, weights))
+        self.is_sorted = False
+        if len(self.values) > self.exact_size:
+            self.compress()
+
+    def sort(self):
+        if not self.is_sorted:
+            order = np.argsort(self.values, kind = 'mergesort')
+            self.values, self.weights = self.values[order], self.weights[order]
+            self.is_sorted = True
+
+    def compress(self):
+        """
+        Merges the points into buckets of the arcsine scale of the percentiles
+        """
+        self.sort()
+        cumulated = np.cumsum(self.weights)
+        middles = (cumulated - .5*self.weights)/cumulated[-1]
+        scale = self.size*(np.arcsin(2*middles - 1)/np.pi + .5)
+        buckets = np.minimum(scale.astype(int), self.size - 1)
+        weights = np.bincount(buckets, weights = self.weights, minlength = self.size)
+        incomes = np.bincount(buckets, weights = self.weights*self.values, minlength = self.size)
+        kept = weights > 0
+        self.values, self.weights = incomes[kept]/weights[kept], weights[kept]
+        self.compressed = True
+
+    def get_points(self):
+        """
+        Returns the sorted values and the weights of the points of the sketch
+        """
+        self.sort()
+        return self.values, self.weights
+
+    def quantiles(self, probabilities):
+        """
+        Returns the quantiles of the given probabilities (nan when the sketch is empty)
+
+        While the sketch is exact, the quantile of probability p is the first value at which the
+        cumulated weight reaches p times the total weight (as in GroupIndex.quantiles).
+        """
+        probabilities = np.asarray(probabilities, dtype = float)
+        if len(self.values) == 0:
+            return np.repeat(np.nan, len(probabilities))
+        values, weights = self.get_points()
+        cumulated = np.cumsum(weights)
+        targets = probabilities*cumulated[-1]
+        if not self.compressed:
+            positions = np.minimum(np.searchsorted(cumulated, targets), len(values) - 1)
+            return values[positions]
+        return self.interpolate(targets)
+
+    def quantile(self, probability):
+        return self.quantiles([probability])[0]
+
+    def interpolate(self, targets):
+        """
+        Returns the values at the given cumulated weights, interpolated between the middles of
+        the buckets and bounded by the extreme values
+        """
+        values, weights = self.get_points()
+        cumulated = np.cumsum(weights)
+        middles = np.concatenate(([0], cumulated - .5*weights, [cumulated[-1]]))
+        return np.interp(targets, middles, np.concatenate(([self.minimum], values, [self.maximum])))
+
+    def get_quantiles(self, quantiles = 10, method = 2):
+        """
+        Returns the thresholds of the quantiles (quantiles + 1 values from the minimum to the
+        maximum, as WeightedQuantiles.get_quantiles and mark_weighted_percentiles return them)
+
+        Parameters
+        ----------
+        quantiles : int, default 10
+                    number of quantiles (10 for deciles, 100 for centiles, 20 for ventiles)
+        method : int, default 2
+                 method of the exact thresholds (see get_cumulated_positions)
+        """
+        breaks = np.linspace(0, 1, quantiles + 1)
+        if len(self.values) == 0:
+            return np.repeat(np.nan, len(breaks))
+        if not self.compressed:
+            values, weights = self.get_points()
+            return interpolate_quantiles(values, get_cumulated_positions(weights, method), breaks)
+        thresholds = self.interpolate(breaks*self.total_weight)
+        thresholds[0], thresholds[-1] = self.minimum, self.maximum
+        return thresholds
+
+    def get_labels(self, values, quantiles = 10, labels = None, method = 2):
+        """
+        Returns the quantile label of the given values (1 to quantiles by default)
+        """
+        if labels is None:
+            labels = np.arange(1, quantiles + 1)
+        labels = np.asarray(labels)
+        if len(labels) != quantiles:
+            raise Exception("WeightedQuantileSketch: %s labels are needed" % quantiles)
+        thresholds = self.get_quantiles(quantiles, method)
+        positions = np.searchsorted(thresholds, np.asarray(values), side = 'right') - 1
+        return labels[np.clip(positions, 0, quantiles - 1)]
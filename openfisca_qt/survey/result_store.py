@@ -0,0 +1,566 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# Persistent store of the tables of computed survey simulations
+
+
+from __future__ import division
+
+from collections import OrderedDict
+import datetime
+import gzip
+import hashlib
+from itertools import izip
+import json
+import logging
+import os
+import pickle
+import shutil
+
+import numpy as np
+import pkg_resources
+from pandas import DataFrame
+
+from ..gui.baseconfig import get_conf_path
+from .streaming import aggregate_entity_chunks, get_chunk_bounds
+
+
+log = logging.getLogger(__name__)
+
+STORE_VERSION = 1
+
+TABLES = ['input_table', 'output_table', 'output_table_default']
+
+# Hashes of the survey files indexed by (path, size, modification time)
+_file_hashes = {}
+
+
+def get_file_hash(filename, block_size = 2**20):
+    """
+    Returns the sha1 hash of the content of a file (computed once per version of the file)
+    """
+    filename = os.path.abspath(filename)
+    stat = os.stat(filename)
+    file_key = (filename, stat.st_size, stat.st_mtime)
+    if file_key not in _file_hashes:
+        digest = hashlib.sha1()
+        with open(filename, 'rb') as survey_file:
+            block = survey_file.read(block_size)
+            while block:
+                digest.update(block)
+                block = survey_file.read(block_size)
+        _file_hashes[file_key] = digest.hexdigest()
+    return _file_hashes[file_key]
+
+
+def update_fingerprint(digest, value, seen):
+    """
+    Feeds a digest with a canonical description of a value (dictionaries are sorted and objects
+    are described by their class and attributes)
+    """
+    if isinstance(value, np.ndarray):
+        digest.update('array %s %s ' % (value.dtype, value.shape))
+        if value.dtype == object:
+            digest.update(repr(value.tolist()))
+        else:
+            digest.update(np.ascontiguousarray(value).tostring())
+    elif isinstance(value, dict):
+        digest.update('dict ')
+        for item_key, item in sorted(value.iteritems(), key = lambda item: repr(item[0])):
+            digest.update(repr(item_key))
+            update_fingerprint(digest, item, seen)
+    elif isinstance(value, (list, tuple)):
+        digest.update('%s %s ' % (type(value).__name__, len(value)))
+        for item in value:
+            update_fingerprint(digest, item, seen)
+    elif value is None or isinstance(value, (bool, int, long, float, basestring, np.generic,
+                                             datetime.date)):
+        digest.update(repr(value))
+    elif hasattr(value, '__dict__'):
+        if id(value) in seen:
+            digest.update('cycle ')
+            return
+        seen.add(id(value))
+        digest.update('object %s ' % type(value).__name__)
+        update_fingerprint(digest, vars(value), seen)
+    else:
+        digest.update(repr(value))
+
+
+def get_fingerprint(value):
+    """
+    Returns the sha1 fingerprint of a value (parameters of a legislation, ...)
+    """
+    digest = hashlib.sha1()
+    update_fingerprint(digest, value, set())
+    return digest.hexdigest()
+
+
+def get_code_version():
+    """
+    Returns the versions of the installed OpenFisca distributions
+    """
+    versions = ['store %s' % STORE_VERSION]
+    for distribution in ['openfisca-core', 'openfisca-france', 'openfisca-qt']:
+        try:
+            versions.append('%s %s' % (distribution, pkg_resources.require(distribution)[0].version))
+        except Exception:
+            pass
+    return ', '.join(versions)
+
+
+def get_simulation_key(simulation, version = None, options = None):
+    """
+    Returns the fields identifying the results of a survey simulation
+
+    Parameters
+    ----------
+    simulation : SurveySimulation
+                 simulation, configured but not necessarily computed
+    version : str, default None
+              version of the code (the versions of the installed distributions when None)
+    options : object, default None
+              anything else changing the results (inflators of the survey, ...)
+
+    Returns
+    -------
+    fields : dict
+             survey file hash, legislation date, reform fingerprint, code version and options
+             fingerprint
+    """
+    survey_filename = getattr(simulation, 'survey_filename', None)
+    if survey_filename is None or not os.path.isfile(survey_filename):
+        raise Exception("get_simulation_key: the survey file %s of the simulation is not available"
+                        % survey_filename)
+    reform = (getattr(simulation, 'reforme', None), getattr(simulation, 'P', None),
+              getattr(simulation, 'P_default', None))
+    return {'survey': get_file_hash(survey_filename),
+            'datesim': str(simulation.datesim),
+            'reform': get_fingerprint(reform),
+            'version': version if version is not None else get_code_version(),
+            'options': get_fingerprint(options)}
+
+
+class SimulationPickler(pickle.Pickler):
+    """
+    Pickler of a simulation leaving out the DataFrames of its tables, which are stored column by
+    column: they are replaced by the name of their table
+    """
+    def __init__(self, output, tables):
+        pickle.Pickler.__init__(self, output, pickle.HIGHEST_PROTOCOL)
+        self.table_names = dict((id(frame), name) for name, frame in tables.iteritems())
+
+    def persistent_id(self, value):
+        return self.table_names.get(id(value))
+
+
+class SimulationUnpickler(pickle.Unpickler):
+    """
+    Unpickler of the simulations pickled by SimulationPickler, whose tables are left empty
+    """
+    def persistent_load(self, name):
+        return None
+
+
+class ResultStore(object):
+    """
+    Persistent store of the tables of computed survey simulations
+
+    Each computation is stored in its own directory, named after the hash of its key (survey
+    file hash, legislation date, reform fingerprint, code version). The tables are stored
+    column by column in gzip compressed npy files, so that only the requested columns are read.
+    A compressed column is decompressed once in an npy file of the cache sub-directory, which
+    is memory-mapped by the next reads.
+    """
+    def __init__(self, directory = None, compress = True, version = None):
+        super(ResultStore, self).__init__()
+        if directory is None:
+            directory = get_conf_path('results')
+        self.directory = directory
+        self.compress = compress
+        self.version = version
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def __repr__(self):
+        return '%s \n directory %s ' % (self.__class__.__name__, self.directory)
+
+    def get_key(self, simulation, options = None):
+        """
+        Returns the key of the results of a simulation (see get_simulation_key)
+        """
+        fields = get_simulation_key(simulation, self.version, options)
+        return hashlib.sha1(json.dumps(fields, sort_keys = True)).hexdigest()
+
+    def get_path(self, key, *names):
+        return os.path.join(self.directory, key, *names)
+
+    def has(self, key):
+        return os.path.isfile(self.get_path(key, 'manifest.json'))
+
+    def keys(self):
+        return sorted(key for key in os.listdir(self.directory) if self.has(key))
+
+    def remove(self, key):
+        if os.path.isdir(self.get_path(key)):
+            shutil.rmtree(self.get_path(key))
+
+    def get_manifest(self, key):
+        if not self.has(key):
+            raise Exception("ResultStore: no results stored under key %s" % key)
+        with open(self.get_path(key, 'manifest.json')) as manifest_file:
+            return json.load(manifest_file)
+
+    def save(self, simulation, key = None, options = None):
+        """
+        Stores the tables of a computed simulation
+
+        The tables are written in a temporary directory renamed at the end, so that concurrent
+        processes never read a partially written entry.
+
+        Parameters
+        ----------
+        simulation : SurveySimulation
+                     computed simulation
+        key : str, default None
+              key of the results (computed from the simulation when None)
+        options : object, default None
+                  anything else changing the results (see get_simulation_key)
+
+        Returns
+        -------
+        key : str
+        """
+        if key is None:
+            key = self.get_key(simulation, options)
+        temporary = self.get_path('%s.tmp-%s' % (key, os.getpid()))
+        if os.path.isdir(temporary):
+            shutil.rmtree(temporary)
+        os.makedirs(temporary)
+
+        manifest = {'fields': get_simulation_key(simulation, self.version, options), 'tables': {},
+                    'compress': self.compress}
+        tables = {}
+        for name in TABLES:
+            datatable = getattr(simulation, name, None)
+            if datatable is None or getattr(datatable, 'table', None) is None:
+                continue
+            if name == 'output_table_default' and datatable is getattr(simulation, 'output_table', None):
+                continue
+            manifest['tables'][name] = self.write_table(datatable.table, os.path.join(temporary, name))
+            tables[name] = datatable.table
+
+        # The simulation is pickled without its tables, which are restored from the columns. The
+        # tables are left out by the pickler: the simulation itself is not modified
+        try:
+            with open(os.path.join(temporary, 'simulation.pk'), 'wb') as output:
+                SimulationPickler(output, tables).dump(simulation)
+            manifest['simulation'] = True
+        except Exception, e:
+            log.warning("ResultStore: the simulation could not be pickled, only its tables are stored: %s", e)
+            manifest['simulation'] = False
+
+        with open(os.path.join(temporary, 'manifest.json'), 'w') as manifest_file:
+            json.dump(manifest, manifest_file, indent = 1)
+
+        if self.has(key):
+            self.remove(key)
+        try:
+            os.rename(temporary, self.get_path(key))
+        except OSError:
+            # Stored meanwhile by another process
+            shutil.rmtree(temporary)
+        return key
+
+    def write_table(self, frame, directory):
+        """
+        Writes the columns of a DataFrame and returns the description of the table
+        """
+        os.makedirs(directory)
+        extension = '.npy.gz' if self.compress else '.npy'
+        columns = []
+        for position, name in enumerate(frame.columns):
+            filename = '%s%s' % (position, extension)
+            values = np.asarray(frame[name])
+            self.write_column(values, os.path.join(directory, filename))
+            columns.append([name, filename, str(values.dtype)])
+        index = None
+        if not np.array_equal(frame.index.values, np.arange(len(frame))):
+            index = 'index' + extension
+            self.write_column(np.asarray(frame.index), os.path.join(directory, index))
+        return {'columns': columns, 'index': index, 'length': len(frame)}
+
+    def write_column(self, values, filename):
+        if filename.endswith('.gz'):
+            column_file = gzip.open(filename, 'wb', 6)
+            try:
+                np.save(column_file, values)
+            finally:
+                column_file.close()
+        else:
+            np.save(filename, values)
+
+    def read_column(self, key, table, filename, mmap = True):
+        """
+        Returns the values of a column, memory-mapped when mmap is True and the values are not
+        Python objects
+        """
+        path = self.get_path(key, table, filename)
+        if not filename.endswith('.gz'):
+            try:
+                return np.load(path, mmap_mode = 'r' if mmap else None, allow_pickle = False)
+            except ValueError:
+                return np.load(path, allow_pickle = True)
+
+        cache = self.get_path(key, 'cache', table, filename[:-len('.gz')])
+        if mmap and os.path.isfile(cache):
+            return np.load(cache, mmap_mode = 'r')
+        column_file = gzip.open(path, 'rb')
+        try:
+            values = np.load(column_file, allow_pickle = True)
+        finally:
+            column_file.close()
+        if mmap and values.dtype != object:
+            if not os.path.isdir(os.path.dirname(cache)):
+                os.makedirs(os.path.dirname(cache))
+            temporary = '%s.tmp-%s.npy' % (cache[:-len('.npy')], os.getpid())
+            np.save(temporary, values)
+            os.rename(temporary, cache)
+            return np.load(cache, mmap_mode = 'r')
+        return values
+
+    def load_columns(self, key, table = 'output_table', columns = None, mmap = True):
+        """
+        Returns the columns of a stored table without building a DataFrame
+
+        Parameters
+        ----------
+        key : str
+              key of the results
+        table : str, default 'output_table'
+                'input_table', 'output_table' or 'output_table_default'
+        columns : list, default None
+                  names of the columns to read (all the columns when None)
+        mmap : bool, default True
+               memory-map the columns instead of reading them
+
+        Returns
+        -------
+        arrays : dict
+                 values indexed by column name
+        """
+        description = self.get_manifest(key)['tables'].get(table)
+        if description is None:
+            raise Exception("ResultStore: no table %s stored under key %s" % (table, key))
+        filenames = dict((name, filename) for name, filename, dtype in description['columns'])
+        if columns is None:
+            columns = [name for name, filename, dtype in description['columns']]
+        missing = [name for name in columns if name not in filenames]
+        if missing:
+            raise Exception("ResultStore: columns %s are not in table %s" % (missing, table))
+        return dict((name, self.read_column(key, table, filenames[name], mmap)) for name in columns)
+
+    def load_table(self, key, table = 'output_table', columns = None, mmap = True):
+        """
+        Returns a stored table as a DataFrame (see load_columns)
+
+        The columns are inserted one by one, so that each one keeps its own block: building the
+        DataFrame from the dictionary of columns would consolidate them in a block copied in
+        memory. Operations consolidating the DataFrame still copy the columns.
+        """
+        description = self.get_manifest(key)['tables'].get(table)
+        if description is None:
+            raise Exception("ResultStore: no table %s stored under key %s" % (table, key))
+        if columns is None:
+            columns = [name for name, filename, dtype in description['columns']]
+        arrays = self.load_columns(key, table, columns, mmap)
+        index = None
+        if description['index'] is not None:
+            index = self.read_column(key, table, description['index'], mmap = False)
+        if index is None:
+            index = np.arange(description['length'])
+        frame = DataFrame(index = index)
+        for name in columns:
+            frame[name] = arrays[name]
+        return frame
+
+    def iter_rows(self, key, columns, tables = ('output_table', 'input_table'), chunks_count = None,
+                  chunk_size = None):
+        """
+        Yields DataFrames of chunks of rows of stored columns
+
+        The columns are memory-mapped: only the rows of a chunk are copied in its DataFrame.
+
+        Parameters
+        ----------
+        key : str
+              key of the results
+        columns : list
+                  names of the columns, each one read from the first of the tables holding it
+                  (the tables of a simulation have the same rows)
+        tables : list, default ('output_table', 'input_table')
+                 tables holding the columns
+        chunks_count : int, default None
+                       number of chunks
+        chunk_size : int, default None
+                     number of rows of a chunk (used when chunks_count is None)
+        """
+        descriptions = self.get_manifest(key)['tables']
+        arrays = {}
+        length = None
+        for table in tables:
+            if table not in descriptions:
+                continue
+            stored = set(name for name, filename, dtype in descriptions[table]['columns'])
+            names = [name for name in columns if name in stored and name not in arrays]
+            if names:
+                arrays.update(self.load_columns(key, table, names, mmap = True))
+                length = descriptions[table]['length']
+        missing = [name for name in columns if name not in arrays]
+        if missing:
+            raise Exception("ResultStore: columns %s are not in tables %s" % (missing, list(tables)))
+        for start, stop in get_chunk_bounds(length or 0, chunks_count, chunk_size):
+            yield DataFrame(OrderedDict((name, np.array(arrays[name][start:stop])) for name in columns),
+                            columns = columns)
+
+    def iter_entity_chunks(self, key, entity, varnames, entity_varnames = (), chunks_count = None,
+                           chunk_size = None, default = True):
+        """
+        Yields chunks of the stored variables aggregated at the entity level
+
+        The individual rows are read chunk by chunk (see iter_rows) and aggregated by
+        aggregate_entity_chunks, so that the whole columns are never held in memory.
+
+        Parameters
+        ----------
+        key : str
+              key of the results
+        entity : str
+                 name of the entity (the rows are not aggregated for 'ind')
+        varnames : list
+                   variables to aggregate
+        entity_varnames : list, default ()
+                          variables defined at the entity level (read from the heads)
+        chunks_count : int, default None
+                       number of chunks of individual rows
+        chunk_size : int, default None
+                     number of individual rows of a chunk (used when chunks_count is None)
+        default : bool, default True
+                  also yield the variables of the default simulation, when stored
+
+        Yields
+        ------
+        data, data_default : DataFrame
+                             aggregated rows of the simulation and of the default simulation
+                             (None when the default simulation is not stored or not requested)
+        """
+        # The individuals are not aggregated
+        id_names = ['id' + entity, 'qui' + entity] if entity != 'ind' else []
+        names = id_names + [name for name in varnames if name not in id_names]
+        rows = self.iter_rows(key, names, chunks_count = chunks_count, chunk_size = chunk_size)
+        descriptions = self.get_manifest(key)['tables']
+        if default and 'output_table_default' in descriptions:
+            stored = set(name for name, filename, dtype in descriptions['output_table_default']['columns'])
+            default_names = [name for name in varnames if name in stored and name not in id_names]
+            default_rows = self.iter_rows(key, default_names, ('output_table_default',),
+                                          chunks_count = chunks_count, chunk_size = chunk_size)
+            rows = izip(rows, default_rows)
+        else:
+            rows = ((data, None) for data in rows)
+        if not id_names:
+            return rows
+        return aggregate_entity_chunks(rows, entity, entity_varnames)
+
+    def load_simulation(self, key, columns = None, mmap = True):
+        """
+        Returns the stored simulation with its tables
+
+        Parameters
+        ----------
+        key : str
+              key of the results
+        columns : list, default None
+                  names of the columns of the tables to read (all the columns when None)
+        mmap : bool, default True
+               memory-map the columns instead of reading them
+        """
+        manifest = self.get_manifest(key)
+        if not manifest.get('simulation'):
+            raise Exception("ResultStore: only the tables of the simulation are stored under key %s" % key)
+        with open(self.get_path(key, 'simulation.pk'), 'rb') as input:
+            simulation = SimulationUnpickler(input).load()
+        for name, description in manifest['tables'].iteritems():
+            table_columns = None
+            if columns is not None:
+                table_columns = [column for column, filename, dtype in description['columns']
+                                 if column in columns]
+            getattr(simulation, name).table = self.load_table(key, name, table_columns, mmap)
+        return simulation
+
+    def restore(self, simulation, key = None, options = None, mmap = True):
+        """
+        Replaces the tables of a simulation by the stored ones
+        """
+        if key is None:
+            key = self.get_key(simulation, options)
+        stored = self.load_simulation(key, mmap = mmap)
+        for name in TABLES:
+            setattr(simulation, name, getattr(stored, name, None))
+        return simulation
+
+
+def compute_simulation(simulation, store = None, options = None, prepare = None):
+    """
+    Computes a survey simulation, or loads its tables when the same computation was stored
+
+    Parameters
+    ----------
+    simulation : SurveySimulation
+                 configured simulation
+    store : ResultStore, default None
+            store of the results (the default store when None)
+    options : object, default None
+              anything else changing the results (see get_simulation_key)
+    prepare : callable, default None
+              called before the simulation is computed (when the tables are not loaded)
+
+    Returns
+    -------
+    loaded : bool
+             True when the tables were loaded from the store
+    """
+    if store is None:
+        store = ResultStore()
+    key = store.get_key(simulation, options)
+    if store.has(key):
+        try:
+            store.restore(simulation, key)
+            return True
+        except Exception, e:
+            log.warning("ResultStore: stored results %s could not be loaded, computing them: %s", key, e)
+    if prepare is not None:
+        prepare()
+    simulation.compute()
+    store.save(simulation, key, options)
+    return False
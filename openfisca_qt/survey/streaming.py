@@ -0,0 +1,406 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+from collections import OrderedDict
+
+import numpy as np
+from pandas import DataFrame, concat, factorize
+
+from .indicators import IncomeDistribution
+from .quantiles import WeightedQuantileSketch
+
+
+def get_chunk_bounds(length, chunks_count = None, chunk_size = None):
+    """
+    Returns the (start, stop) rows of the chunks of a table
+
+    Parameters
+    ----------
+    length : int
+             number of rows of the table
+    chunks_count : int, default None
+                   number of chunks (the chunks_count option of the simulation)
+    chunk_size : int, default None
+                 number of rows of a chunk (used when chunks_count is None, a single chunk
+                 when both are None)
+    """
+    if chunks_count is not None:
+        chunk_size = int(np.ceil(length/max(chunks_count, 1)))
+    if not chunk_size:
+        chunk_size = max(length, 1)
+    return [(start, min(start + chunk_size, length)) for start in range(0, length, chunk_size)]
+
+
+def iter_chunks(data, chunks_count = None, chunk_size = None):
+    """
+    Yields chunks of rows of a DataFrame, or of a tuple of row aligned DataFrames
+
+    Any other iterable of chunks (an HDFStore select with a chunksize for instance) is passed
+    through unchanged.
+
+    Parameters
+    ----------
+    data : DataFrame, tuple of DataFrames or iterable
+           data to split
+    chunks_count : int, default None
+                   number of chunks (the chunks_count option of the simulation)
+    chunk_size : int, default None
+                 number of rows of a chunk (used when chunks_count is None)
+    """
+    frames = data if isinstance(data, tuple) else (data,)
+    if not all(isinstance(frame, DataFrame) or frame is None for frame in frames):
+        for chunk in data:
+            yield chunk
+        return
+    for start, stop in get_chunk_bounds(len(frames[0]), chunks_count, chunk_size):
+        chunk = tuple(frame.iloc[start:stop] if frame is not None else None for frame in frames)
+        yield chunk if isinstance(data, tuple) else chunk[0]
+
+
+def aggregate_entity_chunks(chunks, entity, entity_varnames = ()):
+    """
+    Yields chunks of entity level rows aggregated from chunks of individual rows
+
+    The individuals must be sorted by entity: the rows of the last entity of a chunk are kept
+    for the next chunk, so that no entity is split between two chunks. The variables of the
+    entity (entity_varnames) are read from the rows of the heads of the entities, the other
+    variables are summed over the members.
+
+    Parameters
+    ----------
+    chunks : iterable
+             chunks of the individual rows: DataFrames, or tuples of row aligned DataFrames
+             (the ids and roles are read from the first DataFrame of a tuple)
+    entity : str
+             name of the entity ('men', 'fam', 'foy')
+    entity_varnames : list, default ()
+                      variables defined at the entity level
+
+    Yields
+    ------
+    chunk : DataFrame or tuple of DataFrames
+            aggregated rows, with the id of the entity and the other columns of the chunks
+    """
+    id_name, role_name = 'id' + entity, 'qui' + entity
+    pending = None
+    for chunk in chunks:
+        frames = list(chunk) if isinstance(chunk, tuple) else [chunk]
+        if pending is not None:
+            frames = [concat([previous, frame]) if frame is not None else None
+                      for previous, frame in zip(pending, frames)]
+        ids = frames[0][id_name].values
+        if not len(ids):
+            continue
+        if (np.diff(ids) < 0).any():
+            raise Exception("aggregate_entity_chunks: the individuals are not sorted by %s" % id_name)
+        # The rows of the last entity may go on in the next chunk
+        complete = np.searchsorted(ids, ids[-1])
+        pending = [frame.iloc[complete:] if frame is not None else None for frame in frames]
+        if complete:
+            rows = [frame.iloc[:complete] if frame is not None else None for frame in frames]
+            yield aggregate_entity_rows(rows, entity, entity_varnames, isinstance(chunk, tuple))
+    if pending is not None and len(pending[0]):
+        yield aggregate_entity_rows(pending, entity, entity_varnames, isinstance(chunk, tuple))
+
+
+def aggregate_entity_rows(frames, entity, entity_varnames, as_tuple):
+    """
+    Aggregates row aligned DataFrames holding every member of their entities (see
+    aggregate_entity_chunks)
+    """
+    id_name, role_name = 'id' + entity, 'qui' + entity
+    ids = frames[0][id_name].values
+    heads = frames[0][role_name].values == 0
+    groups, codes = np.unique(ids, return_inverse = True)
+    if heads.sum() != len(groups) or not np.array_equal(ids[heads], groups):
+        raise Exception("aggregate_entity_chunks: every %s should have exactly one head" % id_name)
+    aggregated = []
+    for frame in frames:
+        if frame is None:
+            aggregated.append(None)
+            continue
+        columns = OrderedDict([(id_name, groups)])
+        for name in frame.columns:
+            if name in (id_name, role_name):
+                continue
+            values = frame[name].values
+            if name in entity_varnames:
+                columns[name] = values[heads]
+            else:
+                columns[name] = np.bincount(codes, weights = values, minlength = len(groups))
+        aggregated.append(DataFrame(columns, columns = columns.keys()))
+    return tuple(aggregated) if as_tuple else aggregated[0]
+
+
+class GroupedAccumulator(object):
+    """
+    Weighted sums and quantile sketches by group, accumulated over chunks of observations
+
+    The weights and the weighted sums of the variables by group are additive: accumulators
+    built on separate chunks (or by separate workers) are merged exactly. The quantiles of the
+    variables listed in quantile_names come from mergeable WeightedQuantileSketch.
+
+    Parameters
+    ----------
+    quantile_names : list, default None
+                     variables whose quantiles by group are needed
+    accuracy : float, default .001
+               accuracy of the quantile sketches (see WeightedQuantileSketch)
+    """
+    def __init__(self, quantile_names = None, accuracy = .001):
+        super(GroupedAccumulator, self).__init__()
+        self.quantile_names = set(quantile_names or [])
+        self.accuracy = accuracy
+        self.groups = np.empty(0)
+        self.totals = np.empty(0)
+        self.counts = np.empty(0, dtype = int)
+        self.sums = {}
+        self.sketches = dict((name, {}) for name in self.quantile_names)
+
+    def __repr__(self):
+        return '%s \n groups %s \n variables %s ' % (self.__class__.__name__, self.groups, sorted(self.sums))
+
+    def align(self, groups):
+        """
+        Adds the missing groups and returns the positions of the given groups
+        """
+        # The groups of the first chunk give their type to the groups
+        union = np.union1d(self.groups, groups) if len(self.groups) else np.unique(groups)
+        if len(union) != len(self.groups):
+            positions = np.searchsorted(union, self.groups)
+            self.totals = self.expand(self.totals, positions, len(union))
+            self.counts = self.expand(self.counts, positions, len(union))
+            for name, sums in self.sums.iteritems():
+                self.sums[name] = self.expand(sums, positions, len(union))
+            self.groups = union
+        return np.searchsorted(self.groups, groups)
+
+    @staticmethod
+    def expand(array, positions, length):
+        expanded = np.zeros(length, dtype = array.dtype)
+        expanded[positions] = array
+        return expanded
+
+    def add_sums(self, groups, totals, counts, sums):
+        positions = self.align(groups)
+        self.totals[positions] += totals
+        self.counts[positions] += counts
+        for name, values in sums.iteritems():
+            if name not in self.sums:
+                self.sums[name] = np.zeros(len(self.groups))
+            self.sums[name][positions] += values
+
+    def update(self, by, weights, values):
+        """
+        Adds a chunk of observations
+
+        Parameters
+        ----------
+        by : array
+             groups of the observations (observations with a missing group are left out)
+        weights : array
+                  weights of the observations
+        values : dict
+                 values of the observations indexed by variable
+        """
+        codes, groups = factorize(np.asarray(by), sort = True)
+        selected = codes >= 0
+        codes = codes[selected]
+        weights = np.asarray(weights, dtype = float)[selected]
+        length = len(groups)
+        sums = {}
+        order = None
+        for name, array in values.iteritems():
+            array = np.asarray(array, dtype = float)[selected]
+            sums[name] = np.bincount(codes, weights = weights*array, minlength = length)
+            if name in self.quantile_names:
+                sketches = self.sketches[name]
+                if order is None:
+                    # The observations are sorted by group once for all the variables
+                    order = np.argsort(codes, kind = 'mergesort')
+                    bounds = np.searchsorted(codes[order], np.arange(length + 1))
+                for code, group in enumerate(groups):
+                    observations = order[bounds[code]:bounds[code + 1]]
+                    if group not in sketches:
+                        sketches[group] = WeightedQuantileSketch(self.accuracy)
+                    sketches[group].update(array[observations], weights[observations])
+        self.add_sums(np.asarray(groups), np.bincount(codes, weights = weights, minlength = length),
+                      np.bincount(codes, minlength = length), sums)
+
+    def merge(self, other):
+        """
+        Adds the sums and the sketches of another accumulator
+        """
+        self.add_sums(other.groups, other.totals, other.counts, other.sums)
+        for name, sketches in other.sketches.iteritems():
+            own_sketches = self.sketches.setdefault(name, {})
+            self.quantile_names.add(name)
+            for group, sketch in sketches.iteritems():
+                if group not in own_sketches:
+                    own_sketches[group] = WeightedQuantileSketch(sketch.accuracy, sketch.exact_size)
+                own_sketches[group].merge(sketch)
+
+    def sum(self, name):
+        """
+        Returns the weighted sums of a variable by group
+        """
+        return self.sums[name]
+
+    def mean(self, name):
+        """
+        Returns the weighted means of a variable by group
+        """
+        return self.sums[name]/self.totals
+
+    def quantiles(self, name, probabilities):
+        """
+        Returns the (groups x probabilities) approximate weighted quantiles of a variable
+        """
+        sketches = self.sketches[name]
+        return np.array([sketches[group].quantiles(probabilities) if group in sketches
+                         else np.repeat(np.nan, len(probabilities)) for group in self.groups]
+                        ).reshape(len(self.groups), len(probabilities))
+
+
+class DistributionAccumulator(object):
+    """
+    Inequality indicators of a weighted income distribution, accumulated over chunks of incomes
+
+    The mean, the Theil and the Atkinson indices only need weighted sums of functions of the
+    incomes and are exact. The quantiles, the Gini index, the quantile share ratio and the
+    poverty indicators are computed from a mergeable WeightedQuantileSketch. Theil and Atkinson
+    indices are computed on positive incomes only, as in IncomeDistribution.
+
+    Parameters
+    ----------
+    epsilons : list, default (.5, 1, 2)
+               inequality aversions of the Atkinson indices
+    accuracy : float, default .001
+               accuracy of the quantile sketch (see WeightedQuantileSketch)
+    """
+    def __init__(self, epsilons = (.5, 1, 2), accuracy = .001):
+        super(DistributionAccumulator, self).__init__()
+        self.epsilons = tuple(epsilons)
+        self.sums = dict.fromkeys(['weight', 'income', 'positive_weight', 'positive_income',
+                                   'positive_entropy'] + [('power', epsilon) for epsilon in self.epsilons], 0)
+        self.sketch = WeightedQuantileSketch(accuracy)
+
+    def __repr__(self):
+        return '%s \n mean %s ' % (self.__class__.__name__, self.mean)
+
+    def update(self, values, weights = None):
+        """
+        Adds a chunk of incomes
+        """
+        values = np.asarray(values, dtype = float)
+        if weights is None:
+            weights = np.ones(len(values))
+        weights = np.asarray(weights, dtype = float)
+        self.sketch.update(values, weights)
+        positive = values > 0
+        x, w = values[positive], weights[positive]
+        log_x = np.log(x)
+        sums = self.sums
+        sums['weight'] += weights.sum()
+        sums['income'] += (weights*values).sum()
+        sums['positive_weight'] += w.sum()
+        sums['positive_income'] += (w*x).sum()
+        sums['positive_entropy'] += (w*x*log_x).sum()
+        for epsilon in self.epsilons:
+            # Sum of the logarithms for epsilon = 1, of the incomes to the power 1 - epsilon otherwise
+            sums[('power', epsilon)] += (w*log_x).sum() if epsilon == 1 else (w*x**(1 - epsilon)).sum()
+
+    def merge(self, other):
+        """
+        Adds the incomes of another accumulator (with the same epsilons)
+        """
+        for key, value in other.sums.iteritems():
+            self.sums[key] += value
+        self.sketch.merge(other.sketch)
+
+    @property
+    def mean(self):
+        return self.sums['income']/self.sums['weight']
+
+    def theil(self):
+        """
+        Returns the Theil T index of the positive incomes
+        """
+        sums = self.sums
+        mean = sums['positive_income']/sums['positive_weight']
+        return (sums['positive_entropy'] - np.log(mean)*sums['positive_income'])/(mean*sums['positive_weight'])
+
+    def atkinson(self, epsilon = 1):
+        """
+        Returns the Atkinson index of the positive incomes (epsilon should be one of epsilons)
+        """
+        sums = self.sums
+        mean = sums['positive_income']/sums['positive_weight']
+        power = sums[('power', epsilon)]/sums['positive_weight']
+        equivalent = np.exp(power) if epsilon == 1 else power**(1/(1 - epsilon))
+        return 1 - equivalent/mean
+
+    def get_distribution(self):
+        """
+        Returns the IncomeDistribution of the points of the sketch
+        """
+        values, weights = self.sketch.get_points()
+        return IncomeDistribution(values, weights, order = np.arange(len(values)))
+
+    def quantile(self, probability):
+        return self.sketch.quantile(probability)
+
+    def median(self):
+        return self.quantile(.5)
+
+    def gini(self):
+        return self.get_distribution().gini()
+
+    def quantile_share_ratio(self, share = .2):
+        return self.get_distribution().quantile_share_ratio(share)
+
+    def poverty(self, thresholds, alphas = (0, 1)):
+        """
+        Returns the Foster-Greer-Thorbecke indices of IncomeDistribution.poverty (see there)
+        """
+        return self.get_distribution().poverty(thresholds, alphas)
+
+    def compute(self, median_shares = (.4, .5, .6), alphas = (0, 1, 2)):
+        """
+        Returns the indicators of IncomeDistribution.compute (see there)
+        """
+        distribution = self.get_distribution()
+        median = self.median()
+        indicators = {'mean': self.mean, 'median': median, 'gini': distribution.gini(), 'theil': self.theil(),
+                      's80/s20': distribution.quantile_share_ratio(.2)}
+        for epsilon in self.epsilons:
+            indicators[('atkinson', epsilon)] = self.atkinson(epsilon)
+        thresholds = [share*median for share in median_shares]
+        fgt = distribution.poverty(thresholds, alphas)
+        for share, threshold in zip(median_shares, thresholds):
+            for alpha in alphas:
+                indicators[('fgt', share, alpha)] = fgt[(threshold, alpha)]
+        return indicators
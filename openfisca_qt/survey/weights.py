@@ -0,0 +1,137 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+
+
+def get_members_index(survey, entity):
+    """
+    Returns, for every individual of the survey, the position of its entity
+
+    An exception is raised if some individuals belong to no entity: they would otherwise get the
+    weight of another entity.
+
+    Parameters
+    ----------
+    survey : DataTable
+             survey with an index for the entity
+    entity : str
+             name of the entity
+    """
+    index = survey.index[entity]
+    members_index = -np.ones(len(survey.table), dtype = int)
+    for person, idx in index.iteritems():
+        if person == 'nb':
+            continue
+        members_index[idx['idxIndi']] = idx['idxUnit']
+    orphans = np.flatnonzero(members_index < 0)
+    if len(orphans) > 0:
+        raise Exception("get_members_index: %i individuals (rows %s) belong to no %s"
+                        % (len(orphans), list(orphans[:10]), entity))
+    return members_index
+
+
+class WeightsRegistry(object):
+    """
+    Named weight vectors (initial, calibrated variants, ...) of a survey
+
+    The vectors are stored once at the entity level. The individual level weights are never
+    stored: they are obtained through the entity index of the survey, and the weight column of
+    the survey is filled in place when weights are published. Switching the active weights only
+    changes a name, publishing them always rewrites the column since the survey may have been
+    modified elsewhere.
+    """
+    def __init__(self, survey, entity, column):
+        super(WeightsRegistry, self).__init__()
+        self.survey = survey
+        self.entity = entity
+        self.column = column
+        self.members_index = get_members_index(survey, entity)
+        self.dtype = survey.table[column].dtype
+        self.weights = {}
+        self.active = None
+
+    def __repr__(self):
+        return '%s \n weights %s \n active %s ' % (self.__class__.__name__, sorted(self.weights), self.active)
+
+    def __contains__(self, name):
+        return name in self.weights
+
+    def add(self, name, weights):
+        """
+        Registers (or replaces) a named weight vector given at the entity level
+        """
+        weights = np.asarray(weights, dtype = self.dtype)
+        if len(weights) != self.survey.index[self.entity]['nb']:
+            raise Exception("WeightsRegistry: weights %s should have one value per %s" % (name, self.entity))
+        self.weights[name] = weights
+
+    def remove(self, name):
+        """
+        Unregisters a weight vector
+        """
+        del self.weights[name]
+        if self.active == name:
+            self.active = None
+
+    def activate(self, name):
+        """
+        Makes the named weights the active ones (the survey column is updated by publish)
+        """
+        if name not in self.weights:
+            raise Exception("WeightsRegistry: unknown weights %s" % name)
+        self.active = name
+
+    def get(self, name = None, entity = None, out = None):
+        """
+        Returns the named (default: active) weights at the entity or individual level
+
+        Parameters
+        ----------
+        name : str, default None
+               name of the weights
+        entity : str, default None
+                 'ind' for individual level weights, the registry entity otherwise
+        out : array, default None
+              buffer receiving the individual level weights
+        """
+        if name is None:
+            name = self.active
+        weights = self.weights[name]
+        if entity is None or entity == self.entity:
+            return weights
+        return np.take(weights, self.members_index, out = out)
+
+    def publish(self):
+        """
+        Writes the active weights into the weight column of the survey without reallocating it
+        """
+        if self.active is None:
+            return
+        column = self.survey.table[self.column].values
+        self.get(entity = 'ind', out = column)
+        if not np.may_share_memory(column, self.survey.table[self.column].values):
+            self.survey.table[self.column] = column
@@ -0,0 +1,210 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+# Small in-memory stand-ins of a survey DataTable and a SurveySimulation used by the tests
+
+
+from __future__ import division
+
+from datetime import date
+
+import numpy as np
+from openfisca_core.columns import BoolCol, FloatCol, IntCol
+from pandas import DataFrame
+
+
+def get_column(column_class, name, label, entity = 'ind'):
+    column = column_class(label = label, entity = entity)
+    column.name = name
+    return column
+
+
+COLUMNS = [
+    get_column(IntCol, 'idmen', u"Identifiant du ménage"),
+    get_column(IntCol, 'quimen', u"Rôle dans le ménage"),
+    get_column(IntCol, 'typmen', u"Type de ménage", 'men'),
+    get_column(IntCol, 'so', u"Statut d'occupation", 'men'),
+    get_column(IntCol, 'agegroup', u"Tranche d'âge"),
+    get_column(BoolCol, 'champm', u"Ménage du champ", 'men'),
+    get_column(FloatCol, 'loyer', u"Loyer", 'men'),
+    get_column(FloatCol, 'revdisp', u"Revenu disponible", 'men'),
+    get_column(FloatCol, 'wprm', u"Poids du ménage", 'men'),
+    get_column(FloatCol, 'wprm_init', u"Poids initial du ménage", 'men'),
+    ]
+
+
+class Survey(object):
+    """
+    Stand-in of the survey DataTable: a table of individuals sorted by household, the household
+    variables being held by the heads of the households (quimen == 0)
+    """
+    def __init__(self, table):
+        super(Survey, self).__init__()
+        self.table = table
+        self.column_by_name = dict((column.name, column) for column in COLUMNS)
+        idmen = table['idmen'].values
+        quimen = table['quimen'].values
+        self.heads = np.flatnonzero(quimen == 0)
+        self.index = {'ind': {'nb': len(table)}, 'men': {'nb': len(self.heads)}}
+        for person in np.unique(quimen):
+            selected = np.flatnonzero(quimen == person)
+            self.index['men'][person] = {'idxIndi': selected, 'idxUnit': idmen[selected]}
+
+    def get_value(self, varname, entity = 'ind', opt = None, sum_ = False):
+        values = self.table[varname].values
+        if entity == 'ind':
+            return values
+        if sum_:
+            return np.bincount(self.table['idmen'].values, weights = values)
+        return values[self.heads]
+
+
+def get_survey_table(households = 2000, seed = 0):
+    """
+    Returns the individuals of random households of 1 to 4 members
+    """
+    rng = np.random.RandomState(seed)
+    sizes = rng.randint(1, 5, households)
+    idmen = np.repeat(np.arange(households), sizes)
+    quimen = np.arange(len(idmen)) - np.repeat(np.cumsum(sizes) - sizes, sizes)
+    weights = np.repeat(rng.uniform(500, 1500, households), sizes)
+    so = np.repeat(rng.randint(0, 3, households), sizes)
+    revdisp = np.repeat(rng.lognormal(10, .7, households), sizes)
+    return DataFrame({
+        'idmen': idmen,
+        'quimen': quimen,
+        'typmen': np.repeat(rng.randint(0, 4, households), sizes),
+        'agegroup': rng.randint(0, 5, len(idmen)),
+        'champm': np.repeat(rng.uniform(size = households) < .95, sizes),
+        'loyer': np.repeat(rng.lognormal(6, .5, households), sizes),
+        'wprm': weights.copy(),
+        'wprm_init': weights,
+        'so': so,
+        'revdisp': revdisp,
+        })
+
+
+class Simulation(object):
+    """
+    Stand-in of a SurveySimulation whose survey is drawn at random (one survey by year)
+    """
+    def __init__(self, households = 2000):
+        super(Simulation, self).__init__()
+        self.households = households
+        self.year = None
+        self.survey = None
+        self.input_table = None
+        self.output_table = None
+        self.io_column_by_name = dict((column.name, column) for column in COLUMNS)
+        self.var_list = sorted(self.io_column_by_name)
+
+    def set_config(self, year = None, survey_filename = None):
+        self.year = year
+
+    def set_param(self):
+        pass
+
+    def set_survey(self):
+        self.survey = self.input_table = Survey(get_survey_table(self.households, self.year))
+
+    def get_col(self, varname):
+        return self.survey.column_by_name[varname]
+
+
+def set_output_table(simulation, values):
+    """
+    Sets the output table of a simulation: the survey table with the given individual level
+    variables
+
+    Parameters
+    ----------
+    values : dict
+             arrays of the values of the individuals indexed by variable
+    """
+    table = simulation.survey.table.copy()
+    for varname, value in values.iteritems():
+        table[varname] = value
+    simulation.output_table = Survey(table)
+    simulation.output_table._inputs = simulation.survey
+
+
+def get_computed_simulation(households = 500, year = 2010):
+    """
+    Returns a simulation of a year whose revdisp is 10% higher than in the default simulation
+    """
+    simulation = Simulation(households)
+    simulation.set_config(year = year)
+    simulation.set_survey()
+    simulation.datesim = date(year, 1, 1)
+    set_output_table(simulation, {'revdisp': simulation.survey.table['revdisp'].values*1.1})
+    simulation.output_table_default = Survey(simulation.survey.table.copy())
+    simulation.output_table_default._inputs = simulation.survey
+    return simulation
+
+
+def get_entity_frame(survey, varnames, entity = 'men'):
+    """
+    Returns a DataFrame of the values of the variables at the entity level
+    """
+    return DataFrame(dict((varname, survey.get_value(varname, entity)) for varname in varnames),
+                     columns = varnames)
+
+
+def get_margins(simulation, variables, factor = 1.1):
+    """
+    Returns margins reached by weights different from the initial ones (factor times the
+    initial weights of the households of the first category of each variable)
+
+    Returns
+    -------
+    margins : dict
+              counts of the categories indexed by variable, and 'totalpop'
+    weights : array
+              household weights reaching the margins
+    """
+    survey = simulation.survey
+    champm = survey.get_value('champm', 'men')
+    weights = survey.get_value('wprm_init', 'men')*champm
+    for var in variables:
+        values = survey.get_value(var, 'men')
+        weights = weights*np.where(values == values.min(), factor, 1)
+    margins = {'totalpop': weights.sum()}
+    for var in variables:
+        values = survey.get_value(var, 'men')
+        margins[var] = dict((category, weights[values == category].sum()) for category in np.unique(values))
+    return margins, weights
+
+
+def write_margins(filename, year, margins):
+    """
+    Writes margins in the CSV format read by Calibration.set_margins_from_file
+    """
+    with open(filename, 'w') as margins_file:
+        margins_file.write('var,mod,%s\n' % year)
+        for var, values in sorted(margins.iteritems()):
+            if var == 'totalpop':
+                margins_file.write('totalpop,0,%r\n' % values)
+                continue
+            for category, target in sorted(values.iteritems()):
+                margins_file.write('%s,%s,%r\n' % (var, category, target))
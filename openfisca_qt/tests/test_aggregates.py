@@ -0,0 +1,95 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import logging
+
+import numpy as np
+from pandas import DataFrame, HDFStore
+import pytest
+
+from openfisca_qt.survey.aggregates import Aggregates
+from openfisca_qt.tests.fake_survey import get_computed_simulation
+
+
+def get_aggregates(households = 500):
+    """
+    Returns aggregates of a simulation whose revdisp is 10% higher than the default one
+    """
+    aggregates = Aggregates()
+    aggregates.varlist = ['revdisp', 'loyer', 'agegroup', 'missing']
+    aggregates.set_simulation(get_computed_simulation(households))
+    return aggregates
+
+
+def test_compute_aggregates():
+    aggregates = get_aggregates()
+    assert aggregates.filter_by == 'champm'
+    aggregates.compute_aggregates(aggregates.filter_by)
+
+    survey = aggregates.simulation.survey
+    weights = survey.get_value('wprm', 'men')*survey.get_value('champm', 'men')
+    frame = aggregates.aggr_frame
+    labels = aggregates.labels
+    assert list(frame.index) == ['revdisp', 'loyer', 'agegroup']
+    assert list(frame[labels['entity']]) == ['men', 'men', 'ind']
+    revdisp = survey.get_value('revdisp', 'men')
+    assert np.allclose(frame[labels['dep']]['revdisp'], 1.1*weights.dot(revdisp)/1e6)
+    assert np.allclose(frame[labels['dep_default']]['revdisp'], weights.dot(revdisp)/1e6)
+    assert np.allclose(frame[labels['benef']]['loyer'], weights.sum()/1e3)
+    individual_weights = survey.get_value('wprm')*survey.get_value('champm')
+    agegroup = survey.get_value('agegroup')
+    assert np.allclose(frame[labels['dep']]['agegroup'], individual_weights.dot(agegroup)/1e6)
+    assert np.allclose(frame[labels['benef']]['agegroup'], individual_weights[agegroup != 0].sum()/1e3)
+
+
+def test_real_aggregates(tmpdir):
+    aggregates = get_aggregates()
+    filename = str(tmpdir.join('amounts.h5'))
+    store = HDFStore(filename)
+    store['amounts'] = DataFrame({2010: [2e9, 1e8, 5e7]}, index = ['revdisp', 'rmi', 'rsa'])
+    store['benef'] = DataFrame({2010: [4e5, 1e4, 2e4]}, index = ['revdisp', 'rmi', 'rsa'])
+    store.close()
+    aggregates.load_amounts_from_file(filename)
+    # rsa holds rmi and rsa
+    assert np.allclose(aggregates.totals_df.loc['rsa'], [150, 30])
+
+    aggregates.compute_aggregates(aggregates.filter_by)
+    aggregates.compute_real()
+    aggregates.compute_diff()
+    labels = aggregates.labels
+    frame = aggregates.aggr_frame
+    assert frame[labels['dep_real']]['revdisp'] == 2000
+    assert np.isnan(frame[labels['dep_real']]['loyer'])
+    assert np.allclose(frame[labels['dep_diff_abs']]['revdisp'], frame[labels['dep']]['revdisp'] - 2000)
+    assert np.allclose(frame[labels['benef_diff_rel']]['revdisp'], frame[labels['benef']]['revdisp']/400 - 1)
+
+
+def test_missing_real_aggregates(tmpdir, caplog):
+    aggregates = get_aggregates()
+    with caplog.at_level(logging.WARNING):
+        aggregates.load_amounts_from_file(str(tmpdir.join('missing.h5')))
+    assert aggregates.totals_df is None
+    assert 'No administrative data available for year 2010' in caplog.text
@@ -0,0 +1,150 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+from pandas import DataFrame, HDFStore
+import pytest
+
+from openfisca_qt.survey import aggregates_batch
+from openfisca_qt.survey.aggregates import Aggregates
+from openfisca_qt.survey.aggregates_batch import compute_all, run_year, save_frames
+from openfisca_qt.survey.result_store import ResultStore
+from openfisca_qt.tests.fake_survey import get_computed_simulation
+
+
+VARLIST = ['revdisp', 'loyer']
+
+
+def get_simulation(year, inflators = None, survey_filename = None, store_dir = None):
+    """
+    Stand-in of aggregates_batch.get_simulation (there is no survey for 2011)
+    """
+    if year == 2011:
+        raise Exception("no survey for %s" % year)
+    simulation = get_computed_simulation(300, year)
+    for varname, inflator in (inflators or {}).iteritems():
+        simulation.output_table.table[varname] *= inflator
+    return simulation
+
+
+def test_run_year(monkeypatch):
+    monkeypatch.setattr(aggregates_batch, 'get_simulation', get_simulation)
+    frame = run_year(2010, varlist = VARLIST)['aggregates']
+    assert frame.index.name == 'variable'
+    assert list(frame.index) == VARLIST
+
+    aggregates = Aggregates()
+    aggregates.varlist = list(VARLIST)
+    aggregates.set_simulation(get_simulation(2010))
+    aggregates.compute()
+    assert np.allclose(frame[aggregates.labels['dep']], aggregates.aggr_frame[aggregates.labels['dep']])
+
+    with pytest.raises(Exception):
+        run_year(2010, task = 'unknown')
+
+
+def test_compute_all(monkeypatch, tmpdir):
+    monkeypatch.setattr(aggregates_batch, 'get_simulation', get_simulation)
+    filename = str(tmpdir.join('aggregates.h5'))
+    computed = []
+    frames_by_year, errors = compute_all([2009, 2010, 2011], filename, varlist = VARLIST,
+                                         inflators = {2010: {'loyer': 2}}, processes = 2,
+                                         callback = lambda year, frames: computed.append(year))
+    assert sorted(frames_by_year) == sorted(computed) == [2009, 2010]
+    assert errors == {2011: "no survey for 2011"}
+
+    labels = Aggregates().labels
+    frame = frames_by_year[2010]['aggregates']
+    expected = run_year(2010, varlist = VARLIST, inflators = {'loyer': 2})['aggregates']
+    assert np.allclose(frame[labels['dep']], expected[labels['dep']])
+    assert np.allclose(frame[labels['dep']]['loyer'], 2*run_year(2010, varlist = VARLIST)['aggregates'][labels['dep']]['loyer'])
+
+    store = HDFStore(filename, 'r')
+    try:
+        assert sorted(store.keys()) == ['/y2009/aggregates', '/y2010/aggregates']
+        assert np.allclose(store['y2009/aggregates'][labels['dep']], frames_by_year[2009]['aggregates'][labels['dep']])
+    finally:
+        store.close()
+
+
+def test_save_frames_format(tmpdir):
+    with pytest.raises(Exception):
+        save_frames({}, str(tmpdir.join('aggregates.csv')))
+
+
+class DataTable(object):
+    def __init__(self, table = None):
+        self.table = table
+
+
+class StoredSimulation(object):
+    """
+    Stand-in of SurveySimulation counting its computations
+    """
+    def __init__(self):
+        super(StoredSimulation, self).__init__()
+        self.input_table = None
+        self.output_table = None
+        self.computed = 0
+
+    def set_config(self, year = None, survey_filename = None):
+        self.datesim = '%s-01-01' % year
+        self.survey_filename = survey_filename
+
+    def set_param(self):
+        self.P = {'af': {'taux': .32}}
+
+    def set_survey(self):
+        self.input_table = DataTable(DataFrame({'loyer': np.arange(4.)}))
+
+    def inflate_survey(self, inflators):
+        for varname, inflator in inflators.iteritems():
+            self.input_table.table[varname] *= inflator
+
+    def compute(self):
+        self.computed += 1
+        self.output_table = DataTable(DataFrame({'loyer': self.input_table.table['loyer'].values*2}))
+
+
+def test_get_simulation_from_store(monkeypatch, tmpdir):
+    monkeypatch.setattr(aggregates_batch, 'SurveySimulation', StoredSimulation)
+    tmpdir.join('survey.h5').write('survey')
+    survey_filename = str(tmpdir.join('survey.h5'))
+    store_dir = str(tmpdir.join('results'))
+
+    simulation = aggregates_batch.get_simulation(2010, {'loyer': 2}, survey_filename, store_dir)
+    assert simulation.computed == 1
+    assert (simulation.output_table.table['loyer'].values == np.arange(4)*4).all()
+
+    # The survey is neither loaded nor inflated again
+    simulation = aggregates_batch.get_simulation(2010, {'loyer': 2}, survey_filename, store_dir)
+    assert simulation.computed == 0
+    assert (simulation.input_table.table['loyer'].values == np.arange(4)*2).all()
+    assert (simulation.output_table.table['loyer'].values == np.arange(4)*4).all()
+
+    # Other inflators, other results
+    assert aggregates_batch.get_simulation(2010, {'loyer': 3}, survey_filename, store_dir).computed == 1
+    assert len(ResultStore(store_dir).keys()) == 2
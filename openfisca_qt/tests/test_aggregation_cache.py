@@ -0,0 +1,126 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+from pandas import DataFrame
+
+from openfisca_qt.survey.aggregation_cache import AggregationCache
+
+
+class FakeSimulation(object):
+    """
+    Simulation whose aggregation records the requested variables and adds the weights
+    """
+    def __init__(self, default = True):
+        super(FakeSimulation, self).__init__()
+        self.output_table = object()
+        self.output_table_default = object() if default else None
+        self.default = default
+        self.requests = []
+        self.computed = 0
+        self.scale = 1
+
+    def compute(self):
+        self.computed += 1
+        self.output_table = object()
+
+    def aggregated_by_entity(self, entity, varnames):
+        self.requests.append((entity, list(varnames)))
+        columns = dict((name, np.arange(3)*self.scale + len(name)) for name in varnames)
+        columns['wprm'] = np.ones(3)
+        data = DataFrame(columns)
+        data_default = data*2 if self.default else None
+        return data, data_default
+
+
+def test_get():
+    simulation = FakeSimulation()
+    cache = AggregationCache(simulation)
+    data, data_default = cache.get('men', ['revdisp', 'af'])
+    assert list(data.columns) == ['af', 'revdisp', 'wprm']
+    assert (data['revdisp'].values == np.arange(3) + 7).all()
+    assert (data_default['af'].values == 2*data['af'].values).all()
+
+
+def test_get_without_default():
+    cache = AggregationCache(FakeSimulation(default = False))
+    data, data_default = cache.get('men', ['revdisp'])
+    assert data_default is None
+    arrays = cache.get_arrays('men', ['revdisp'])
+    assert arrays['revdisp'][1] is None
+    assert (arrays['revdisp'][0] == data['revdisp'].values).all()
+
+
+def test_fetch_only_missing():
+    simulation = FakeSimulation()
+    cache = AggregationCache(simulation)
+    cache.get('men', ['revdisp'])
+    cache.get('men', ['revdisp', 'af'])
+    cache.get('men', ['af'])
+    assert simulation.requests == [('men', ['revdisp']), ('men', ['af'])]
+    # The implicit columns are added to every table of the entity
+    assert cache.fetch('men', ['af']) == ['af', 'wprm']
+    # Each entity has its own columns
+    cache.get('fam', ['af'])
+    assert simulation.requests[-1] == ('fam', ['af'])
+
+
+def test_replaced_output_tables():
+    simulation = FakeSimulation()
+    cache = AggregationCache(simulation)
+    cache.get('men', ['revdisp'])
+    simulation.output_table = object()
+    simulation.scale = 10
+    data, data_default = cache.get('men', ['revdisp'])
+    assert cache.revision == 1
+    assert len(simulation.requests) == 2
+    assert (data['revdisp'].values == np.arange(3)*10 + 7).all()
+
+
+def test_invalidate():
+    simulation = FakeSimulation()
+    cache = AggregationCache(simulation)
+    cache.get('men', ['revdisp'])
+    cache.invalidate()
+    assert cache.columns == {}
+    cache.get('men', ['revdisp'])
+    assert len(simulation.requests) == 2
+
+
+def test_compute_when_aggregation_fails():
+    simulation = FakeSimulation()
+    aggregated_by_entity = simulation.aggregated_by_entity
+
+    def fail_once(entity, varnames):
+        simulation.aggregated_by_entity = aggregated_by_entity
+        raise Exception("simulation not computed")
+
+    simulation.aggregated_by_entity = fail_once
+    cache = AggregationCache(simulation)
+    data, data_default = cache.get('men', ['revdisp'])
+    assert simulation.computed == 1
+    assert cache.revision == 1
+    assert list(data.columns) == ['revdisp', 'wprm']
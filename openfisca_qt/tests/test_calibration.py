@@ -0,0 +1,209 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+
+from openfisca_qt.survey.calibration import Calibration
+from openfisca_qt.tests.fake_survey import Simulation
+
+
+def get_calibration(method = 'linear'):
+    simulation = Simulation()
+    simulation.set_config(year = 2010)
+    simulation.set_survey()
+    calibration = Calibration()
+    calibration.set_simulation(simulation)
+    calibration.set_param('invlo', 3)
+    calibration.set_param('up', 3)
+    calibration.set_param('method', method)
+    return calibration
+
+
+def get_target_weights(calibration, seed = 1):
+    """
+    Returns household weights close to the initial ones, of which the margins are the targets
+    """
+    rng = np.random.RandomState(seed)
+    return calibration.weights_init*rng.uniform(.9, 1.2, len(calibration.weights_init))*calibration.champm
+
+
+def get_counts(values, weights):
+    return dict((category, weights[values == category].sum()) for category in np.unique(values))
+
+
+def get_crossed_counts(values, weights):
+    return dict((key, weights[np.all([component == mod for component, mod in zip(values, key)], axis = 0)].sum())
+                for key in set(zip(*values)))
+
+
+def test_household_margins():
+    calibration = get_calibration()
+    target_weights = get_target_weights(calibration)
+    typmen = calibration.get_margin_value('typmen')
+    calibration.add_var2('typmen', get_counts(typmen, target_weights))
+    calibration.set_totalpop(target_weights.sum())
+    calibration.calibrate()
+
+    weights = calibration.weights*calibration.champm
+    assert abs(weights.sum()/target_weights.sum() - 1) < 1e-6
+    for category, target in get_counts(typmen, target_weights).iteritems():
+        assert abs(weights[typmen == category].sum()/target - 1) < 1e-6
+    assert np.allclose(calibration.frame['marge'], calibration.frame[u"cible ajustée"])
+
+
+def test_member_margins():
+    calibration = get_calibration('logit')
+    target_weights = get_target_weights(calibration)
+    members = calibration.get_members_index('ind')
+    agegroup = calibration.get_margin_value('agegroup', 'ind')
+    calibration.add_var2('typmen', get_counts(calibration.get_margin_value('typmen'), target_weights))
+    calibration.add_var2('agegroup', get_counts(agegroup, target_weights[members]), entity = 'ind')
+    calibration.set_totalpop(target_weights.sum())
+    calibration.calibrate()
+
+    # The household weights reach the margins on individuals
+    weights = (calibration.weights*calibration.champm)[members]
+    for category, target in get_counts(agegroup, target_weights[members]).iteritems():
+        assert abs(weights[agegroup == category].sum()/target - 1) < 1e-6
+    frame = calibration.frame
+    assert set(frame['entity']) == set(['men', 'ind'])
+    assert np.allclose(frame['marge'], frame[u"cible ajustée"])
+
+
+def test_crossed_margins():
+    calibration = get_calibration()
+    target_weights = get_target_weights(calibration)
+    values = calibration.get_margin_value('typmen'), calibration.get_margin_value('so')
+    varname = calibration.add_crossed_var(['typmen', 'so'], get_crossed_counts(values, target_weights))
+    calibration.set_totalpop(target_weights.sum())
+    calibration.calibrate()
+
+    assert varname == 'typmen x so'
+    weights = calibration.weights*calibration.champm
+    for key, target in get_crossed_counts(values, target_weights).iteritems():
+        selected = (values[0] == key[0]) & (values[1] == key[1])
+        assert abs(weights[selected].sum()/target - 1) < 1e-6
+    frame = calibration.frame
+    assert len(frame) == len(set(zip(*values)))
+    assert frame[u"modalités"].iloc[0].count(u" x ") == 1
+
+
+def test_crossed_member_margins():
+    calibration = get_calibration()
+    target_weights = get_target_weights(calibration)
+    members = calibration.get_members_index('ind')
+    values = calibration.get_margin_value('typmen', 'ind'), calibration.get_margin_value('agegroup', 'ind')
+    calibration.add_crossed_var(['typmen', 'agegroup'], get_crossed_counts(values, target_weights[members]),
+                                entity = 'ind')
+    calibration.set_totalpop(target_weights.sum())
+    calibration.calibrate()
+
+    weights = (calibration.weights*calibration.champm)[members]
+    for key, target in get_crossed_counts(values, target_weights[members]).iteritems():
+        selected = (values[0] == key[0]) & (values[1] == key[1])
+        assert abs(weights[selected].sum()/target - 1) < 1e-6
+
+
+def test_bundle_round_trip(tmpdir):
+    calibration = get_calibration()
+    target_weights = get_target_weights(calibration)
+    members = calibration.get_members_index('ind')
+    calibration.add_var2('typmen', get_counts(calibration.get_margin_value('typmen'), target_weights))
+    calibration.add_var2('agegroup', get_counts(calibration.get_margin_value('agegroup', 'ind'), target_weights[members]),
+                         entity = 'ind')
+    calibration.set_totalpop(target_weights.sum())
+    calibration.calibrate()
+    filename = str(tmpdir.join('calibration.npz'))
+    calibration.save_bundle(filename)
+
+    loaded = Calibration()
+    loaded.set_simulation(calibration.simulation)
+    assert loaded.load_bundle(filename)
+    assert np.allclose(loaded.weights, calibration.weights)
+    assert np.allclose(loaded.lambdasol, calibration.lambdasol)
+    assert loaded.param['method'] == 'linear'
+    assert loaded.totalpop == calibration.totalpop
+    # The weights are published in the survey
+    survey = calibration.simulation.survey
+    assert loaded.get_weights_registry().active == 'calibrated'
+    assert np.allclose(survey.table['wprm'].values, calibration.weights[members])
+    # The engine is restored: calibrating again keeps it and warm starts from the saved solution
+    engine = loaded.engine
+    loaded.calibrate()
+    assert loaded.engine is engine
+    assert len(loaded.trace) <= 2
+    assert np.allclose(loaded.weights, calibration.weights)
+
+
+def test_bundle_changed_survey(tmpdir):
+    calibration = get_calibration()
+    target_weights = get_target_weights(calibration)
+    calibration.add_var2('typmen', get_counts(calibration.get_margin_value('typmen'), target_weights))
+    calibration.calibrate()
+    filename = str(tmpdir.join('calibration.npz'))
+    calibration.save_bundle(filename)
+
+    simulation = calibration.simulation
+    simulation.survey.table['typmen'] = (simulation.survey.table['typmen'] + 1) % 4
+    loaded = Calibration()
+    loaded.set_simulation(simulation)
+    assert not loaded.load_bundle(filename)
+    assert loaded.engine is None
+    assert set(loaded.frame['var']) == set(['typmen'])
+
+
+def test_margin_values_cache():
+    calibration = get_calibration()
+    survey = calibration.simulation.survey
+    get_value = survey.get_value
+    requests = []
+
+    def counted_get_value(varname, entity = 'ind', opt = None, sum_ = False):
+        requests.append((varname, entity))
+        return get_value(varname, entity, opt, sum_)
+
+    survey.get_value = counted_get_value
+    typmen = calibration.get_margin_value('typmen')
+    assert calibration.get_margin_value('typmen') is typmen
+    assert calibration.get_margin_value('typmen', 'men') is typmen
+    calibration.get_margin_value('agegroup', 'ind')
+    assert requests == [('typmen', 'men'), ('agegroup', 'ind')]
+
+    target_weights = get_target_weights(calibration)
+    calibration.add_var2('typmen', get_counts(typmen, target_weights))
+    calibration.set_totalpop(target_weights.sum())
+    calibration.calibrate()
+    engine = calibration.engine
+    calibration.calibrate()
+    assert len(requests) == 2
+    # The design matrix is kept when the values of the margin variables did not change
+    assert calibration.engine is engine
+
+    calibration.invalidate_margin_values()
+    survey.table['typmen'] = (survey.table['typmen'] + 1) % 4
+    calibration.calibrate()
+    assert requests.count(('typmen', 'men')) == 2
+    assert calibration.engine is not engine
@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import os
+
+import numpy as np
+from pandas import HDFStore
+
+from openfisca_qt.survey import calibration_batch
+from openfisca_qt.tests.fake_survey import Simulation, get_margins, write_margins
+
+
+def test_calibrate_all(tmpdir, monkeypatch):
+    # The worker processes are forked and inherit the fake simulation
+    monkeypatch.setattr(calibration_batch, 'SurveySimulation', Simulation)
+    simulation = Simulation()
+    simulation.set_config(year = 2010)
+    simulation.set_survey()
+    margins, target_weights = get_margins(simulation, ['typmen'])
+    margins_filename = os.path.join(str(tmpdir), 'calib_2010.csv')
+    write_margins(margins_filename, 2010, margins)
+    store_filename = os.path.join(str(tmpdir), 'calibrations.h5')
+    jobs = [(2010, margins_filename, 'linear', 2, 2), (2010, margins_filename, 'logit', 3, 3)]
+
+    errors = calibration_batch.calibrate_all(jobs, store_filename, processes = 2)
+
+    assert errors == {}
+    typmen = simulation.survey.get_value('typmen', 'men')
+    champm = simulation.survey.get_value('champm', 'men')
+    store = HDFStore(store_filename)
+    try:
+        for job in jobs:
+            key = calibration_batch.get_job_key(job)
+            weights = store[key + '/weights'].values*champm
+            assert abs(weights.sum()/margins['totalpop'] - 1) < 1e-5
+            for category, target in margins['typmen'].iteritems():
+                assert abs(weights[typmen == category].sum()/target - 1) < 1e-5
+            frame = store[key + '/margins']
+            assert np.allclose(frame['marge'].values, frame[u"cible ajustée"].values)
+    finally:
+        store.close()
+
+
+def test_calibrate_all_errors(tmpdir, monkeypatch):
+    monkeypatch.setattr(calibration_batch, 'SurveySimulation', Simulation)
+    store_filename = os.path.join(str(tmpdir), 'calibrations.h5')
+    job = (2010, os.path.join(str(tmpdir), 'missing.csv'), 'linear', 2, 2)
+
+    errors = calibration_batch.calibrate_all([job], store_filename, processes = 1)
+
+    assert job in errors
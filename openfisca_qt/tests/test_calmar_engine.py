@@ -0,0 +1,195 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+import pytest
+from scipy import sparse
+
+from openfisca_qt.survey.calmar_engine import CalmarEngine, calmar, factorize, get_newton_step
+
+
+def get_mixed_scale_case(mu, size = 20000, seed = 0):
+    """
+    Returns data and margins mixing counts of categories with a total of euros
+    """
+    rng = np.random.RandomState(seed)
+    age = rng.randint(0, 5, size)
+    sex = rng.randint(0, 2, size)
+    income = rng.lognormal(mu, 1, size)
+    weights = rng.uniform(50, 150, size)
+    target_weights = weights*rng.uniform(.8, 1.25, size)
+    data = dict(age = age, sex = sex, income = income, wprm_init = weights)
+    margins = dict(
+        age = dict((category, target_weights[age == category].sum()) for category in range(5)),
+        sex = dict((category, target_weights[sex == category].sum()) for category in range(2)),
+        income = (target_weights*income).sum(),
+        totalpop = target_weights.sum(),
+        )
+    return data, margins
+
+
+def check_margins(engine, weights, margins, precision):
+    reached = engine.get_margins(weights)
+    for var, val in margins.iteritems():
+        if var == 'totalpop':
+            assert abs(weights.sum()/val - 1) < precision
+        elif isinstance(val, dict):
+            for category, target in val.iteritems():
+                assert abs(reached[var][category]/target - 1) < precision, (var, category)
+        else:
+            assert abs(reached[var]/val - 1) < precision, var
+
+
+def test_mixed_scale_margins():
+    for mu in (10, 12):
+        data, margins = get_mixed_scale_case(mu)
+        for param, maxiter in [(dict(method = 'linear'), 1),
+                               (dict(method = 'raking ratio'), 4),
+                               (dict(method = 'logit', lo = .5, up = 2), 4)]:
+            engine = CalmarEngine()
+            engine.set_data(data, margins, 'wprm_init')
+            weights, lambdasol, margins_new = engine.solve(margins, param = param)
+            assert engine.iterations <= maxiter, (mu, param, engine.iterations)
+            check_margins(engine, weights, margins, 1e-6)
+
+
+def test_newton_step_mixed_scales():
+    data, margins = get_mixed_scale_case(12, size = 2000)
+    engine = CalmarEngine()
+    engine.set_data(data, margins, 'wprm_init')
+    x = engine.design
+    hessian = x.T.dot(sparse.diags(engine.weights_init).dot(x))
+    gap = x.T.dot(engine.weights_init) - engine.get_targets(margins)[0]
+    # The hessian of the unscaled design is singular (collinear categories) and spans about
+    # twenty orders of magnitude: the step still fits the margins of the linear method
+    for matrix in (hessian, hessian.toarray()):
+        step = get_newton_step(matrix, gap)
+        weights = engine.weights_init*(1 + x.dot(step))
+        check_margins(engine, weights, margins, 1e-6)
+
+
+def test_invalid_weights_are_kept():
+    data, margins = get_mixed_scale_case(10, size = 1000)
+    data['wprm_init'][:3] = [0, np.nan, -1]
+    weights, lambdasol, margins_new = calmar(data, margins, param = dict(method = 'raking ratio'))
+    assert weights[0] == 0 and np.isnan(weights[1]) and weights[2] == -1
+    assert (weights[3:] > 0).all()
+
+
+def test_warm_start():
+    data, margins = get_mixed_scale_case(12, size = 5000)
+    engine = CalmarEngine()
+    engine.set_data(data, margins, 'wprm_init')
+    param = dict(method = 'logit', lo = .5, up = 2)
+    weights, lambdasol, margins_new = engine.solve(margins, param = param)
+    warm_weights = engine.solve(margins, param = param, lambda0 = lambdasol)[0]
+    assert engine.iterations == 0
+    assert np.allclose(warm_weights, weights)
+
+
+def test_replicates_match_solve():
+    data, margins = get_mixed_scale_case(12, size = 3000)
+    rng = np.random.RandomState(1)
+    # A fine categorical margin gives a sparse hessian
+    data['cell'] = rng.randint(0, 600, 3000)
+    margins['cell'] = dict((cell, margins['totalpop']*(data['cell'] == cell).mean())
+                           for cell in np.unique(data['cell']))
+    param = dict(method = 'raking ratio')
+    engine = CalmarEngine()
+    engine.set_data(data, margins, 'wprm_init')
+    engine.solve(margins, param = param)
+    replicates = data['wprm_init']*rng.exponential(1, (5, 3000))
+    replicates[2, :50] = 0
+    replicate_weights = engine.solve_replicates(replicates, margins, param = param, chunk_size = 2)
+    assert (replicate_weights[2, :50] == 0).all()
+    for replicate, weights in zip(replicates, replicate_weights):
+        replicate_data = dict(data, wprm_init = replicate)
+        expected = calmar(replicate_data, margins, param = param)[0]
+        assert np.allclose(weights, expected, rtol = 1e-5)
+
+
+def test_trace():
+    data, margins = get_mixed_scale_case(12, size = 5000)
+    engine = CalmarEngine()
+    engine.set_data(data, margins, 'wprm_init')
+    engine.solve(margins, param = dict(method = 'logit', lo = .5, up = 2))
+    trace = engine.get_trace()
+    assert list(trace['iteration']) == range(engine.iterations + 1)
+    assert trace['max_gap'].iloc[-1] <= 1e-6
+    assert trace['max_gap'].iloc[-1] < trace['max_gap'].iloc[0]
+    assert (trace['ratio_min'].iloc[1:] >= .5 - 1e-9).all()
+    assert (trace['ratio_max'].iloc[1:] <= 2 + 1e-9).all()
+    assert trace['worst_margin'].iloc[0] in engine.constraints
+    # The trace is emptied by every solve
+    engine.solve(margins, param = dict(method = 'linear'))
+    assert len(engine.get_trace()) == engine.iterations + 1
+
+
+def test_no_convergence_describes_gap():
+    data, margins = get_mixed_scale_case(10, size = 1000)
+    engine = CalmarEngine()
+    engine.set_data(data, margins, 'wprm_init')
+    with pytest.raises(Exception) as excinfo:
+        engine.solve(margins, param = dict(method = 'logit', lo = .5, up = 2, maxiter = 0))
+    assert "max relative margin gap" in str(excinfo.value)
+    assert len(engine.get_trace()) == 1
+
+
+def test_factorize():
+    labels, codes = factorize(np.array([3, 1, 3, 2]))
+    assert labels == [1, 2, 3]
+    assert list(codes) == [2, 0, 2, 1]
+    # Only the combinations present in the data are categories of a crossed variable
+    labels, codes = factorize((np.array([1, 1, 2, 2]), np.array(['a', 'b', 'a', 'a'])))
+    assert labels == [(1, 'a'), (1, 'b'), (2, 'a')]
+    assert list(codes) == [0, 1, 2, 2]
+
+
+def test_categorical_design():
+    data = dict(cell = np.array([5, 7, 5, 9]), wprm_init = np.ones(4))
+    engine = CalmarEngine()
+    # Categories of the data without margin are left out of the design
+    engine.set_data(data, dict(cell = {5: 2, 7: 1}), 'wprm_init')
+    assert engine.design.shape == (4, 3)
+    assert engine.design[:, 0].toarray().ravel().tolist() == [1, 0, 1, 0]
+    assert engine.constraints[:2] == [('cell', 5), ('cell', 7)]
+    with pytest.raises(Exception):
+        engine.set_data(data, dict(cell = {5: 2, 8: 1}), 'wprm_init')
+
+
+def test_crossed_margins():
+    data, margins = get_mixed_scale_case(10, size = 5000)
+    rng = np.random.RandomState(2)
+    region = rng.randint(0, 300, 5000)
+    target_weights = data['wprm_init']*rng.uniform(.8, 1.25, 5000)
+    data['crossed'] = (data['sex'], region)
+    margins = dict(totalpop = target_weights.sum(),
+                   crossed = dict((key, target_weights[(data['sex'] == key[0]) & (region == key[1])].sum())
+                                  for key in set(zip(data['sex'], region))))
+    engine = CalmarEngine()
+    engine.set_data(data, margins, 'wprm_init')
+    weights = engine.solve(margins, param = dict(method = 'raking ratio'))[0]
+    check_margins(engine, weights, margins, 1e-6)
@@ -0,0 +1,112 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+import pytest
+from pandas import DataFrame
+
+from openfisca_qt.survey.grouped import GroupIndex, same_values
+
+
+def get_case(size = 1000, seed = 0):
+    rng = np.random.RandomState(seed)
+    by = rng.randint(0, 4, size).astype(float)
+    by[rng.uniform(size = size) < .05] = np.nan
+    values = rng.lognormal(8, 1, size)
+    weights = rng.uniform(50, 150, size)
+    return by, values, weights
+
+
+def weighted_quantile(values, weights, probability):
+    order = np.argsort(values, kind = 'mergesort')
+    cumulated = np.cumsum(weights[order])
+    position = np.searchsorted(cumulated, probability*cumulated[-1])
+    return values[order][min(position, len(values) - 1)]
+
+
+def test_sum_and_mean():
+    by, values, weights = get_case()
+    index = GroupIndex(by, weights)
+    frame = DataFrame(dict(by = by, values = values*weights, weights = weights))
+    expected = frame.groupby('by').sum()
+    assert len(index) == 4
+    assert (index.groups == expected.index.values).all()
+    assert np.allclose(index.sum(values), expected['values'].values)
+    assert np.allclose(index.mean(values), (expected['values']/expected['weights']).values)
+
+
+def test_unweighted():
+    by = np.array(['b', 'a', 'b', 'c'])
+    index = GroupIndex(by)
+    assert list(index.groups) == ['a', 'b', 'c']
+    assert (index.sum([1, 2, 3, 4]) == [2, 4, 4]).all()
+    assert (index.mean([1, 2, 3, 4]) == [2, 2, 4]).all()
+
+
+def test_quantiles():
+    by, values, weights = get_case()
+    index = GroupIndex(by, weights)
+    quantiles = index.quantiles(values, [.1, .5, .9])
+    for position, group in enumerate(index.groups):
+        selected = by == group
+        for column, probability in enumerate([.1, .5, .9]):
+            expected = weighted_quantile(values[selected], weights[selected], probability)
+            assert quantiles[position, column] == expected
+    assert (index.median(values) == quantiles[:, 1]).all()
+
+
+def test_quantiles_of_group_without_weight():
+    index = GroupIndex([0, 0, 1, 1], [1, 1, 0, 0])
+    medians = index.median([1, 2, 3, 4])
+    assert medians[0] == 1
+    assert np.isnan(medians[1])
+
+
+def test_set_weights():
+    by, values, weights = get_case()
+    index = GroupIndex(by)
+    assert not index.has_weights(weights)
+    index.set_weights(weights)
+    assert index.has_weights(weights)
+    assert np.allclose(index.sum(values), GroupIndex(by, weights).sum(values))
+    with pytest.raises(Exception):
+        index.set_weights(weights[:-1])
+
+
+def test_has_groups():
+    by, values, weights = get_case()
+    index = GroupIndex(by, weights)
+    assert index.has_groups(by.copy())
+    changed = by.copy()
+    changed[0] = 5
+    assert not index.has_groups(changed)
+    assert not index.has_groups(by[:-1])
+
+
+def test_same_values():
+    assert same_values([1, np.nan], [1, np.nan])
+    assert not same_values([1, np.nan], [1, 2])
+    assert not same_values([1, 2], [1, 2, 3])
@@ -0,0 +1,74 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+
+from openfisca_qt.survey.indicators import IncomeDistribution
+
+
+def test_gini():
+    # Mean absolute difference of (1, 2, 3, 4) is 20/16, divided by twice the mean 2.5
+    assert abs(IncomeDistribution([4, 1, 3, 2]).gini() - .25) < 1e-12
+    assert abs(IncomeDistribution([5, 5, 5]).gini()) < 1e-12
+    # One observation holding all the income among n
+    assert abs(IncomeDistribution([0, 0, 0, 10]).gini() - .75) < 1e-12
+
+
+def test_theil():
+    # mean of r*log(r) with r = x/2.5
+    assert abs(IncomeDistribution([1, 2, 3, 4]).theil() - 0.10644013528622318) < 1e-12
+    # Zero incomes are left out
+    assert abs(IncomeDistribution([0, 1, 2, 3, 4]).theil() - 0.10644013528622318) < 1e-12
+
+
+def test_atkinson():
+    distribution = IncomeDistribution([1, 2, 3, 4])
+    # 1 - geometric mean/mean
+    assert abs(distribution.atkinson(1) - (1 - 24**.25/2.5)) < 1e-12
+    # 1 - harmonic mean/mean = 1 - 1.92/2.5
+    assert abs(distribution.atkinson(2) - .232) < 1e-12
+    # 1 - mean(sqrt(x))**2/mean
+    assert abs(distribution.atkinson(.5) - 0.05558585736954513) < 1e-12
+
+
+def test_poverty():
+    fgt = IncomeDistribution([3, 1, 4, 2]).poverty([2, 2.5], alphas = (0, 1, 2))
+    # Incomes strictly below the line are poor
+    assert abs(fgt[(2, 0)] - .25) < 1e-12
+    assert abs(fgt[(2, 1)] - .5/4) < 1e-12
+    # Gaps of 1 and 2 are (1.5 + .5)/2.5 = .8, their squares .36 + .04
+    assert abs(fgt[(2.5, 0)] - .5) < 1e-12
+    assert abs(fgt[(2.5, 1)] - .2) < 1e-12
+    assert abs(fgt[(2.5, 2)] - .1) < 1e-12
+
+
+def test_weights_are_replications():
+    # Integer weights give the indicators of the replicated observations
+    weighted = IncomeDistribution([1, 2, 5], weights = [3, 1, 2]).compute()
+    replicated = IncomeDistribution([1, 1, 1, 2, 5, 5]).compute()
+    assert sorted(weighted) == sorted(replicated)
+    for name, value in weighted.iteritems():
+        assert abs(value - replicated[name]) < 1e-12, name
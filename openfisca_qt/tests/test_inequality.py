@@ -0,0 +1,131 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+import pytest
+from pandas import DataFrame
+
+from openfisca_qt.survey.inequality import Inequality
+from openfisca_qt.survey.quantiles import WeightedQuantiles
+from openfisca_qt.tests.fake_survey import Simulation, set_output_table
+
+
+def get_inequality(households = 2000):
+    """
+    Returns an Inequality of standards of living by household, and of salaries by individual
+    """
+    simulation = Simulation(households)
+    simulation.set_config(year = 2010)
+    simulation.set_survey()
+    table = simulation.survey.table
+    rng = np.random.RandomState(2)
+    nivvie = table['revdisp'].values/(1 + table.groupby('idmen')['idmen'].transform(len).values/2)
+    set_output_table(simulation, {'nivvie_ini': nivvie*1.2, 'nivvie_net': nivvie*1.1, 'nivvie': nivvie,
+                                  'salaire': rng.lognormal(9, 1, len(table))})
+    inequality = Inequality()
+    inequality.simulation = simulation
+    inequality.vars = {'nivvie_ini': ['men'], 'nivvie_net': ['men'], 'nivvie': ['men'], 'salaire': ['ind']}
+    return inequality
+
+
+def get_expected_quantiles(inequality, varname, entity, quantiles = 10):
+    output = inequality.simulation.output_table
+    survey = inequality.simulation.survey
+    weighted_quantiles = WeightedQuantiles(survey.get_value('wprm', entity)*survey.get_value('champm', entity))
+    weighted_quantiles.set_values(varname, output.get_value(varname, entity))
+    return weighted_quantiles.get_quantiles(varname, quantiles)
+
+
+def test_quantiles_by_entity():
+    inequality = get_inequality()
+    inequality.compute()
+
+    assert sorted(inequality.weighted_quantiles) == ['ind', 'men']
+    thresholds = inequality.get_quantiles(grids = (10, 20))
+    for varname, entity in [('nivvie', 'men'), ('nivvie_ini', 'men'), ('salaire', 'ind')]:
+        for quantiles in (10, 20):
+            assert np.allclose(thresholds[quantiles][varname], get_expected_quantiles(inequality, varname, entity,
+                                                                                      quantiles))
+    deciles = get_expected_quantiles(inequality, 'nivvie', 'men')
+    frame = inequality.inequality_dataframe.set_index('index')
+    assert np.allclose(frame['nivvie'][['D%s' % decile for decile in range(1, 10)]], deciles[1:-1])
+
+
+def test_confidence_intervals_by_entity():
+    inequality = get_inequality(500)
+    inequality.compute()
+    intervals = inequality.compute_confidence_intervals(replicates = 40, chunk_size = 15, seed = 0)
+
+    assert sorted(intervals) == ['nivvie', 'nivvie_ini', 'nivvie_net', 'salaire']
+    for varname, frame in intervals.iteritems():
+        assert (frame['lower'] <= frame['upper']).all()
+        assert frame['std']['Moyenne'] > 0
+    # The household replicates do not depend on the variables of the other entities
+    households = get_inequality(500)
+    households.vars = {'nivvie_ini': ['men'], 'nivvie_net': ['men'], 'nivvie': ['men']}
+    households.compute()
+    expected = households.compute_confidence_intervals(replicates = 40, chunk_size = 15, seed = 0)
+    assert np.allclose(intervals['nivvie'].values, expected['nivvie'].values, equal_nan = True)
+
+
+def test_confidence_intervals_replicate_weights():
+    inequality = get_inequality(500)
+    inequality.compute()
+    survey = inequality.simulation.survey
+    rng = np.random.RandomState(3)
+    replicate_weights = {}
+    for entity in ['men', 'ind']:
+        weights = survey.get_value('wprm', entity)
+        replicate_weights[entity] = weights*rng.uniform(.5, 1.5, (30, len(weights)))
+    intervals = inequality.compute_confidence_intervals(replicate_weights = replicate_weights)
+    assert intervals['salaire']['std']['Moyenne'] > 0
+
+    with pytest.raises(Exception):
+        inequality.compute_confidence_intervals(replicate_weights = replicate_weights['men'])
+    del replicate_weights['ind']
+    with pytest.raises(Exception):
+        inequality.compute_confidence_intervals(replicate_weights = replicate_weights)
+
+
+def test_compute_from_chunks():
+    inequality = get_inequality()
+    inequality.vars = {'nivvie_ini': ['men'], 'nivvie_net': ['men'], 'nivvie': ['men']}
+    inequality.compute()
+    expected = inequality.inequality_dataframe.set_index('index')
+
+    output = inequality.simulation.output_table
+    survey = inequality.simulation.survey
+    frame = DataFrame(dict((varname, output.get_value(varname, 'men')) for varname in inequality.vars))
+    frame['wprm'] = survey.get_value('wprm', 'men')
+    frame['champm'] = survey.get_value('champm', 'men')
+    messages = []
+    inequality.compute(progress = messages.append, chunks = (frame[start:start + 300]
+                                                              for start in range(0, len(frame), 300)))
+    assert len(messages) == 7
+    assert inequality.inputs == {}
+    streamed = inequality.inequality_dataframe.set_index('index')
+    assert np.allclose(streamed['nivvie']['Moyenne'], expected['nivvie']['Moyenne'])
+    assert np.allclose(streamed['nivvie'], expected['nivvie'], rtol = .01)
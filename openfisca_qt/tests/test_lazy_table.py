@@ -0,0 +1,89 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+from pandas import DataFrame, HDFStore
+
+from openfisca_qt.survey.lazy_table import LazyTable, get_survey_key
+
+
+# Rows of 1 MB float64 columns
+SIZE = 2**17
+
+
+def get_survey(tmpdir, format = 'fixed'):
+    rng = np.random.RandomState(0)
+    frame = DataFrame(dict((name, rng.uniform(size = SIZE)) for name in 'abcd'))
+    frame['idmen'] = np.arange(SIZE)//3
+    filename = str(tmpdir.join('survey_%s.h5' % format))
+    store = HDFStore(filename)
+    try:
+        store.put('survey_2006', frame, format = format)
+    finally:
+        store.close()
+    return filename, frame
+
+
+def test_lru_eviction(tmpdir):
+    filename, frame = get_survey(tmpdir)
+    assert get_survey_key(filename, 2009) == 'survey_2006'
+    table = LazyTable(filename, 'survey_2006', budget = 3, preload = ['idmen'])
+    try:
+        assert list(table.cache) == ['idmen']
+        table.fetch(['a'])
+        table.fetch(['b'])
+        assert list(table.cache) == ['idmen', 'a', 'b']
+        # a becomes the most recently used column, b is dropped to read c
+        table.fetch(['a'])
+        table.fetch(['c'])
+        assert list(table.cache) == ['idmen', 'a', 'c']
+        assert table.nbytes == 3*2**20
+        # Requested columns are kept even beyond the budget, preloaded ones are never dropped
+        arrays = table.fetch(['b', 'c', 'd'])
+        assert sorted(table.cache) == ['b', 'c', 'd', 'idmen']
+        for name in 'bcd':
+            assert (arrays[name] == frame[name].values).all()
+        table.fetch(['a'])
+        assert list(table.cache) == ['idmen', 'd', 'a']
+        assert table.nbytes <= table.budget*2**20
+        assert (table['a'] == frame['a']).all()
+    finally:
+        table.close()
+
+
+def test_rows(tmpdir):
+    for format in ('fixed', 'table'):
+        filename, frame = get_survey(tmpdir, format)
+        table = LazyTable(filename, 'survey_2006', budget = 1, preload = ['idmen'])
+        try:
+            chunks = list(table.iter_rows(['idmen', 'b'], chunks_count = 3))
+            assert len(chunks) == 3
+            rows = DataFrame(np.concatenate([chunk.values for chunk in chunks]), columns = ['idmen', 'b'])
+            assert (rows.values == frame[['idmen', 'b']].values).all()
+            # The rows read chunk by chunk are not kept
+            assert list(table.cache) == ['idmen']
+        finally:
+            table.close()
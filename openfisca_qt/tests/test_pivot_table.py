@@ -0,0 +1,280 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import threading
+
+import numpy as np
+from pandas import concat
+import pytest
+
+from openfisca_qt.survey.pivot_table import OpenfiscaPivotTable
+from openfisca_qt.survey.result_store import ResultStore
+from openfisca_qt.survey.streaming import aggregate_entity_chunks, iter_chunks
+from openfisca_qt.tests.fake_survey import Simulation, Survey, get_entity_frame, get_survey_table, set_output_table
+
+
+VARNAMES = ['so', 'champm', 'wprm', 'loyer', 'revdisp']
+
+
+def get_pivot_table(households = 2000):
+    """
+    Returns a pivot table of household data, the default revdisp being lower than the current one
+    for two households out of three
+    """
+    simulation = Simulation(households)
+    simulation.set_config(year = 2010)
+    simulation.set_survey()
+    data = get_entity_frame(simulation.survey, VARNAMES)
+    data_default = data.copy()
+    rng = np.random.RandomState(1)
+    data_default['revdisp'] = data['revdisp']*rng.choice([.9, 1.1, .95], len(data))
+    pivot_table = OpenfiscaPivotTable()
+    pivot_table.simulation = simulation
+    pivot_table.set_data(data, data_default)
+    return pivot_table
+
+
+def get_weighted_means(data, varname, by = 'so', champm = True):
+    weights = data['wprm'].values*(data['champm'].values if champm else 1)
+    categories = np.unique(data[by].values)
+    return np.array([(weights*data[varname].values)[data[by].values == category].sum()
+                     /weights[data[by].values == category].sum() for category in categories])
+
+
+def test_group_by_means():
+    pivot_table = get_pivot_table()
+    aggr = pivot_table.group_by(['loyer', 'revdisp'], 'so')
+
+    data, data_default = pivot_table.data, pivot_table.data_default
+    current, default = aggr['data'], aggr['default']
+    assert list(current['so']) == list(np.unique(data['so']))
+    weights = data['wprm']*data['champm']
+    assert np.allclose(current['wprm'], [weights[data['so'] == so].sum() for so in current['so']])
+    for varname in ['loyer', 'revdisp']:
+        assert np.allclose(current[varname], get_weighted_means(data, varname))
+        assert np.allclose(default[varname + '__init'], get_weighted_means(data_default, varname))
+
+
+def test_group_by_without_champm_and_weights():
+    pivot_table = get_pivot_table()
+    data = pivot_table.data
+    aggr = pivot_table.group_by(['revdisp'], 'so', champm = False)
+    assert np.allclose(aggr['data']['revdisp'], get_weighted_means(data, 'revdisp', champm = False))
+
+    aggr = pivot_table.group_by(['revdisp'], 'so', champm = False, do_not_use_weights = True)
+    assert np.allclose(aggr['data']['revdisp'], data.groupby('so')['revdisp'].mean().values)
+    assert np.allclose(aggr['data']['wprm'], data.groupby('so').size().values)
+
+
+def test_format_table():
+    pivot_table = get_pivot_table()
+    frame = pivot_table.format_table(pivot_table.group_by(['revdisp'], 'so'), 'so')
+    assert sorted(frame.columns) == sorted([u"Statut d'occupation", u"Poids du ménage", u"Revenu disponible",
+                                            u"Revenu disponible init."])
+
+
+def get_weighted_quantile(values, weights, probability):
+    """
+    Returns the first value at which the cumulated weight reaches the probability
+    """
+    order = np.argsort(values, kind = 'mergesort')
+    cumulated = np.cumsum(weights[order])
+    return values[order][np.searchsorted(cumulated, probability*cumulated[-1])]
+
+
+def test_column_spec():
+    pivot_table = OpenfiscaPivotTable()
+    assert pivot_table.get_column_spec('revdisp') == {'data': ['current', 'default'], 'transform': ['mean'],
+                                                       'diff': []}
+    pivot_table.set_column_spec('revdisp', data = ['current'], transform = ['median', 'q90'])
+    assert pivot_table.get_column_spec('revdisp') == {'data': ['current'], 'transform': ['median', 'q90'],
+                                                       'diff': []}
+    with pytest.raises(Exception):
+        pivot_table.set_column_spec('revdisp', transform = ['mode'])
+    with pytest.raises(Exception):
+        pivot_table.set_column_spec('revdisp', diff = ['ratio'])
+
+
+def test_group_by_quantiles():
+    pivot_table = get_pivot_table()
+    pivot_table.set_column_spec('revdisp', transform = ['mean', 'median', 'q10', 'q90'])
+    aggr = pivot_table.group_by(['revdisp'], 'so')
+
+    for name, suffix in [('data', ''), ('default', '__init')]:
+        data = getattr(pivot_table, 'data' if name == 'data' else 'data_default')
+        weights = data['wprm'].values*data['champm'].values
+        for position, so in enumerate(aggr[name]['so']):
+            selected = data['so'].values == so
+            for transform, probability in [('median', .5), ('q10', .1), ('q90', .9)]:
+                expected = get_weighted_quantile(data['revdisp'].values[selected], weights[selected], probability)
+                assert aggr[name]['revdisp__' + transform + suffix].iloc[position] == expected
+
+
+def test_group_by_diffs():
+    pivot_table = get_pivot_table()
+    pivot_table.set_column_spec('revdisp', transform = ['mean', 'median'],
+                                diff = ['absolute', 'relative', 'winners', 'loosers'])
+    aggr = pivot_table.group_by(['revdisp'], 'so')
+
+    current, default = aggr['data'], aggr['default']
+    for transform in ['', '__median']:
+        difference = current['revdisp' + transform].values - default['revdisp' + transform + '__init'].values
+        assert np.allclose(current['revdisp' + transform + '__diff'], difference)
+        assert np.allclose(current['revdisp' + transform + '__reldiff'],
+                           difference/default['revdisp' + transform + '__init'].values)
+    data, data_default = pivot_table.data, pivot_table.data_default
+    weights = data['wprm']*data['champm']
+    delta = data['revdisp'] - data_default['revdisp']
+    for position, so in enumerate(current['so']):
+        selected = data['so'] == so
+        assert np.allclose(current['revdisp__winners'].iloc[position], weights[selected & (delta > 0)].sum())
+        assert np.allclose(current['revdisp__loosers'].iloc[position], weights[selected & (delta < 0)].sum())
+    # Winners and loosers are all the households with a changed revenue
+    assert np.allclose(current['revdisp__winners'] + current['revdisp__loosers'], current['wprm'])
+
+    frame = pivot_table.format_table(aggr, 'so')
+    assert u"Revenu disponible médiane écart relatif" in frame.columns
+    assert u"Revenu disponible gagnants" in frame.columns
+
+
+def get_aligned_arrays(pivot_table):
+    """
+    Returns the (values, default values) arrays of the data of a pivot table
+    """
+    data, data_default = pivot_table.data, pivot_table.data_default
+    return dict((name, (data[name].values, data_default[name].values)) for name in data.columns)
+
+
+def test_group_by_aligned():
+    pivot_table = get_pivot_table()
+    pivot_table.set_column_spec('revdisp', transform = ['mean', 'median'],
+                                diff = ['absolute', 'relative', 'winners', 'loosers'])
+    aligned = pivot_table.group_by_aligned(get_aligned_arrays(pivot_table), ['revdisp', 'loyer'], 'so')
+
+    # The default data has the groups of the current data: both modes agree
+    aggr = pivot_table.group_by(['revdisp', 'loyer'], 'so')
+    expected = aggr['data'].merge(aggr['default'].drop('wprm', axis = 1), on = 'so')
+    assert sorted(aligned.columns) == sorted(expected.columns)
+    for column in expected.columns:
+        assert np.allclose(aligned[column], expected[column])
+
+    frame = pivot_table.format_table({'data': aligned}, 'so')
+    assert u"Revenu disponible médiane écart relatif" in frame.columns
+
+
+def test_group_by_aligned_index():
+    pivot_table = get_pivot_table()
+    arrays = get_aligned_arrays(pivot_table)
+    weighted = pivot_table.group_by_aligned(arrays, ['revdisp'], 'so')
+    index = pivot_table.aligned_index
+    assert pivot_table.group_by_aligned(arrays, ['revdisp'], 'so') is not None
+    assert pivot_table.aligned_index is index
+
+    # Other weights replace the index instead of modifying it
+    weights = index.weights.copy()
+    unweighted = pivot_table.group_by_aligned(arrays, ['revdisp'], 'so', champm = False, do_not_use_weights = True)
+    assert pivot_table.aligned_index is not index
+    assert np.array_equal(index.weights, weights)
+    data = pivot_table.data
+    assert np.allclose(unweighted['revdisp'], data.groupby('so')['revdisp'].mean().values)
+    assert np.allclose(weighted['revdisp'], get_weighted_means(data, 'revdisp'))
+
+
+def test_group_by_aligned_threads():
+    pivot_table = get_pivot_table()
+    pivot_table.set_column_spec('revdisp', diff = ['winners', 'loosers'])
+    arrays = get_aligned_arrays(pivot_table)
+    expected = dict((flag, pivot_table.group_by_aligned(arrays, ['revdisp', 'loyer'], 'so', do_not_use_weights = flag))
+                    for flag in [False, True])
+    errors = []
+
+    def compute(flag):
+        for count in range(20):
+            aggr = pivot_table.group_by_aligned(arrays, ['revdisp', 'loyer'], 'so', do_not_use_weights = flag)
+            if not all(np.allclose(aggr[column], expected[flag][column]) for column in aggr.columns):
+                errors.append(flag)
+
+    threads = [threading.Thread(target = compute, args = (position % 2 == 0,)) for position in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert not errors
+
+
+def test_aggregate_entity_chunks():
+    table = get_survey_table(300)
+    heads = table['quimen'].values == 0
+    # Chunks of 37 individuals split most of the households
+    aggregated = concat(list(aggregate_entity_chunks(iter_chunks(table, chunk_size = 37), 'men', ['so', 'revdisp'])),
+                        ignore_index = True)
+    assert list(aggregated['idmen']) == range(300)
+    assert 'quimen' not in aggregated
+    assert np.array_equal(aggregated['so'], table['so'].values[heads])
+    assert np.array_equal(aggregated['revdisp'], table['revdisp'].values[heads])
+    assert np.allclose(aggregated['agegroup'], np.bincount(table['idmen'].values, weights = table['agegroup'].values))
+
+    chunks = aggregate_entity_chunks(iter_chunks((table, table[['revdisp']]*2), chunk_size = 37), 'men', ['revdisp'])
+    data, data_default = [concat(frames, ignore_index = True) for frames in zip(*list(chunks))]
+    assert np.allclose(data_default['revdisp'], 2*data['revdisp'])
+
+    with pytest.raises(Exception):
+        list(aggregate_entity_chunks(iter_chunks(table.iloc[::-1], chunk_size = 37), 'men'))
+
+
+def get_stored_simulation(directory, households = 500):
+    """
+    Returns a simulation, a result store in directory and the key of the stored simulation, the
+    current revdisp being higher than the default one
+    """
+    simulation = Simulation(households)
+    simulation.set_config(year = 2010)
+    simulation.set_survey()
+    directory.join('survey.h5').write('survey')
+    simulation.survey_filename = str(directory.join('survey.h5'))
+    simulation.datesim = '2010-01-01'
+    set_output_table(simulation, {'revdisp': simulation.survey.table['revdisp'].values*1.1})
+    simulation.output_table_default = Survey(simulation.survey.table.copy())
+    store = ResultStore(str(directory.join('results')))
+    return simulation, store, store.save(simulation)
+
+
+def test_get_table_from_stored_chunks(tmpdir):
+    simulation, store, key = get_stored_simulation(tmpdir)
+    pivot_table = OpenfiscaPivotTable()
+    pivot_table.simulation = simulation
+    frame = pivot_table.get_table(by = 'so', vars = ['revdisp', 'loyer'], chunks_count = 7, store = store, key = key)
+
+    pivot_table.set_data(get_entity_frame(simulation.output_table, VARNAMES),
+                         get_entity_frame(simulation.output_table_default, VARNAMES))
+    expected = pivot_table.format_table(pivot_table.group_by(['revdisp', 'loyer'], 'so'), 'so')
+    assert sorted(frame.columns) == sorted(expected.columns)
+    for column in expected.columns:
+        assert np.allclose(frame[column], expected[column])
+    assert np.allclose(frame[u"Revenu disponible"], 1.1*frame[u"Revenu disponible init."])
+
+    with pytest.raises(Exception):
+        pivot_table.get_table(by = 'so', vars = ['revdisp'], chunks_count = 7)
@@ -0,0 +1,116 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+
+from openfisca_qt.survey.quantiles import WeightedQuantiles, WeightedQuantileSketch
+
+
+def get_exact_quantiles(values, weights, probabilities):
+    """
+    Returns the first values at which the cumulated weights reach the probabilities
+    """
+    order = np.argsort(values, kind = 'mergesort')
+    cumulated = np.cumsum(weights[order])
+    positions = np.searchsorted(cumulated, np.asarray(probabilities)*cumulated[-1])
+    return values[order][np.minimum(positions, len(values) - 1)]
+
+
+def get_ranks(values, weights, thresholds):
+    """
+    Returns the shares of the total weight below the thresholds
+    """
+    order = np.argsort(values, kind = 'mergesort')
+    cumulated = np.concatenate(([0], np.cumsum(weights[order])))
+    return cumulated[np.searchsorted(values[order], thresholds, side = 'right')]/cumulated[-1]
+
+
+def test_unit_weights_match_percentiles():
+    values = np.random.RandomState(0).lognormal(10, 1, 1001)
+    quantiles = WeightedQuantiles(np.ones(len(values)))
+    quantiles.set_values('x', values)
+    for grid in (10, 20, 100):
+        expected = np.percentile(values, np.linspace(0, 100, grid + 1))
+        assert np.allclose(quantiles.get_quantiles('x', grid), expected, rtol = 1e-12)
+
+
+def test_labels():
+    rng = np.random.RandomState(1)
+    values = rng.permutation(1000).astype(float)
+    quantiles = WeightedQuantiles(np.ones(len(values)))
+    quantiles.set_values('x', values)
+    labels = quantiles.get_labels('x', 10)
+    assert (np.bincount(labels)[1:] == 100).all()
+    assert (labels == values//100 + 1).all()
+
+
+def test_values_update():
+    rng = np.random.RandomState(2)
+    values = rng.lognormal(10, 1, 5000)
+    weights = rng.uniform(1, 10, 5000)
+    quantiles = WeightedQuantiles(weights)
+    quantiles.set_values('x', values)
+    quantiles.get_quantiles('x')
+    # The new sort starts from the previous order
+    values = values*rng.uniform(.95, 1.05, 5000)
+    quantiles.set_values('x', values)
+    fresh = WeightedQuantiles(weights)
+    fresh.set_values('x', values)
+    assert (quantiles.get_order('x') == fresh.get_order('x')).all()
+    assert np.allclose(quantiles.get_quantiles('x', 100), fresh.get_quantiles('x', 100))
+
+
+def test_exact_sketch():
+    rng = np.random.RandomState(3)
+    values = rng.randint(0, 50, 2000).astype(float)
+    weights = rng.uniform(1, 10, 2000)
+    sketch = WeightedQuantileSketch(exact_size = 5000).update(values, weights)
+    assert not sketch.compressed
+    probabilities = np.linspace(0, 1, 101)
+    assert (sketch.quantiles(probabilities) == get_exact_quantiles(values, weights, probabilities)).all()
+    quantiles = WeightedQuantiles(weights)
+    quantiles.set_values('x', values)
+    assert np.allclose(sketch.get_quantiles(20), quantiles.get_quantiles('x', 20))
+    assert WeightedQuantileSketch().update([1, 2, 3, 4]).quantile(.5) == 2
+
+
+def test_compressed_sketch_rank_error():
+    rng = np.random.RandomState(4)
+    values = rng.lognormal(10, 1, 200000)
+    weights = rng.uniform(100, 1000, 200000)
+    accuracy = .001
+    sketch = WeightedQuantileSketch(accuracy)
+    # Chunks merged as the workers do
+    for chunk in np.array_split(np.arange(len(values)), 7):
+        sketch.merge(WeightedQuantileSketch(accuracy).update(values[chunk], weights[chunk]))
+    assert sketch.compressed
+    assert len(sketch) <= sketch.size
+    assert abs(sketch.total_weight/weights.sum() - 1) < 1e-12
+    probabilities = np.linspace(.01, .99, 99)
+    ranks = get_ranks(values, weights, sketch.quantiles(probabilities))
+    assert np.abs(ranks - probabilities).max() < 2*accuracy
+    thresholds = sketch.get_quantiles(10)
+    assert thresholds[0] == values.min() and thresholds[-1] == values.max()
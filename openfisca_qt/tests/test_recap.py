@@ -0,0 +1,115 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+from pandas import Series
+import pytest
+
+from openfisca_qt.scripts.victor import recap
+from openfisca_qt.scripts.victor.recap import ErfAggregatesCache, Recap
+from openfisca_qt.survey import aggregates_batch
+from openfisca_qt.survey.aggregates import Aggregates
+from openfisca_qt.tests.test_aggregates_batch import VARLIST, get_simulation
+
+
+def get_erf_aggregates(year, variables):
+    """
+    Stand-in of recap.get_erf_aggregates
+    """
+    return Series(dict((variable, year + position) for position, variable in enumerate(variables)))
+
+
+def test_erf_aggregates_cache(tmpdir):
+    cache = ErfAggregatesCache(str(tmpdir.join('erf_aggregates.h5')))
+    cached, missing = cache.get(2009, ['af', 'cf'])
+    assert len(cached) == 0 and missing == ['af', 'cf']
+
+    cache.put(2009, Series({'af': 1., 'rsa': 2.}))
+    cache.put(2009, Series({'rsa': 3.}))
+    cached, missing = cache.get(2009, ['af', 'cf', 'rsa'])
+    assert cached.to_dict() == {'af': 1., 'rsa': 3.}
+    assert missing == ['cf']
+    assert cache.get(2010, ['af'])[1] == ['af']
+
+
+def get_recap(tmpdir, years = (2009, 2010), processes = 4):
+    recap_ = Recap()
+    recap_.set_years(list(years))
+    recap_.set_aggregates_variables(list(VARLIST))
+    recap_.processes = processes
+    recap_.erf_cache = ErfAggregatesCache(str(tmpdir.join('erf_aggregates.h5')))
+    return recap_
+
+
+def test_build_dataframe(monkeypatch, tmpdir):
+    monkeypatch.setattr(aggregates_batch, 'get_simulation', get_simulation)
+    monkeypatch.setattr(recap, 'get_erf_aggregates', get_erf_aggregates)
+    calls = []
+
+    def iter_years(years, **kwargs):
+        calls.append(kwargs['processes'])
+        return aggregates_batch.iter_years(years, **kwargs)
+
+    monkeypatch.setattr(recap, 'iter_years', iter_years)
+    recap_ = get_recap(tmpdir)
+    recap_.build_dataframe()
+    # The two ERFS jobs take half of the processes
+    assert calls == [2]
+
+    labels = Aggregates().labels
+    dep, benef = labels['dep'], labels['benef']
+    frame = recap_.dataframe
+    assert list(frame.index) == [(label, source) for label in [u"Revenu disponible", u"Loyer"]
+                                 for source in ['of', 'erfs', 'reel']]
+    for year in [2009, 2010]:
+        expected = aggregates_batch.run_year(year, varlist = VARLIST)['aggregates']
+        for variable, label in [('revdisp', u"Revenu disponible"), ('loyer', u"Loyer")]:
+            assert np.allclose(frame[(dep, year)][(label, 'of')], expected[dep][variable])
+            assert np.allclose(frame[(benef, year)][(label, 'of')], expected[benef][variable])
+        assert frame[(dep, year)][(u"Revenu disponible", 'erfs')] == year
+        assert frame[(dep, year)][(u"Loyer", 'erfs')] == year + 1
+        # No administrative nor ERFS beneficiaries: the values are missing, not zero
+        assert np.isnan(frame[(dep, year)][(u"Loyer", 'reel')])
+        assert np.isnan(frame[(benef, year)][(u"Loyer", 'erfs')])
+
+    # The ERFS aggregates are now read from the cache: no ERFS pool
+    def failing_erf_aggregates(year, variables):
+        raise Exception("ERFS data read again")
+
+    monkeypatch.setattr(recap, 'get_erf_aggregates', failing_erf_aggregates)
+    calls[:] = []
+    cached = get_recap(tmpdir)
+    cached.build_dataframe()
+    assert calls == [4]
+    assert cached.dataframe.equals(frame)
+
+
+def test_failed_year(monkeypatch, tmpdir):
+    monkeypatch.setattr(aggregates_batch, 'get_simulation', get_simulation)
+    monkeypatch.setattr(recap, 'get_erf_aggregates', get_erf_aggregates)
+    recap_ = get_recap(tmpdir, years = (2010, 2011))
+    with pytest.raises(Exception):
+        recap_.build_dataframe()
@@ -0,0 +1,187 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import logging
+
+import numpy as np
+from pandas import DataFrame
+
+from openfisca_qt.survey.result_store import ResultStore, compute_simulation
+
+
+class DataTable(object):
+    def __init__(self, table = None):
+        self.table = table
+
+
+class WatchedDataTable(DataTable):
+    """
+    DataTable counting the assignments of its table
+    """
+    def __init__(self, table = None):
+        object.__setattr__(self, 'assignments', 0)
+        super(WatchedDataTable, self).__init__(table)
+
+    def __setattr__(self, name, value):
+        if name == 'table':
+            object.__setattr__(self, 'assignments', self.assignments + 1)
+        object.__setattr__(self, name, value)
+
+
+class Simulation(object):
+    """
+    Stand-in of a survey simulation with the attributes used by the store
+    """
+    def __init__(self, survey_filename, year = 2010):
+        self.survey_filename = survey_filename
+        self.datesim = '%s-01-01' % year
+        self.P = {'af': {'taux': .32}}
+        self.input_table = DataTable()
+        self.output_table = DataTable()
+        self.output_table_default = None
+        self.computed = 0
+
+    def set_survey(self):
+        self.input_table.table = DataFrame({'sali': np.arange(5, dtype = np.float32)*1000,
+                                            'idmen': np.arange(5)//2,
+                                            'label': list('abcde')},
+                                           index = np.arange(10, 15))
+
+    def compute(self):
+        self.computed += 1
+        self.output_table.table = DataFrame({'revdisp': self.input_table.table['sali'].values*.8})
+
+
+def get_survey_file(tmpdir):
+    survey = tmpdir.join('survey.h5')
+    survey.write('survey')
+    return str(survey)
+
+
+def is_memory_mapped(values):
+    while values is not None:
+        if isinstance(values, np.memmap):
+            return True
+        values = values.base
+    return False
+
+
+def check_round_trip(tmpdir, compress):
+    store = ResultStore(str(tmpdir.join('results')), compress = compress)
+    simulation = Simulation(get_survey_file(tmpdir))
+    simulation.set_survey()
+    simulation.compute()
+    key = store.save(simulation)
+    assert store.has(key) and store.keys() == [key]
+    assert key == store.get_key(Simulation(simulation.survey_filename))
+
+    for mmap in (True, False):
+        stored = store.load_simulation(key, mmap = mmap)
+        assert stored.P == simulation.P
+        for name in ('input_table', 'output_table'):
+            table, expected = getattr(stored, name).table, getattr(simulation, name).table
+            assert list(table.columns) == list(expected.columns)
+            assert (table.index == expected.index).all()
+            for column in expected.columns:
+                assert table[column].dtype == expected[column].dtype
+                assert (table[column].values == expected[column].values).all()
+        table = stored.input_table.table
+        assert is_memory_mapped(table['sali'].values) == mmap
+        assert not is_memory_mapped(table['label'].values)
+
+    columns = store.load_columns(key, 'input_table', ['idmen'])
+    assert list(columns) == ['idmen'] and (columns['idmen'] == np.arange(5)//2).all()
+    assert list(store.load_table(key, 'input_table', ['sali', 'idmen']).columns) == ['sali', 'idmen']
+
+
+def test_round_trip(tmpdir):
+    check_round_trip(tmpdir.mkdir('compressed'), True)
+    check_round_trip(tmpdir.mkdir('uncompressed'), False)
+
+
+def test_key(tmpdir):
+    store = ResultStore(str(tmpdir.join('results')), version = 'test')
+    survey_filename = get_survey_file(tmpdir)
+    key = store.get_key(Simulation(survey_filename))
+    assert key == store.get_key(Simulation(survey_filename))
+    assert key != store.get_key(Simulation(survey_filename), options = {'loyer': 1.02})
+    assert key != ResultStore(str(tmpdir.join('results')), version = 'other').get_key(Simulation(survey_filename))
+    # The key follows the content of the survey file
+    tmpdir.join('survey.h5').write('other survey')
+    assert key != store.get_key(Simulation(survey_filename))
+
+
+def test_compute_simulation(tmpdir):
+    store = ResultStore(str(tmpdir.join('results')))
+    survey_filename = get_survey_file(tmpdir)
+    simulation = Simulation(survey_filename)
+    assert not compute_simulation(simulation, store, prepare = simulation.set_survey)
+    assert simulation.computed == 1
+
+    simulation = Simulation(survey_filename)
+    assert compute_simulation(simulation, store, prepare = simulation.set_survey)
+    assert simulation.computed == 0
+    assert (simulation.output_table.table['revdisp'].values == np.arange(5)*800).all()
+
+    # Other parameters, other results
+    simulation = Simulation(survey_filename)
+    simulation.P['af']['taux'] = .3
+    assert not compute_simulation(simulation, store, prepare = simulation.set_survey)
+    simulation = Simulation(survey_filename, 2011)
+    assert not compute_simulation(simulation, store, prepare = simulation.set_survey)
+    assert len(store.keys()) == 3
+
+
+def test_save_leaves_the_tables(tmpdir):
+    store = ResultStore(str(tmpdir.join('results')))
+    simulation = Simulation(get_survey_file(tmpdir))
+    simulation.input_table = WatchedDataTable()
+    simulation.set_survey()
+    simulation.compute()
+    table = simulation.input_table.table
+    assignments = simulation.input_table.assignments
+    key = store.save(simulation)
+    # The tables are left out by the pickler instead of being detached from the simulation
+    assert simulation.input_table.assignments == assignments
+    assert simulation.input_table.table is table
+
+    stored = store.load_simulation(key)
+    assert (stored.input_table.table['sali'].values == table['sali'].values).all()
+    assert (stored.output_table.table['revdisp'].values == np.arange(5)*800).all()
+
+
+def test_save_unpicklable_simulation(tmpdir, caplog):
+    store = ResultStore(str(tmpdir.join('results')))
+    simulation = Simulation(get_survey_file(tmpdir))
+    simulation.set_survey()
+    simulation.compute()
+    simulation.callback = lambda: None
+    with caplog.at_level(logging.WARNING):
+        key = store.save(simulation)
+    assert 'the simulation could not be pickled' in caplog.text
+    assert not store.get_manifest(key)['simulation']
+    assert simulation.output_table.table is not None
+    assert (store.load_table(key)['revdisp'].values == np.arange(5)*800).all()
@@ -0,0 +1,88 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import numpy as np
+import pytest
+
+from openfisca_qt.survey.weights import WeightsRegistry, get_members_index
+from openfisca_qt.tests.fake_survey import Survey, get_survey_table
+
+
+def get_registry(households = 50):
+    survey = Survey(get_survey_table(households))
+    registry = WeightsRegistry(survey, 'men', 'wprm')
+    registry.add('initial', survey.get_value('wprm_init', 'men'))
+    return survey, registry
+
+
+def test_members_index():
+    survey = Survey(get_survey_table(50))
+    members_index = get_members_index(survey, 'men')
+    assert (members_index == survey.table['idmen'].values).all()
+
+
+def test_members_without_entity():
+    survey = Survey(get_survey_table(50))
+    survey.index['men'][0]['idxIndi'] = survey.index['men'][0]['idxIndi'][1:]
+    with pytest.raises(Exception):
+        get_members_index(survey, 'men')
+
+
+def test_publish_in_place():
+    survey, registry = get_registry()
+    column = survey.table['wprm'].values
+    calibrated = 2*registry.get('initial')
+    registry.add('calibrated', calibrated)
+    registry.activate('calibrated')
+    registry.publish()
+    assert np.may_share_memory(column, survey.table['wprm'].values)
+    assert np.allclose(survey.table['wprm'].values, 2*survey.table['wprm_init'].values)
+    assert np.allclose(registry.get(entity = 'ind'), survey.table['wprm'].values)
+    registry.activate('initial')
+    registry.publish()
+    assert np.allclose(survey.table['wprm'].values, survey.table['wprm_init'].values)
+
+
+def test_publish_after_external_change():
+    survey, registry = get_registry()
+    registry.activate('initial')
+    registry.publish()
+    survey.table['wprm'].values[:] = 0
+    registry.publish()
+    assert np.allclose(survey.table['wprm'].values, survey.table['wprm_init'].values)
+
+
+def test_add_remove():
+    survey, registry = get_registry()
+    with pytest.raises(Exception):
+        registry.add('short', np.ones(3))
+    with pytest.raises(Exception):
+        registry.activate('unknown')
+    registry.add('calibrated', registry.get('initial'))
+    registry.activate('calibrated')
+    registry.remove('calibrated')
+    assert 'calibrated' not in registry
+    assert registry.active is None
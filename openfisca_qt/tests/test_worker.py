@@ -0,0 +1,116 @@
+# -*- coding:utf-8 -*-
+# Copyright © 2012 Clément Schaff, Mahdi Ben Jelloul
+
+"""
+openFisca, Logiciel libre de simulation du système socio-fiscal français
+Copyright © 2011 Clément Schaff, Mahdi Ben Jelloul
+
+This file is part of openFisca.
+
+    openFisca is free software: you can redistribute it and/or modify
+    it under the terms of the GNU General Public License as published by
+    the Free Software Foundation, either version 3 of the License, or
+    (at your option) any later version.
+
+    openFisca is distributed in the hope that it will be useful,
+    but WITHOUT ANY WARRANTY; without even the implied warranty of
+    MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+    GNU General Public License for more details.
+
+    You should have received a copy of the GNU General Public License
+    along with openFisca.  If not, see <http://www.gnu.org/licenses/>.
+"""
+
+
+from __future__ import division
+
+import threading
+
+import pytest
+
+pytest.importorskip('PyQt4')
+
+from openfisca_qt.plugins.survey.worker import Cancelled, ComputationThread, SURVEY_LOCK
+
+
+def is_locked_elsewhere(lock):
+    """
+    Returns True if the lock is held by another thread
+    """
+    result = []
+
+    def try_lock():
+        acquired = lock.acquire(False)
+        if acquired:
+            lock.release()
+        result.append(not acquired)
+    thread = threading.Thread(target = try_lock)
+    thread.start()
+    thread.join()
+    return result[0]
+
+
+def get_thread(function, args = (), kwargs = None, lock = SURVEY_LOCK):
+    thread = ComputationThread(1, function, args, kwargs, lock = lock)
+    events = []
+    thread.computed.connect(lambda run_id, result: events.append(('computed', run_id, result)))
+    thread.failed.connect(lambda run_id, error: events.append(('failed', run_id, error[0])))
+    thread.progressed.connect(lambda run_id, message: events.append(('progressed', run_id, message)))
+    return thread, events
+
+
+def test_computation_holds_the_lock():
+    def compute(value, progress = None):
+        progress('computing')
+        return is_locked_elsewhere(SURVEY_LOCK), value
+
+    thread, events = get_thread(compute, args = (3,))
+    thread.run()
+    assert events == [('progressed', 1, 'computing'), ('computed', 1, (True, 3))]
+    assert not is_locked_elsewhere(SURVEY_LOCK)
+
+
+def test_reentrant_lock():
+    # A computation may take the lock again (to load the survey for instance)
+    def compute(progress = None):
+        with SURVEY_LOCK:
+            return 'loaded'
+
+    thread, events = get_thread(compute)
+    thread.run()
+    assert events == [('computed', 1, 'loaded')]
+
+
+def test_failed_computation_releases_the_lock():
+    def compute(progress = None):
+        raise ValueError('no survey')
+
+    thread, events = get_thread(compute)
+    thread.run()
+    assert len(events) == 1
+    assert events[0][0] == 'failed' and isinstance(events[0][2], ValueError)
+    assert not is_locked_elsewhere(SURVEY_LOCK)
+
+
+def test_cancelled_computation():
+    calls = []
+
+    def compute(progress = None):
+        calls.append(1)
+        thread.cancel()
+        progress('stale')
+        calls.append(2)
+
+    thread, events = get_thread(compute)
+    thread.run()
+    assert calls == [1]
+    assert events == []
+    assert not is_locked_elsewhere(SURVEY_LOCK)
+
+    # A computation cancelled before it started is not run
+    thread, events = get_thread(compute)
+    thread.cancel()
+    thread.run()
+    assert calls == [1]
+    with pytest.raises(Cancelled):
+        thread.report('stale')